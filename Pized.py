@@ -1,13 +1,43 @@
+import asyncio
+import bisect
+import csv
+import hashlib
+import json
 import logging
 import os
+import signal
+import tempfile
+import time
 import io
 import html
-from datetime import datetime
+import multiprocessing
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, date
 import pandas as pd
 from telegram import Update, BotCommand
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ConversationHandler, ContextTypes
+from telegram.error import BadRequest
+from telegram.ext import (Application, CommandHandler, MessageHandler, filters,
+                          ConversationHandler, ContextTypes, PicklePersistence)
 from dotenv import load_dotenv
 import psycopg2
+from psycopg2.extras import execute_values
+
+# Parquet-експорт доступний лише за наявності pyarrow
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Графіки /rik малюються matplotlib без дисплея (у воркерах пулу процесів)
+try:
+    import matplotlib
+    matplotlib.use('Agg')
+except ImportError:
+    matplotlib = None
 
 # Завантажуємо змінні середовища (для локального тестування)
 load_dotenv()
@@ -30,8 +60,77 @@ CMD_SWITCH_USER = "kor" # Обрати користувача
 CMD_USER_LIST = "ulist" # Список користувачів (Адмін)
 CMD_USER_DELETE = "udel" # Видалити користувача (Адмін)
 CMD_HOLIDAY = "vih" # Вихідний
-
-# СПИСОК КОРИСТУВАЧІВ ДЛЯ ОБЛІКУ
+CMD_DELETE_RANGE = "vidr" # Видалити записи за діапазон дат
+CMD_EDIT_RANGE = "red" # Редагувати зміни за діапазон дат
+CMD_LUNCH_RANGE = "obid" # Змінити перерву за діапазон дат
+CMD_MOVE_HOLIDAY = "pvih" # Перенести вихідний
+CMD_USER_ADD = "uadd" # Додати користувача до команди (Адмін)
+CMD_TEAM_RATE = "stavka" # Ставка та валюта команди (Адмін)
+CMD_EXPORT = "eksport" # Експорт записів у CSV/Parquet
+CMD_WEEKLY = "tyzh" # Тижневі підсумки та понаднормові
+CMD_UNDO = "vidnov" # Відновити записи, видалені однією операцією (Адмін)
+CMD_AUDIT_LOG = "zhurnal" # Журнал видалень і масових змін (Адмін)
+CMD_PAY_RULE = "pravylo" # Правила оплати: ставка з дати, множники та понаднормові (Адмін)
+CMD_PUBLIC_HOLIDAY = "svyato" # Святкові дні команди (Адмін)
+CMD_REPRICE = "pererah" # Перерахувати оплату за діапазон (Адмін)
+
+# HOT-WINDOW ІНДЕКС (поточний і попередній місяць кожного користувача в пам'яті)
+HOT_INDEX_MAX_ENTRIES = int(os.getenv("HOT_INDEX_MAX_ENTRIES", 1000)) # Макс. кількість пар (користувач, місяць)
+HOT_INDEX_SHADOW = os.getenv("HOT_INDEX_SHADOW", "0") == "1" # Режим перевірки індексу проти БД
+
+# Аргумент команди для попереднього перегляду (нічого не змінює, лише рахує записи)
+DRY_RUN_ARG = "?"
+
+# СТІЙКІСТЬ ДО НЕДОСТУПНОСТІ БД
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", 5)) # Секунд на підключення до PostgreSQL
+DB_BREAKER_THRESHOLD = int(os.getenv("DB_BREAKER_THRESHOLD", 3)) # Невдач поспіль до розмикання запобіжника
+DB_BREAKER_BASE_DELAY = float(os.getenv("DB_BREAKER_BASE_DELAY", 1)) # Перша пауза запобіжника (с), далі подвоюється
+DB_BREAKER_MAX_DELAY = float(os.getenv("DB_BREAKER_MAX_DELAY", 60)) # Максимальна пауза запобіжника (с)
+# Локальний журнал записів, що очікують на БД (має бути на постійному томі: файлова система контейнера
+# Railway зникає з кожним деплоєм). За замовчуванням — на томі Railway, якщо його підключено.
+SPOOL_PATH = os.getenv("SPOOL_PATH") or os.path.join(os.getenv("RAILWAY_VOLUME_MOUNT_PATH", ""), "spool.jsonl")
+SPOOL_ON_VOLUME = bool(os.getenv("SPOOL_PATH") or os.getenv("RAILWAY_VOLUME_MOUNT_PATH")) # Без тому журнал вимкнено
+SPOOL_FSYNC_INTERVAL = float(os.getenv("SPOOL_FSYNC_INTERVAL", 0.2)) # Пакетний fsync журналу не рідше ніж раз на N с
+SPOOL_REPLAY_INTERVAL = float(os.getenv("SPOOL_REPLAY_INTERVAL", 5)) # Як часто пробувати відтворити журнал (с)
+SPOOL_SHUTDOWN_REPLAY = float(os.getenv("SPOOL_SHUTDOWN_REPLAY", 10)) # Секунд на останнє відтворення журналу при зупинці
+
+# ЖИТТЄВИЙ ЦИКЛ (перезапуски без втрати оновлень)
+DRAIN_DEADLINE = float(os.getenv("DRAIN_DEADLINE", 20)) # Секунд на завершення незавершених задач після SIGTERM
+STATE_PATH = os.getenv("STATE_PATH", "bot_state.pickle") # Стан діалогів і user_data (має бути на постійному томі)
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", 10)) # Як часто зберігати стан діалогів (с)
+PENDING_UPDATES_INTERVAL = float(os.getenv("PENDING_UPDATES_INTERVAL", 2)) # Як часто забирати відкладені оновлення (с)
+
+# МУЛЬТИКОМАНДНІСТЬ: кожен чат/група — окрема команда (тенант) зі своїм списком користувачів і ставкою
+MULTI_TENANT = os.getenv("MULTI_TENANT", "0") == "1" # Без цього прапорця всі чати працюють з командою за замовчуванням
+DEFAULT_TEAM_ID = "default" # Команда, якій належать записи, створені до появи тенантів
+LEGACY_CHAT_IDS = {c.strip() for c in os.getenv("LEGACY_CHAT_IDS", "").split(",") if c.strip()} # Чати команди за замовчуванням
+ADMIN_USER_IDS = {u.strip() for u in os.getenv("ADMIN_USER_IDS", "").split(",") if u.strip()} # Telegram ID адміністраторів бота
+TENANT_RATE_LIMIT = float(os.getenv("TENANT_RATE_LIMIT", 5)) # Важких задач (звітів) на секунду на команду
+TENANT_RATE_BURST = int(os.getenv("TENANT_RATE_BURST", 20)) # Допустимий сплеск важких задач на команду
+TENANT_MAX_CONCURRENT_JOBS = int(os.getenv("TENANT_MAX_CONCURRENT_JOBS", 2)) # Одночасних звітів на команду
+GLOBAL_MAX_CONCURRENT_JOBS = int(os.getenv("GLOBAL_MAX_CONCURRENT_JOBS", 8)) # Одночасних звітів загалом
+
+# АНАЛІТИКА
+WEEKLY_OVERTIME_HOURS = float(os.getenv("WEEKLY_OVERTIME_HOURS", 40)) # Годин на тиждень, після яких іде понаднормова робота
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 5000)) # Рядків за одне звернення серверного курсора
+TEXT_SUMMARY_LIMIT = 3500 # Довші підсумки надсилаються файлом, а не повідомленням
+
+# ЖУРНАЛ АУДИТУ
+AUDIT_LIST_LIMIT = int(os.getenv("AUDIT_LIST_LIMIT", 10)) # Скільки останніх операцій показує /zhurnal
+
+# ПРАВИЛА ОПЛАТИ
+PAY_RECOMPUTE_BATCH_SIZE = int(os.getenv("PAY_RECOMPUTE_BATCH_SIZE", 1000)) # Рядків за один UPDATE під час перерахунку
+WEEKEND_MULTIPLIER_ARG = "vih=" # /pravylo ... vih=1.5 — множник для суботи й неділі
+HOLIDAY_MULTIPLIER_ARG = "sv=" # /pravylo ... sv=2 — множник для святкових днів (/svyato)
+HOLIDAY_ON_ARG = "on" # /svyato РРРР-ММ-ДД on — зробити день святковим
+HOLIDAY_OFF_ARG = "off" # /svyato РРРР-ММ-ДД off — прибрати святковий день
+
+# ГРАФІКИ
+CHART_ARG = "grafik" # /rik РРРР grafik — річний графік замість текстового списку
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", 2)) # Процесів для малювання графіків
+CHART_CACHE_MAX_ENTRIES = int(os.getenv("CHART_CACHE_MAX_ENTRIES", 500)) # Збережених file_id графіків
+
+# СПИСОК КОРИСТУВАЧІВ ДЛЯ ОБЛІКУ (початковий реєстр команди за замовчуванням)
 KNOWN_USERS = {
     'user_1': "Іра",
     'user_2': "Андрей",
@@ -51,17 +150,48 @@ logger = logging.getLogger(__name__)
 
 # --- 2. ЛОГІКА БАЗИ ДАНИХ (POSTGRESQL) ---
 
+# Запобіжник (circuit breaker): після DB_BREAKER_THRESHOLD невдач поспіль підключення не пробуються
+# до open_until, а пауза подвоюється з кожною новою невдачею — так під час збою БД запити
+# не чекають таймаут підключення щоразу.
+_db_breaker = {'failures': 0, 'open_until': 0.0}
+_db_breaker_lock = threading.Lock()
+
+def db_breaker_open() -> bool:
+    """True, якщо запобіжник розімкнений і підключатися зараз не варто."""
+    return time.monotonic() < _db_breaker['open_until']
+
+def record_db_success() -> None:
+    """Замикає запобіжник після успішного підключення."""
+    with _db_breaker_lock:
+        if _db_breaker['failures']:
+            logger.info("PostgreSQL знову доступний, запобіжник замкнено.")
+        _db_breaker['failures'] = 0
+        _db_breaker['open_until'] = 0.0
+
+def record_db_failure() -> None:
+    """Рахує невдачу та за потреби розмикає запобіжник з експоненційною паузою."""
+    with _db_breaker_lock:
+        _db_breaker['failures'] += 1
+        failures = _db_breaker['failures']
+        if failures >= DB_BREAKER_THRESHOLD:
+            delay = min(DB_BREAKER_MAX_DELAY, DB_BREAKER_BASE_DELAY * 2 ** (failures - DB_BREAKER_THRESHOLD))
+            _db_breaker['open_until'] = time.monotonic() + delay
+            logger.warning(f"PostgreSQL недоступний ({failures} невдач поспіль), запобіжник розімкнено на {delay:g} с.")
+
 def get_db_connection():
     """
     Створює та повертає підключення до бази даних PostgreSQL. 
+    Повертає None одразу (без спроби підключення), поки розімкнений запобіжник.
     """
+    if db_breaker_open():
+        return None
+
     try:
         # 1. Підключення через повний URL (пріоритет для Railway)
         db_url = os.getenv("DATABASE_URL")
         if db_url:
-            conn = psycopg2.connect(db_url)
+            conn = psycopg2.connect(db_url, connect_timeout=DB_CONNECT_TIMEOUT)
             logger.info("Успішне підключення до PostgreSQL через DATABASE_URL.")
-            return conn
         else:
             # 2. Підключення через окремі змінні (резервний варіант)
             conn = psycopg2.connect(
@@ -69,12 +199,15 @@ def get_db_connection():
                 database=os.getenv("PGDATABASE"),
                 user=os.getenv("PGUSER"),
                 password=os.getenv("PGPASSWORD"),
-                port=os.getenv("PGPORT")
+                port=os.getenv("PGPORT"),
+                connect_timeout=DB_CONNECT_TIMEOUT
             )
             logger.info("Успішне підключення до PostgreSQL через окремі змінні.")
-            return conn
+        record_db_success()
+        return conn
     except Exception as e:
         logger.error(f"Помилка підключення до PostgreSQL: {e}")
+        record_db_failure()
         return None
 
 def setup_database():
@@ -98,36 +231,165 @@ def setup_database():
                 daily_pay REAL
             )
         ''')
+        # Кожен запис належить команді; старі записи автоматично потрапляють до команди за замовчуванням
+        cursor.execute(f'''
+            ALTER TABLE records ADD COLUMN IF NOT EXISTS team_id TEXT NOT NULL DEFAULT '{DEFAULT_TEAM_ID}'
+        ''')
+        # Індекс для пошуку за командою, користувачем і датою/діапазоном дат
+        cursor.execute('DROP INDEX IF EXISTS idx_records_user_date')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_records_team_user_date ON records (team_id, user_id, work_date)
+        ''')
+        # Експорт і тижневий підсумок для всієї команди (`all`) фільтрують лише команду й діапазон дат —
+        # без цього індексу вони переглядали б усю історію команди
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_records_team_date ON records (team_id, work_date)
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS teams (
+                team_id TEXT PRIMARY KEY,
+                pay_rate REAL NOT NULL,
+                currency TEXT NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS team_users (
+                team_id TEXT NOT NULL,
+                user_code TEXT NOT NULL,
+                user_name TEXT NOT NULL,
+                PRIMARY KEY (team_id, user_code)
+            )
+        ''')
+        # Ідентифікатори операцій з локального журналу, вже застосованих до БД (ідемпотентне відтворення)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS applied_ops (
+                op_id TEXT PRIMARY KEY,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        ''')
+        # Оновлення, які інстанс не встиг обробити під час зупинки (їх забирає наступний інстанс)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS pending_updates (
+                id BIGSERIAL PRIMARY KEY,
+                payload TEXT NOT NULL,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        ''')
+        # Правила оплати з дати дії: для користувача або всієї команди (user_code = '*')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS pay_rules (
+                team_id TEXT NOT NULL,
+                user_code TEXT NOT NULL,
+                valid_from TEXT NOT NULL, -- РРРР-ММ-ДД
+                hourly_rate REAL NOT NULL,
+                weekend_multiplier REAL NOT NULL DEFAULT 1,
+                holiday_multiplier REAL NOT NULL DEFAULT 1,
+                overtime_tiers JSONB NOT NULL DEFAULT '[]', -- [[поріг годин, множник], ...]
+                PRIMARY KEY (team_id, user_code, valid_from)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS pay_holidays (
+                team_id TEXT NOT NULL,
+                holiday_date TEXT NOT NULL, -- РРРР-ММ-ДД
+                PRIMARY KEY (team_id, holiday_date)
+            )
+        ''')
+        # Журнал аудиту: вміст видалених рядків, хто і коли їх видалив (лише дописування)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS audit_log (
+                id BIGSERIAL PRIMARY KEY,
+                batch_id TEXT NOT NULL,
+                team_id TEXT NOT NULL,
+                action TEXT NOT NULL,
+                actor_chat_id BIGINT,
+                actor_user_id BIGINT,
+                logged_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                record JSONB NOT NULL,
+                undo_of TEXT -- Для подій відновлення: партія, яку відновлено
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_audit_log_team_batch ON audit_log (team_id, batch_id)')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_audit_log_team_undo ON audit_log (team_id, undo_of) WHERE undo_of IS NOT NULL
+        ''')
+        # Змінити чи стерти рядки журналу не можна навіть прямим SQL-запитом
+        cursor.execute('''
+            CREATE OR REPLACE FUNCTION audit_log_append_only() RETURNS trigger AS $$
+            BEGIN
+                RAISE EXCEPTION 'audit_log is append-only';
+            END;
+            $$ LANGUAGE plpgsql
+        ''')
+        cursor.execute('DROP TRIGGER IF EXISTS audit_log_no_change ON audit_log')
+        cursor.execute('''
+            CREATE TRIGGER audit_log_no_change BEFORE UPDATE OR DELETE ON audit_log
+            FOR EACH ROW EXECUTE FUNCTION audit_log_append_only()
+        ''')
+        cursor.execute('DROP TRIGGER IF EXISTS audit_log_no_truncate ON audit_log')
+        cursor.execute('''
+            CREATE TRIGGER audit_log_no_truncate BEFORE TRUNCATE ON audit_log
+            FOR EACH STATEMENT EXECUTE FUNCTION audit_log_append_only()
+        ''')
+        # Команда за замовчуванням отримує ставку та реєстр з констант
+        cursor.execute('''
+            INSERT INTO teams (team_id, pay_rate, currency) VALUES (%s, %s, %s)
+            ON CONFLICT (team_id) DO NOTHING
+        ''', (DEFAULT_TEAM_ID, PAY_RATE, CURRENCY_SYMBOL))
+        for user_code, user_name in KNOWN_USERS.items():
+            cursor.execute('''
+                INSERT INTO team_users (team_id, user_code, user_name) VALUES (%s, %s, %s)
+                ON CONFLICT (team_id, user_code) DO NOTHING
+            ''', (DEFAULT_TEAM_ID, user_code, user_name))
         conn.commit()
-        logger.info("Таблиця 'records' перевірена/створена успішно.")
+        logger.info("Таблиці 'records', 'teams', 'team_users', 'pay_rules', 'audit_log' перевірені/створені успішно.")
     except Exception as e:
         logger.error(f"Помилка ініціалізації таблиць PostgreSQL: {e}")
     finally:
         if conn:
             conn.close()
 
-def save_record(user_code: str, work_date, time_start, time_end, lunch_mins, net_hours, daily_pay):
-    """Зберігає розраховані дані в базу."""
+def save_record(team_id: str, user_code: str, work_date, time_start, time_end, lunch_mins, net_hours, daily_pay) -> str:
+    """
+    Зберігає розраховані дані в базу. Якщо БД недоступна (або в журналі вже є операції, що
+    очікують — щоб не порушити порядок), запис потрапляє до локального журналу.
+    Повертає SAVE_STORED, SAVE_QUEUED або SAVE_FAILED.
+    """
+    op = {'op': 'save', 'team_id': team_id, 'user_code': user_code, 'work_date': work_date,
+          'time_start': time_start, 'time_end': time_end, 'lunch_mins': lunch_mins,
+          'net_hours': net_hours, 'daily_pay': daily_pay}
+    if spool_has_pending():
+        return queue_mutation(op)
+
     conn = get_db_connection()
     if conn is None:
-        return
+        return queue_mutation(op)
 
+    status = SAVE_STORED
     try:
         cursor = conn.cursor()
         cursor.execute('''
             INSERT INTO records
-            (user_id, work_date, time_start, time_end, lunch_mins, net_hours, daily_pay)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-        ''', (user_code, work_date, time_start, time_end, lunch_mins, net_hours, daily_pay))
+            (team_id, user_id, work_date, time_start, time_end, lunch_mins, net_hours, daily_pay)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        ''', (team_id, user_code, work_date, time_start, time_end, lunch_mins, net_hours, daily_pay))
         conn.commit()
+        hot_index_record_saved(team_id, user_code, work_date, net_hours, daily_pay)
+    except psycopg2.OperationalError as e:
+        # З'єднання обірвалось посеред запиту — зберігаємо операцію в журналі
+        logger.error(f"Втрачено з'єднання з PostgreSQL під час збереження: {e}")
+        record_db_failure()
+        status = queue_mutation(op)
     except Exception as e:
         logger.error(f"Помилка збереження запису в PostgreSQL: {e}")
         conn.rollback()
+        status = SAVE_FAILED
     finally:
         if conn:
             conn.close()
+    return status
 
-def get_monthly_records(month_year_prefix: str, user_code: str):
+def get_monthly_records(team_id: str, month_year_prefix: str, user_code: str):
     """Витягує всі записи за вказаний місяць для користувача."""
     conn = get_db_connection()
     if conn is None:
@@ -139,9 +401,9 @@ def get_monthly_records(month_year_prefix: str, user_code: str):
         cursor.execute('''
             SELECT work_date, time_start, time_end, lunch_mins, net_hours, daily_pay
             FROM records
-            WHERE user_id = %s AND work_date LIKE %s
+            WHERE team_id = %s AND user_id = %s AND work_date LIKE %s
             ORDER BY work_date ASC -- Сортування за датою в БД
-        ''', (user_code, month_year_prefix + '%'))
+        ''', (team_id, user_code, month_year_prefix + '%'))
 
         records = cursor.fetchall()
     except Exception as e:
@@ -151,7 +413,7 @@ def get_monthly_records(month_year_prefix: str, user_code: str):
             conn.close()
     return records
 
-def get_annual_records_by_month(user_code: str, year: str):
+def get_annual_records_by_month(team_id: str, user_code: str, year: str):
     """Витягує всі робочі дати (РРРР-ММ-ДД) за вказаний рік для користувача."""
     conn = get_db_connection()
     if conn is None:
@@ -163,9 +425,9 @@ def get_annual_records_by_month(user_code: str, year: str):
         cursor.execute('''
             SELECT work_date
             FROM records
-            WHERE user_id = %s AND work_date LIKE %s
+            WHERE team_id = %s AND user_id = %s AND work_date LIKE %s
             ORDER BY work_date ASC
-        ''', (user_code, year + '-%'))
+        ''', (team_id, user_code, year + '-%'))
         dates = [row[0] for row in cursor.fetchall()]
     except Exception as e:
         logger.error(f"Помилка отримання річних записів PostgreSQL: {e}")
@@ -174,21 +436,59 @@ def get_annual_records_by_month(user_code: str, year: str):
             conn.close()
     return dates
 
-def delete_record(user_code: str, date_str: str):
-    """Видаляє запис за конкретною датою для користувача."""
+def get_annual_daily_totals(team_id: str, user_code: str, year: str):
+    """Повертає агреговані (дата, годин, оплата) по днях за рік — не більше 366 рядків."""
     conn = get_db_connection()
     if conn is None:
-        return 0
+        return []
 
-    changes = 0
+    rows = []
     try:
         cursor = conn.cursor()
         cursor.execute('''
+            SELECT work_date, SUM(net_hours), SUM(daily_pay)
+            FROM records
+            WHERE team_id = %s AND user_id = %s AND work_date LIKE %s
+            GROUP BY work_date
+            ORDER BY work_date ASC
+        ''', (team_id, user_code, year + '-%'))
+        rows = cursor.fetchall()
+    except Exception as e:
+        logger.error(f"Помилка отримання річних підсумків PostgreSQL: {e}")
+    finally:
+        if conn:
+            conn.close()
+    return rows
+
+def delete_record(team_id: str, user_code: str, date_str: str, audit: dict):
+    """
+    Видаляє запис за конкретною датою для користувача (вміст потрапляє до журналу аудиту).
+    Повертає кількість видалених рядків або DELETE_QUEUED, якщо видалення поставлено
+    в локальний журнал до відновлення БД.
+    """
+    op = {'op': 'delete', 'team_id': team_id, 'user_code': user_code, 'work_date': date_str, 'audit': audit}
+    if spool_has_pending():
+        return DELETE_QUEUED if queue_mutation(op) == SAVE_QUEUED else 0
+
+    conn = get_db_connection()
+    if conn is None:
+        return DELETE_QUEUED if queue_mutation(op) == SAVE_QUEUED else 0
+
+    changes = 0
+    try:
+        cursor = conn.cursor()
+        cursor.execute(audited_delete('''
             DELETE FROM records
-            WHERE user_id = %s AND work_date = %s
-        ''', (user_code, date_str))
+            WHERE team_id = %s AND user_id = %s AND work_date = %s
+        '''), (team_id, user_code, date_str) + audit_params(audit))
         changes = cursor.rowcount
         conn.commit()
+        hot_index_invalidate(team_id, user_code, date_str, date_str)
+    except psycopg2.OperationalError as e:
+        # З'єднання обірвалось посеред запиту — ставимо видалення в журнал (повтор ідемпотентний)
+        logger.error(f"Втрачено з'єднання з PostgreSQL під час видалення: {e}")
+        record_db_failure()
+        changes = DELETE_QUEUED if queue_mutation(op) == SAVE_QUEUED else 0
     except Exception as e:
         logger.error(f"Помилка видалення запису PostgreSQL: {e}")
         conn.rollback()
@@ -197,8 +497,22 @@ def delete_record(user_code: str, date_str: str):
             conn.close()
     return changes
 
-def check_record_exists(user_code: str, date_str: str) -> bool:
-    """Перевіряє, чи існує запис для даного користувача і дати."""
+def check_record_exists(team_id: str, user_code: str, date_str: str) -> bool:
+    """
+    Перевіряє, чи існує запис для даного користувача і дати. Спершу враховуються операції
+    з локального журналу, що ще чекають на БД; для поточного та попереднього місяця далі
+    відповідає hot-window індекс без запиту до БД.
+    """
+    spooled = spooled_record_state(team_id, user_code, date_str)
+    if spooled is not None:
+        return spooled
+    entry = get_hot_month(team_id, user_code, date_str[:7])
+    if entry is not None:
+        return bool(entry['days'] >> int(date_str[8:10]) & 1)
+    return check_record_exists_db(team_id, user_code, date_str)
+
+def check_record_exists_db(team_id: str, user_code: str, date_str: str) -> bool:
+    """Перевіряє наявність запису безпосередньо в БД."""
     conn = get_db_connection()
     if conn is None:
         return False
@@ -209,8 +523,8 @@ def check_record_exists(user_code: str, date_str: str) -> bool:
         cursor.execute('''
             SELECT 1
             FROM records
-            WHERE user_id = %s AND work_date = %s
-        ''', (user_code, date_str))
+            WHERE team_id = %s AND user_id = %s AND work_date = %s
+        ''', (team_id, user_code, date_str))
         record_exists = cursor.fetchone() is not None
     except Exception as e:
         logger.error(f"Помилка перевірки запису PostgreSQL: {e}")
@@ -219,177 +533,1677 @@ def check_record_exists(user_code: str, date_str: str) -> bool:
             conn.close()
     return record_exists
 
-def delete_user_records(user_code: str):
-    """Видаляє всі записи для конкретного коду користувача."""
+def delete_user_records(team_id: str, user_code: str, audit: dict):
+    """
+    Видаляє всі записи для конкретного коду користувача в межах команди. Видалені рядки
+    переносяться до журналу аудиту тим самим запитом і не завантажуються в пам'ять бота.
+    Повертає кількість видалених рядків або None, якщо видалення не виконано.
+    """
+    if spool_blocks_write("видалення записів користувача"):
+        return None
     conn = get_db_connection()
     if conn is None:
-        return 0
+        return None
 
-    changes = 0
+    changes = None
     try:
         cursor = conn.cursor()
-        cursor.execute('''
+        cursor.execute(audited_delete('''
             DELETE FROM records
-            WHERE user_id = %s
-        ''', (user_code,))
+            WHERE team_id = %s AND user_id = %s
+        '''), (team_id, user_code) + audit_params(audit))
 
         changes = cursor.rowcount
         conn.commit()
+        hot_index_invalidate(team_id, user_code)
     except Exception as e:
         logger.error(f"Помилка видалення всіх записів користувача PostgreSQL: {e}")
         conn.rollback()
+        changes = None
     finally:
         if conn:
             conn.close()
     return changes
 
 
-# --- 3. ЛОГІКА РОЗРАХУНКУ ЧАСУ ---
+# --- 2.1. ДІАПАЗОННІ ОПЕРАЦІЇ (ОДИН SET-BASED ЗАПИТ НА КОМАНДУ) ---
 
-def calculate_work_data(date_str, start_time_str, end_time_str, lunch_minutes):
+def execute_range_statement(query: str, params: tuple, dry_run: bool = False) -> int | None:
     """
-    Розраховує чистий робочий час та оплату за день.
+    Виконує одну set-based операцію в окремій транзакції та повертає кількість змінених рядків
+    (None, якщо БД недоступна або запит завершився помилкою).
+    У режимі dry_run той самий запит відкочується — так попередній перегляд завжди
+    показує точну кількість рядків, яку зачепить реальне виконання.
     """
+    if not dry_run and spool_blocks_write("діапазонна операція"):
+        return None
+    conn = get_db_connection()
+    if conn is None:
+        return None
+
+    changes = None
     try:
-        start_dt = datetime.strptime(f"{date_str} {start_time_str}", "%Y-%m-%d %H:%M")
-        end_dt = datetime.strptime(f"{date_str} {end_time_str}", "%Y-%m-%d %H:%M")
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        changes = cursor.rowcount
+        if dry_run:
+            conn.rollback()
+        else:
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Помилка діапазонної операції PostgreSQL: {e}")
+        conn.rollback()
+        changes = None
+    finally:
+        if conn:
+            conn.close()
+    return changes
 
-        total_duration_minutes = (end_dt - start_dt).total_seconds() / 60
-        
-        # Віднімаємо лише загальний час, вказаний користувачем
-        total_deduction_minutes = lunch_minutes 
-        net_minutes = total_duration_minutes - total_deduction_minutes
+def delete_records_range(team_id: str, user_code: str, date_from: str, date_to: str, audit: dict,
+                         dry_run: bool = False) -> int | None:
+    """Видаляє всі записи користувача в діапазоні дат (включно) одним запитом разом із записом до журналу аудиту."""
+    changes = execute_range_statement(audited_delete('''
+        DELETE FROM records
+        WHERE team_id = %s AND user_id = %s AND work_date BETWEEN %s AND %s
+    '''), (team_id, user_code, date_from, date_to) + audit_params(audit), dry_run)
+    if changes and not dry_run:
+        hot_index_invalidate(team_id, user_code, date_from, date_to)
+    return changes
 
-        if net_minutes < 0:
-            return None, None, "Помилка: Загальний час перерви перевищує тривалість зміни. Перевірте дані."
+def update_records_range_priced(team_id: str, user_code: str, date_from: str, date_to: str, lunch_mins: int,
+                                audit: dict, shift: tuple | None = None, dry_run: bool = False) -> tuple:
+    """
+    Змінює перерву (і, якщо задано shift=(початок, кінець), саму зміну) для робочих днів діапазону та
+    перераховує чистий час і оплату за правилами команди в тій самій транзакції: рядки блокуються
+    SELECT ... FOR UPDATE, оцінюються PayRuleIndex і записуються одним UPDATE ... FROM (VALUES ...).
+    Стан рядків до зміни потрапляє до журналу аудиту в тій самій транзакції (скасування — /vidnov).
+    Дні, де перерва перевищує тривалість зміни, не змінюються.
+    Повертає (кількість змінених рядків, кількість пропущених днів, сумарна оплата змінених днів);
+    (None, 0, 0.0) — операцію не виконано.
+    У режимі dry_run транзакція відкочується, тож попередній перегляд показує ту саму кількість і оплату.
+    """
+    if not dry_run and spool_blocks_write("діапазонна операція"):
+        return None, 0, 0.0
+    pay_rules = get_pay_rules(team_id)
+    conn = get_db_connection()
+    if conn is None:
+        return None, 0, 0.0
 
-        net_hours = round(net_minutes / 60, 2)
-        daily_pay = round(net_hours * PAY_RATE, 2)
+    changes, skipped, total_pay = None, 0, 0.0
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, work_date, time_start, time_end
+            FROM records
+            WHERE team_id = %s AND user_id = %s AND work_date BETWEEN %s AND %s AND time_start <> '-'
+            ORDER BY id
+            FOR UPDATE
+        ''', (team_id, user_code, date_from, date_to))
+        values = []
+        for record_id, work_date, time_start, time_end in cursor.fetchall():
+            time_start, time_end = shift or (time_start, time_end)
+            net_hours, _, error_msg = calculate_work_data(work_date, time_start, time_end, lunch_mins)
+            if error_msg:
+                skipped += 1
+                continue
+            pay = pay_rules.price(user_code, work_date, net_hours)
+            values.append((record_id, time_start, time_end, lunch_mins, net_hours, pay))
+            total_pay += pay
+        if values:
+            cursor.execute(AUDIT_INSERT_SNAPSHOT, audit_params(audit) + ([value[0] for value in values],))
+            execute_values(cursor, '''
+                UPDATE records AS r
+                SET time_start = v.time_start, time_end = v.time_end, lunch_mins = v.lunch_mins,
+                    net_hours = v.net_hours, daily_pay = v.pay
+                FROM (VALUES %s) AS v (id, time_start, time_end, lunch_mins, net_hours, pay)
+                WHERE r.id = v.id
+            ''', values, template='(%s::integer, %s, %s, %s::integer, %s::real, %s::real)',
+                page_size=PAY_RECOMPUTE_BATCH_SIZE)
+        changes = len(values)
+        if dry_run:
+            conn.rollback()
+        else:
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Помилка діапазонної операції PostgreSQL: {e}")
+        conn.rollback()
+        changes, skipped, total_pay = None, 0, 0.0
+    finally:
+        if conn:
+            conn.close()
+    if changes and not dry_run:
+        hot_index_invalidate(team_id, user_code, date_from, date_to)
+    return changes, skipped, round(total_pay, 2)
+
+def update_records_range_shift(team_id: str, user_code: str, date_from: str, date_to: str, time_start: str, time_end: str,
+                               lunch_mins: int, audit: dict, dry_run: bool = False) -> tuple:
+    """Встановлює однакову зміну для всіх робочих днів (не вихідних) у діапазоні з оплатою за правилами команди."""
+    return update_records_range_priced(team_id, user_code, date_from, date_to, lunch_mins, audit,
+                                       (time_start, time_end), dry_run)
+
+def update_records_range_lunch(team_id: str, user_code: str, date_from: str, date_to: str, lunch_mins: int,
+                               audit: dict, dry_run: bool = False) -> tuple:
+    """Змінює тривалість перерви для робочих днів у діапазоні з перерахунком годин і оплати за правилами команди."""
+    return update_records_range_priced(team_id, user_code, date_from, date_to, lunch_mins, audit, dry_run=dry_run)
+
+def move_holiday_record(team_id: str, user_code: str, old_date: str, new_date: str, audit: dict,
+                        dry_run: bool = False) -> int | None:
+    """Переносить вихідний на іншу дату, якщо нова дата ще вільна (стан до перенесення — у журнал аудиту)."""
+    changes = execute_range_statement(f'''
+        WITH moved AS (
+            SELECT * FROM records
+            WHERE team_id = %s AND user_id = %s AND work_date = %s AND time_start = '-'
+              AND NOT EXISTS (
+                  SELECT 1 FROM records WHERE team_id = %s AND user_id = %s AND work_date = %s
+              )
+            FOR UPDATE
+        ), logged AS (
+            {AUDIT_INSERT_MOVED}
+        )
+        UPDATE records AS r
+        SET work_date = %s
+        FROM moved
+        WHERE r.id = moved.id
+    ''', (team_id, user_code, old_date, team_id, user_code, new_date) + audit_params(audit) + (new_date,), dry_run)
+    if changes and not dry_run:
+        hot_index_invalidate(team_id, user_code, old_date, old_date)
+        hot_index_invalidate(team_id, user_code, new_date, new_date)
+    return changes
 
-        return net_hours, daily_pay, None
 
-    except ValueError:
-        return None, None, "Помилка формату: Переконайтеся, що час введено як ГГ:ХХ (наприклад, 09:00), а дата як РРРР-ММ-ДД."
+# --- 2.2. HOT-WINDOW ІНДЕКС ОСТАННІХ МІСЯЦІВ ---
+# Ключ: (команда, код користувача, 'РРРР-ММ'). Значення: бітові маски днів місяця (біт N = день N)
+# для всіх записів і лише для робочих днів, а також підсумки годин та оплати.
+# Індекс заповнюється ліниво, оновлюється з функцій збереження/видалення та
+# обмежений HOT_INDEX_MAX_ENTRIES (витісняється найдавніше використаний місяць).
+# Кожне збереження та скидання місяця збільшує його покоління: знімок, завантажений з БД
+# паралельно зі зміною (покоління змінилося), відкидається, а не перезаписує новіший стан.
+
+_hot_index = OrderedDict()
+_hot_index_generations = {} # Ключ індексу -> покоління (лише місяці вікна)
+_hot_index_lock = threading.Lock()
+HOT_INDEX_STATS = {'hits': 0, 'misses': 0, 'divergences': 0}
+
+def hot_window_months(today: date | None = None) -> tuple:
+    """Повертає префікси 'РРРР-ММ' поточного та попереднього місяця."""
+    today = today or date.today()
+    if today.month == 1:
+        previous = f"{today.year - 1}-12"
+    else:
+        previous = f"{today.year}-{today.month - 1:02d}"
+    return (today.strftime("%Y-%m"), previous)
+
+def load_hot_month(team_id: str, user_code: str, month: str):
+    """Будує запис індексу за місяць одним запитом до БД. Повертає None, якщо БД недоступна."""
+    conn = get_db_connection()
+    if conn is None:
+        return None
+
+    entry = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT work_date, net_hours, daily_pay
+            FROM records
+            WHERE team_id = %s AND user_id = %s AND work_date LIKE %s
+        ''', (team_id, user_code, month + '-%'))
+        entry = {'days': 0, 'worked': 0, 'hours': 0.0, 'pay': 0.0}
+        for work_date, net_hours, daily_pay in cursor.fetchall():
+            bit = 1 << int(work_date[8:10])
+            entry['days'] |= bit
+            if net_hours:
+                entry['worked'] |= bit
+            entry['hours'] += net_hours or 0.0
+            entry['pay'] += daily_pay or 0.0
     except Exception as e:
-        logger.error(f"Непередбачена помилка: {e}")
-        return None, None, f"Непередбачена помилка: {e}"
+        logger.error(f"Помилка завантаження hot-window індексу PostgreSQL: {e}")
+        entry = None
+    finally:
+        if conn:
+            conn.close()
+    return entry
 
+def hot_entries_equal(a: dict, b: dict) -> bool:
+    """Порівнює два записи індексу з точністю до копійок."""
+    return (a['days'] == b['days'] and a['worked'] == b['worked']
+            and round(a['hours'], 2) == round(b['hours'], 2)
+            and round(a['pay'], 2) == round(b['pay'], 2))
 
-# --- 4. ОБРОБНИКИ TELEGRAM-БОТА ---
+def get_hot_month(team_id: str, user_code: str, month: str):
+    """
+    Повертає запис індексу за місяць або None, якщо місяць поза вікном, БД недоступна
+    або місяць змінився під час завантаження.
+    У режимі HOT_INDEX_SHADOW кожне звернення перевіряється проти БД, а розбіжності логуються.
+    """
+    window = hot_window_months()
+    if month not in window:
+        return None
 
-async def select_user_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    # ... (код select_user_start) ...
-    user_options = "\n".join([f"• <b>{html.escape(key)}</b> - {html.escape(name)}"
-                             for key, name in KNOWN_USERS.items()])
+    key = (team_id, user_code, month)
+    with _hot_index_lock:
+        entry = _hot_index.get(key)
+        generation = _hot_index_generations.get(key, 0)
+        if entry is not None:
+            _hot_index.move_to_end(key)
+            HOT_INDEX_STATS['hits'] += 1
+            entry = dict(entry)
+
+    if entry is not None and not HOT_INDEX_SHADOW:
+        return entry
+
+    fresh = load_hot_month(team_id, user_code, month)
+    if fresh is None:
+        return entry
+
+    with _hot_index_lock:
+        # Поки місяць завантажувався, його змінили (збереження, відтворення журналу, діапазонна
+        # операція) — знімок міг не побачити зміну, тож не кешуємо його; викликач звернеться до БД
+        if _hot_index_generations.get(key, 0) != generation:
+            return None
+        _hot_index[key] = fresh
+        _hot_index.move_to_end(key)
+        # Прибираємо місяці, що випали з вікна, та витісняємо найдавніші записи
+        for stale_key in [k for k in _hot_index if k[2] not in window]:
+            del _hot_index[stale_key]
+        for stale_key in [k for k in _hot_index_generations if k[2] not in window]:
+            del _hot_index_generations[stale_key]
+        while len(_hot_index) > HOT_INDEX_MAX_ENTRIES:
+            _hot_index.popitem(last=False)
+
+    if entry is not None and not hot_entries_equal(entry, fresh):
+        HOT_INDEX_STATS['divergences'] += 1
+        logger.warning(f"[HOT_INDEX] Розбіжність з БД для {team_id}/{user_code} {month}: індекс={entry}, БД={fresh}")
+    if entry is None:
+        HOT_INDEX_STATS['misses'] += 1
+    return dict(fresh)
+
+def hot_index_record_saved(team_id: str, user_code: str, date_str: str, net_hours: float, daily_pay: float) -> None:
+    """Write-through після успішного INSERT: оновлює вже завантажений місяць (незавантажений не чіпає)."""
+    key = (team_id, user_code, date_str[:7])
+    with _hot_index_lock:
+        if key[2] in hot_window_months():
+            _hot_index_generations[key] = _hot_index_generations.get(key, 0) + 1
+        entry = _hot_index.get(key)
+        if entry is None:
+            return
+        bit = 1 << int(date_str[8:10])
+        entry['days'] |= bit
+        if net_hours:
+            entry['worked'] |= bit
+        entry['hours'] += net_hours or 0.0
+        entry['pay'] += daily_pay or 0.0
+
+def hot_index_invalidate(team_id: str, user_code: str, date_from: str | None = None, date_to: str | None = None) -> None:
+    """
+    Write-through після видалення/редагування: скидає місяці користувача, що перетинаються з діапазоном
+    (або всі його місяці). Вони будуть перезавантажені ліниво при наступному зверненні.
+    """
+    with _hot_index_lock:
+        # Покоління збільшується й для незавантажених місяців: їх саме зараз може завантажувати інший потік
+        for month in hot_window_months():
+            if date_from is None or date_from[:7] <= month <= date_to[:7]:
+                key = (team_id, user_code, month)
+                _hot_index_generations[key] = _hot_index_generations.get(key, 0) + 1
+        for key in list(_hot_index):
+            team, code, month = key
+            if team != team_id or code != user_code:
+                continue
+            if date_from is None or date_from[:7] <= month <= date_to[:7]:
+                del _hot_index[key]
+
+def get_month_progress(team_id: str, user_code: str, month: str):
+    """Повертає (робочих днів, годин, оплата) за місяць з індексу або None, якщо місяць поза вікном."""
+    entry = get_hot_month(team_id, user_code, month)
+    if entry is None:
+        return None
+    return bin(entry['worked']).count('1'), round(entry['hours'], 2), round(entry['pay'], 2)
 
-    await update.message.reply_text(
-        "👤 <b>Оберіть, для кого буде вестися облік:</b>\n"
-        "Введіть один із кодів зі списку (наприклад, user_1):\n\n"
-        f"{user_options}",
-        parse_mode='HTML'
-    )
-    return USER_SELECT
 
-async def select_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    # ... (код select_user) ...
-    user_code = update.message.text.strip().lower()
+# --- 2.3. КОМАНДИ (ТЕНАНТИ): РЕЄСТР КОРИСТУВАЧІВ, СТАВКИ ТА ЛІМІТИ ---
+# Тенант — словник {'team_id', 'users': {код: ім'я}, 'pay_rate', 'currency'}.
+# Реєстр кожної команди кешується в пам'яті та скидається при будь-якій зміні.
 
-    if user_code not in KNOWN_USERS:
-        await update.message.reply_text(
-            f"⛔️ Код `{user_code}` не знайдено. Введіть коректний код зі списку:",
-            parse_mode='Markdown'
-        )
-        return USER_SELECT
+_tenant_cache = {}
+_tenant_cache_lock = threading.Lock()
 
-    user_name = KNOWN_USERS[user_code]
-    context.user_data['current_user'] = user_code
+def team_id_for_chat(chat_id) -> str:
+    """Повертає ідентифікатор команди для чату Telegram."""
+    if not MULTI_TENANT or str(chat_id) in LEGACY_CHAT_IDS:
+        return DEFAULT_TEAM_ID
+    return f"chat_{chat_id}"
 
-    await update.message.reply_text(
-        f"✅ Облік встановлено для **{user_name}** (`{user_code}`).\n"
-        f"Тепер ви можете почати облік: **/{CMD_START_DAY}**",
-        parse_mode='Markdown'
-    )
-    return ConversationHandler.END
+def default_tenant(team_id: str) -> dict:
+    """Тенант з налаштуваннями за замовчуванням (використовується, поки БД недоступна)."""
+    users = dict(KNOWN_USERS) if team_id == DEFAULT_TEAM_ID else {}
+    return {'team_id': team_id, 'users': users, 'pay_rate': PAY_RATE, 'currency': CURRENCY_SYMBOL}
 
+def load_tenant(team_id: str):
+    """Завантажує (і за потреби створює) команду з її реєстром. Повертає None, якщо БД недоступна."""
+    conn = get_db_connection()
+    if conn is None:
+        return None
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    # ... (код start) ...
-    current_user_code = context.user_data.get('current_user')
+    tenant = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO teams (team_id, pay_rate, currency) VALUES (%s, %s, %s)
+            ON CONFLICT (team_id) DO NOTHING
+        ''', (team_id, PAY_RATE, CURRENCY_SYMBOL))
+        cursor.execute('SELECT pay_rate, currency FROM teams WHERE team_id = %s', (team_id,))
+        pay_rate, currency = cursor.fetchone()
+        cursor.execute('''
+            SELECT user_code, user_name FROM team_users
+            WHERE team_id = %s
+            ORDER BY user_code
+        ''', (team_id,))
+        users = dict(cursor.fetchall())
+        conn.commit()
+        tenant = {'team_id': team_id, 'users': users, 'pay_rate': pay_rate, 'currency': currency}
+    except Exception as e:
+        logger.error(f"Помилка завантаження команди PostgreSQL: {e}")
+        conn.rollback()
+    finally:
+        if conn:
+            conn.close()
+    return tenant
+
+def get_tenant(team_id: str) -> dict:
+    """Повертає налаштування команди з кешу, завантажуючи їх з БД при першому зверненні."""
+    with _tenant_cache_lock:
+        tenant = _tenant_cache.get(team_id)
+    if tenant is not None:
+        return tenant
+
+    tenant = load_tenant(team_id)
+    if tenant is None:
+        return default_tenant(team_id)
+    with _tenant_cache_lock:
+        _tenant_cache[team_id] = tenant
+    return tenant
+
+def get_chat_tenant(update: Update) -> dict:
+    """Повертає команду, до якої належить чат оновлення."""
+    return get_tenant(team_id_for_chat(update.effective_chat.id))
+
+def invalidate_tenant(team_id: str) -> None:
+    """Скидає кеш команди після зміни її реєстру або ставки (разом зі скомпільованими правилами оплати)."""
+    with _tenant_cache_lock:
+        _tenant_cache.pop(team_id, None)
+    invalidate_pay_rules(team_id)
+
+def execute_tenant_statement(team_id: str, query: str, params: tuple) -> int:
+    """Виконує зміну реєстру/налаштувань команди та скидає її кеш."""
+    conn = get_db_connection()
+    if conn is None:
+        return 0
 
-    if not current_user_code:
-        await update.message.reply_text(
-            f"❌ **Помилка:** Спочатку оберіть користувача для обліку: **/{CMD_SWITCH_USER}**",
-            parse_mode='Markdown'
-        )
-        return ConversationHandler.END
+    changes = 0
+    try:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        changes = cursor.rowcount
+        conn.commit()
+    except Exception as e:
+        logger.error(f"Помилка зміни налаштувань команди PostgreSQL: {e}")
+        conn.rollback()
+    finally:
+        if conn:
+            conn.close()
+    invalidate_tenant(team_id)
+    return changes
 
-    user_name = KNOWN_USERS[current_user_code]
+def add_team_user(team_id: str, user_code: str, user_name: str) -> int:
+    """Додає користувача до реєстру команди або перейменовує існуючого."""
+    return execute_tenant_statement(team_id, '''
+        INSERT INTO team_users (team_id, user_code, user_name) VALUES (%s, %s, %s)
+        ON CONFLICT (team_id, user_code) DO UPDATE SET user_name = EXCLUDED.user_name
+    ''', (team_id, user_code, user_name))
 
-    await update.message.reply_text(
-        f"👋 Привіт! Облік для **{user_name}**.\n"
-        "Введіть **дату** (формат: РРРР-ММ-ДД, наприклад: 2025-10-15):"
-    )
-    return GET_DATE
+def remove_team_user(team_id: str, user_code: str) -> int:
+    """Видаляє користувача з реєстру команди."""
+    return execute_tenant_statement(team_id, '''
+        DELETE FROM team_users WHERE team_id = %s AND user_code = %s
+    ''', (team_id, user_code))
 
-async def get_date(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Отримання дати, перевірка, стандартизація і запит часу початку."""
-    date_str_input = update.message.text.strip()
+def set_team_pay_rate(team_id: str, pay_rate: float, currency: str) -> int:
+    """Змінює ставку та валюту команди."""
+    return execute_tenant_statement(team_id, '''
+        UPDATE teams SET pay_rate = %s, currency = %s WHERE team_id = %s
+    ''', (pay_rate, currency, team_id))
 
-    try:
-        # Стандартизуємо дату: перетворюємо на об'єкт datetime, а потім назад у формат YYYY-MM-DD
-        # Це виправить '2025-10-1' на '2025-10-01'
-        date_obj = datetime.strptime(date_str_input, "%Y-%m-%d")
-        date_str_standard = date_obj.strftime("%Y-%m-%d") # Це гарантує формат з нулями спереду
-    except ValueError:
-        await update.message.reply_text("⛔️ Невірний формат дати. Спробуйте ще раз (РРРР-ММ-ДД):")
-        return GET_DATE
 
-    current_user_code = context.user_data.get('current_user')
-    if not current_user_code:
-        await update.message.reply_text(f"❌ Помилка: Користувач не обраний. Будь ласка, почніть з `/{CMD_SWITCH_USER}`.")
-        return ConversationHandler.END
+class ServiceDraining(Exception):
+    """
+    Бот зупиняється: нова важка задача не прийнята. Кидається лише до першого запису обробника,
+    тому оновлення можна передати наступному інстансу (див. розділ 2.6).
+    """
 
-    if check_record_exists(current_user_code, date_str_standard):
-        await update.message.reply_text(
-            f"❌ **Помилка:** Запис за дату **{date_str_standard}** для користувача **{KNOWN_USERS[current_user_code]}** вже існує!\n\n"
-            f"Щоб додати новий запис, спочатку видаліть існуючий командою: `/{CMD_DELETE_DAY} {date_str_standard}` або скасуйте введення: `/{CMD_CANCEL}`.",
-            parse_mode='Markdown'
-        )
-        return ConversationHandler.END
 
-    context.user_data['work_date'] = date_str_standard # Зберігаємо стандартизовану дату
-    await update.message.reply_text(
-        f"✅ Дату **{date_str_standard}** прийнято.\n"
-        "Введіть **час початку** роботи (формат: ГГ:ХХ, наприклад: 09:00):"
-    )
-    return GET_START_TIME
+class JobInterrupted(Exception):
+    """Важку задачу перервано дедлайном зупинки вже після запуску: її записи могли відбутися, тож оновлення не передається."""
 
-async def get_start_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    # ... (код get_start_time) ...
-    start_time_str = update.message.text.strip()
-    context.user_data['time_start'] = start_time_str
 
-    await update.message.reply_text(
-        f"✅ Початок **{start_time_str}** прийнято.\n"
-        "Введіть **час завершення** роботи (формат: ГГ:ХХ, наприклад: 18:30):"
-    )
-    return GET_END_TIME
+class TenantThrottled(Exception):
+    """Команда перевищила ліміт частоти важких задач; задачу не запущено."""
 
-async def get_end_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    # ... (код get_end_time) ...
-    end_time_str = update.message.text.strip()
-    context.user_data['time_end'] = end_time_str
 
-    # ТЕКСТ: Просимо ввести загальний час перерв
-    await update.message.reply_text(
-        f"✅ Закінчення **{end_time_str}** прийнято.\n"
-        "Введіть **загальну тривалість усіх перерв/обіду у хвилинах** (наприклад: 60, 90, або **0**, якщо перерви не було):"
-    )
-    return GET_LUNCH
+class TenantLimiter:
+    """
+    Ізоляція навантаження між командами:
+    - token bucket на кожну команду обмежує частоту важких задач (звичайні оновлення й відповіді
+      в діалогах не обмежуються); rate_limited=False вимикає його, коли всі чати ділять одну команду;
+    - семафор на команду + глобальний семафор обмежують одночасні важкі задачі (звіти),
+      тож велика команда займає не більше TENANT_MAX_CONCURRENT_JOBS із загальних слотів.
+    Під час зупинки (begin_drain) нові задачі й ті, що ще чекають на слот, відхиляються з ServiceDraining,
+    а ті, що виконуються, отримують час до дедлайну (після нього — JobInterrupted).
+    """
 
-async def get_lunch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    # ... (код get_lunch) ...
-    try:
+    def __init__(self, rate: float, burst: int, per_tenant_jobs: int, global_jobs: int, rate_limited: bool = True):
+        self.rate = rate
+        self.rate_limited = rate_limited
+        self.burst = burst
+        self.per_tenant_jobs = per_tenant_jobs
+        self.global_jobs = global_jobs
+        self._buckets = {} # team_id -> [токени, час останнього поповнення]
+        self._semaphores = {}
+        self._global_semaphore = None
+        self.throttled = {} # Загальна кількість відхилених задач на команду
+        self.streak = {} # Відкинуто поспіль (скидається після першого дозволеного)
+        self.drain_deadline = None
+        self._in_flight = set() # Задачі asyncio, що чекають на важку роботу
+
+    @property
+    def draining(self) -> bool:
+        return self.drain_deadline is not None
+
+    def ensure_accepting(self) -> None:
+        """Кидає ServiceDraining, якщо інстанс зупиняється. Обробники викликають перед першим записом у БД."""
+        if self.draining:
+            raise ServiceDraining()
+
+    def begin_drain(self, deadline_seconds: float) -> None:
+        """Перестає приймати нові задачі та перериває ті, що не завершаться за deadline_seconds."""
+        if self.draining:
+            return
+        self.drain_deadline = time.monotonic() + deadline_seconds
+        asyncio.get_running_loop().call_later(deadline_seconds, self._cancel_in_flight)
+
+    def _cancel_in_flight(self) -> None:
+        for task in list(self._in_flight):
+            task.cancel()
+
+    async def wait_idle(self) -> None:
+        """Чекає, поки завершаться (або будуть перервані) всі задачі."""
+        while self._in_flight:
+            await asyncio.sleep(0.05)
+
+    def allow(self, team_id: str) -> bool:
+        """Списує один токен команди; False, якщо ліміт частоти вичерпано."""
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(team_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets[team_id] = (tokens, now)
+            self.throttled[team_id] = self.throttled.get(team_id, 0) + 1
+            self.streak[team_id] = self.streak.get(team_id, 0) + 1
+            return False
+        self._buckets[team_id] = (tokens - 1, now)
+        self.streak[team_id] = 0
+        return True
+
+    async def run(self, team_id: str, func, *args, executor=None):
+        """
+        Виконує синхронну важку задачу в межах слотів команди та глобальних слотів:
+        у потоці за замовчуванням або в переданому executor (наприклад, пулі процесів).
+        Кидає TenantThrottled, якщо команда перевищила ліміт частоти важких задач.
+        """
+        self.ensure_accepting()
+        if self.rate_limited and not self.allow(team_id):
+            raise TenantThrottled()
+        if self._global_semaphore is None:
+            self._global_semaphore = asyncio.Semaphore(self.global_jobs)
+        semaphore = self._semaphores.setdefault(team_id, asyncio.Semaphore(self.per_tenant_jobs))
+        task = asyncio.current_task()
+        self._in_flight.add(task)
+        started = False
+        try:
+            async with semaphore:
+                async with self._global_semaphore:
+                    # Задачі, що чекали в черзі, після початку зупинки вже не запускаємо
+                    self.ensure_accepting()
+                    started = True
+                    if executor is not None:
+                        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+                    return await asyncio.to_thread(func, *args)
+        except asyncio.CancelledError:
+            if not self.draining:
+                raise
+            task.uncancel()
+            # Передати наступному інстансу можна лише задачу, що ще чекала на слот і нічого не записала
+            if started:
+                raise JobInterrupted() from None
+            raise ServiceDraining() from None
+        finally:
+            self._in_flight.discard(task)
+
+
+# Без MULTI_TENANT усі чати належать одній команді за замовчуванням — спільний ліміт частоти
+# гальмував би всіх, тому лишаються тільки семафори одночасних задач
+TENANT_LIMITER = TenantLimiter(TENANT_RATE_LIMIT, TENANT_RATE_BURST, TENANT_MAX_CONCURRENT_JOBS, GLOBAL_MAX_CONCURRENT_JOBS,
+                               rate_limited=MULTI_TENANT)
+
+
+# --- 2.4. АНАЛІТИКА: ПОТОКОВИЙ ЕКСПОРТ ТА ТИЖНЕВІ ПІДСУМКИ В SQL ---
+
+# Колонки експорту з типами, приведеними в БД (дата, час, десяткові з фіксованою точністю)
+EXPORT_COLUMNS = ['user_id', 'work_date', 'time_start', 'time_end', 'lunch_mins', 'net_hours', 'daily_pay']
+EXPORT_QUERY = '''
+    SELECT user_id,
+           work_date::date,
+           NULLIF(time_start, '-')::time,
+           NULLIF(time_end, '-')::time,
+           lunch_mins,
+           net_hours::numeric(6, 2),
+           daily_pay::numeric(10, 2)
+    FROM records
+    WHERE team_id = %s AND work_date BETWEEN %s AND %s AND (%s::text IS NULL OR user_id = %s)
+    ORDER BY user_id, work_date
+'''
+
+def export_parquet_schema():
+    """Схема Parquet, що відповідає EXPORT_QUERY."""
+    return pa.schema([
+        ('user_id', pa.string()),
+        ('work_date', pa.date32()),
+        ('time_start', pa.time64('us')),
+        ('time_end', pa.time64('us')),
+        ('lunch_mins', pa.int32()),
+        ('net_hours', pa.decimal128(6, 2)),
+        ('daily_pay', pa.decimal128(10, 2)),
+    ])
+
+def export_records(team_id: str, user_code: str | None, date_from: str, date_to: str, export_format: str):
+    """
+    Потоково вивантажує записи команди (або одного користувача) за діапазон у тимчасовий файл.
+    Рядки читаються серверним курсором пачками по EXPORT_BATCH_SIZE, тож пам'ять не росте з історією.
+    Повертає (шлях до файлу, кількість рядків) або (None, 0), якщо БД недоступна.
+    """
+    conn = get_db_connection()
+    if conn is None:
+        return None, 0
+
+    output = tempfile.NamedTemporaryFile(suffix=f".{export_format}", delete=False)
+    rows_written = 0
+    try:
+        cursor = conn.cursor(name='records_export')
+        cursor.itersize = EXPORT_BATCH_SIZE
+        cursor.execute(EXPORT_QUERY, (team_id, date_from, date_to, user_code, user_code))
+
+        if export_format == 'parquet':
+            schema = export_parquet_schema()
+            with pq.ParquetWriter(output, schema) as writer:
+                while True:
+                    batch = cursor.fetchmany(EXPORT_BATCH_SIZE)
+                    if not batch:
+                        break
+                    columns = list(zip(*batch))
+                    writer.write_table(pa.Table.from_arrays(
+                        [pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema
+                    ))
+                    rows_written += len(batch)
+        else:
+            with open(output.name, 'w', newline='', encoding='utf-8') as csv_file:
+                writer = csv.writer(csv_file)
+                writer.writerow(EXPORT_COLUMNS)
+                while True:
+                    batch = cursor.fetchmany(EXPORT_BATCH_SIZE)
+                    if not batch:
+                        break
+                    writer.writerows(batch)
+                    rows_written += len(batch)
+        conn.commit()
+    except Exception as e:
+        logger.error(f"Помилка експорту записів PostgreSQL: {e}")
+        conn.rollback()
+        output.close()
+        os.remove(output.name)
+        return None, 0
+    finally:
+        if conn:
+            conn.close()
+    output.close()
+    return output.name, rows_written
+
+def get_weekly_rollup(team_id: str, user_code: str | None, date_from: str, date_to: str, overtime_hours: float):
+    """
+    Тижневі підсумки, розраховані в БД: кількість змін, години, понаднормові понад overtime_hours,
+    середня тривалість зміни, наростаючий підсумок годин (віконна функція) та оплата.
+    Повертає лише агреговані рядки (по одному на користувача й тиждень).
+    """
+    conn = get_db_connection()
+    if conn is None:
+        return []
+
+    rows = []
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            WITH weeks AS (
+                SELECT user_id,
+                       date_trunc('week', work_date::date)::date AS week_start,
+                       COUNT(*) AS shifts,
+                       SUM(net_hours)::numeric AS hours,
+                       SUM(daily_pay)::numeric AS pay
+                FROM records
+                WHERE team_id = %s AND work_date BETWEEN %s AND %s AND time_start <> '-'
+                  AND (%s::text IS NULL OR user_id = %s)
+                GROUP BY user_id, week_start
+            )
+            SELECT user_id,
+                   week_start,
+                   shifts,
+                   ROUND(hours, 2),
+                   ROUND(GREATEST(hours - %s::numeric, 0), 2) AS overtime,
+                   ROUND(hours / shifts, 2) AS avg_shift,
+                   ROUND(SUM(hours) OVER (PARTITION BY user_id ORDER BY week_start), 2) AS running_hours,
+                   ROUND(pay, 2)
+            FROM weeks
+            ORDER BY user_id, week_start
+        ''', (team_id, date_from, date_to, user_code, user_code, overtime_hours))
+        rows = cursor.fetchall()
+    except Exception as e:
+        logger.error(f"Помилка розрахунку тижневих підсумків PostgreSQL: {e}")
+    finally:
+        if conn:
+            conn.close()
+    return rows
+
+
+# --- 2.5. ЛОКАЛЬНИЙ ЖУРНАЛ ЗАПИСІВ (WRITE-AHEAD SPOOL) ---
+# Поки БД недоступна, кожна зміна (збереження/видалення дня) дописується рядком JSON у SPOOL_PATH.
+# Рядок одразу записується в ОС (переживає падіння процесу), а fsync виконується пакетно —
+# не рідше ніж раз на SPOOL_FSYNC_INTERVAL. Після відновлення БД журнал відтворюється по порядку;
+# кожна операція має op_id, тож повторне відтворення (наприклад, після падіння) нічого не дублює.
+
+SAVE_STORED = "stored"
+SAVE_QUEUED = "queued"
+SAVE_FAILED = "failed"
+DELETE_QUEUED = -1 # Результат delete_record, коли видалення чекає в журналі
+
+
+class WriteAheadSpool:
+    """Append-only журнал операцій у файлі JSON Lines з пакетним fsync."""
+
+    def __init__(self, path: str, fsync_interval: float):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._file = None
+        self._last_fsync = 0.0
+        self._unsynced = False
+        self._pending = None # Кількість операцій у файлі (рахується ліниво)
+
+    def _open(self):
+        if self._file is None:
+            if os.path.exists(self.path):
+                self._truncate_torn_tail_locked()
+            self._file = open(self.path, 'a', encoding='utf-8')
+        return self._file
+
+    def _truncate_torn_tail_locked(self) -> None:
+        """Відкидає недописаний останній рядок (процес упав посеред запису), щоб нові операції не склеїлись з ним."""
+        with open(self.path, 'rb+') as spool_file:
+            size = spool_file.seek(0, os.SEEK_END)
+            if size == 0:
+                return
+            spool_file.seek(size - 1)
+            if spool_file.read(1) == b"\n":
+                return
+            spool_file.seek(0)
+            keep = spool_file.read().rfind(b"\n") + 1
+            spool_file.truncate(keep)
+            spool_file.flush()
+            os.fsync(spool_file.fileno())
+        logger.error(f"[SPOOL] Відкинуто недописаний останній рядок журналу {self.path} ({size - keep} байт).")
+
+    def _entries_locked(self) -> list:
+        """Пари (рядок, операція) по порядку. Пошкоджені рядки пропускаються з записом у лог."""
+        if not os.path.exists(self.path):
+            return []
+        self._truncate_torn_tail_locked()
+        entries = []
+        with open(self.path, encoding='utf-8', errors='replace') as spool_file:
+            for line in spool_file:
+                if not line.strip():
+                    continue
+                try:
+                    entries.append((line, json.loads(line)))
+                except json.JSONDecodeError:
+                    logger.error(f"[SPOOL] Пропущено пошкоджений рядок журналу {self.path}: {line[:200]!r}")
+        return entries
+
+    def append(self, op: dict) -> None:
+        """Дописує операцію в кінець журналу."""
+        line = json.dumps(op, ensure_ascii=False) + "\n"
+        with self._lock:
+            spool_file = self._open()
+            spool_file.write(line)
+            spool_file.flush()
+            self._unsynced = True
+            self._pending = self._count_locked() if self._pending is None else self._pending + 1
+            if time.monotonic() - self._last_fsync >= self.fsync_interval:
+                self._fsync_locked()
+
+    def sync(self) -> None:
+        """Примусовий fsync усього, що записано після попереднього fsync."""
+        with self._lock:
+            self._fsync_locked()
+
+    def _fsync_locked(self) -> None:
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = False
+        self._last_fsync = time.monotonic()
+
+    def _count_locked(self) -> int:
+        return len(self._entries_locked())
+
+    def pending(self) -> int:
+        """Кількість операцій, що очікують на відтворення."""
+        with self._lock:
+            if self._pending is None:
+                self._pending = self._count_locked()
+            return self._pending
+
+    def read(self) -> list:
+        """Читає всі операції журналу по порядку."""
+        with self._lock:
+            return [op for _, op in self._entries_locked()]
+
+    def drop_applied(self, applied: int) -> None:
+        """Атомарно прибирає з початку журналу перші applied операцій (через тимчасовий файл і os.replace)."""
+        with self._lock:
+            self._fsync_locked()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            remaining = [line for line, _ in self._entries_locked()][applied:]
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as tmp_file:
+                tmp_file.writelines(remaining)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.replace(tmp_path, self.path)
+            self._pending = len(remaining)
+
+
+WRITE_SPOOL = WriteAheadSpool(SPOOL_PATH, SPOOL_FSYNC_INTERVAL)
+_spool_replay_lock = threading.Lock()
+
+def spool_has_pending() -> bool:
+    """True, якщо в журналі є операції, ще не застосовані до БД."""
+    return WRITE_SPOOL.pending() > 0
+
+def spooled_record_state(team_id: str, user_code: str, date_str: str):
+    """
+    Стан запису після відтворення журналу: True — останньою операцією для дати є збереження,
+    False — видалення, None — журнал цієї дати не торкається (відповідає БД).
+    """
+    if not spool_has_pending():
+        return None
+    state = None
+    for op in WRITE_SPOOL.read():
+        if op['team_id'] == team_id and op['user_code'] == user_code and op['work_date'] == date_str:
+            state = op['op'] == 'save'
+    return state
+
+def spool_blocks_write(action: str) -> bool:
+    """
+    True, якщо в журналі ще є операції: зміна, виконана напряму в БД, обігнала б їх
+    (наприклад, збереження з черги повернуло б день, видалений /vidr). Такі зміни відхиляються.
+    """
+    if not spool_has_pending():
+        return False
+    logger.warning(f"[SPOOL] Відхилено ({action}): у журналі ще {WRITE_SPOOL.pending()} операцій.")
+    return True
+
+def queue_mutation(op: dict) -> str:
+    """
+    Ставить операцію в локальний журнал. Повертає SAVE_QUEUED або SAVE_FAILED, якщо запис у файл не вдався
+    або журнал не лежить на постійному томі (тоді обіцяти користувачу перенесення після деплою не можна).
+    """
+    if not SPOOL_ON_VOLUME:
+        logger.error(f"[SPOOL] Журнал вимкнено (SPOOL_PATH не задано, том Railway не підключено): операцію {op['op']} не збережено.")
+        return SAVE_FAILED
+    op = dict(op, op_id=uuid.uuid4().hex, queued_at=datetime.now().isoformat(timespec='seconds'))
+    try:
+        WRITE_SPOOL.append(op)
+    except OSError as e:
+        logger.error(f"Не вдалося записати операцію в локальний журнал {SPOOL_PATH}: {e}")
+        return SAVE_FAILED
+    logger.warning(f"[SPOOL] БД недоступна, операцію {op['op']} {op['team_id']}/{op['user_code']} {op['work_date']} поставлено в чергу.")
+    return SAVE_QUEUED
+
+def apply_spooled_op(cursor, op: dict) -> bool:
+    """Застосовує одну операцію журналу в поточній транзакції. False, якщо її вже було застосовано."""
+    cursor.execute('INSERT INTO applied_ops (op_id) VALUES (%s) ON CONFLICT (op_id) DO NOTHING', (op['op_id'],))
+    if cursor.rowcount == 0:
+        return False
+
+    if op['op'] == 'save':
+        # Запис за цю дату міг з'явитися, поки операція чекала — дублікат не створюємо
+        cursor.execute('''
+            INSERT INTO records
+            (team_id, user_id, work_date, time_start, time_end, lunch_mins, net_hours, daily_pay)
+            SELECT %s, %s, %s, %s, %s, %s, %s, %s
+            WHERE NOT EXISTS (
+                SELECT 1 FROM records WHERE team_id = %s AND user_id = %s AND work_date = %s
+            )
+        ''', (op['team_id'], op['user_code'], op['work_date'], op['time_start'], op['time_end'],
+              op['lunch_mins'], op['net_hours'], op['daily_pay'],
+              op['team_id'], op['user_code'], op['work_date']))
+        if cursor.rowcount == 0:
+            logger.warning(f"[SPOOL] Запис {op['team_id']}/{op['user_code']} {op['work_date']} вже існує, операцію {op['op_id']} пропущено.")
+    elif op['op'] == 'delete':
+        delete_query = '''
+            DELETE FROM records
+            WHERE team_id = %s AND user_id = %s AND work_date = %s
+        '''
+        params = (op['team_id'], op['user_code'], op['work_date'])
+        # Операції, записані до появи журналу аудиту, не мають поля 'audit'
+        if op.get('audit'):
+            cursor.execute(audited_delete(delete_query), params + audit_params(op['audit']))
+        else:
+            cursor.execute(delete_query, params)
+    return True
+
+def replay_spool(deadline: float | None = None) -> int:
+    """
+    Відтворює журнал по порядку, кожну операцію — окремою транзакцією. Зупиняється на першій
+    помилці, щоб не порушити порядок, а також після моменту deadline (time.monotonic()), якщо його задано.
+    Повертає кількість застосованих операцій.
+    """
+    with _spool_replay_lock:
+        try:
+            ops = WRITE_SPOOL.read()
+        except OSError as e:
+            logger.error(f"Не вдалося прочитати локальний журнал {SPOOL_PATH}: {e}")
+            return 0
+        if not ops:
+            return 0
+
+        conn = get_db_connection()
+        if conn is None:
+            return 0
+
+        done = 0
+        applied = 0
+        try:
+            cursor = conn.cursor()
+            for op in ops:
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+                if apply_spooled_op(cursor, op):
+                    applied += 1
+                conn.commit()
+                hot_index_invalidate(op['team_id'], op['user_code'], op['work_date'], op['work_date'])
+                done += 1
+        except Exception as e:
+            logger.error(f"Помилка відтворення локального журналу PostgreSQL: {e}")
+            conn.rollback()
+            if isinstance(e, psycopg2.OperationalError):
+                record_db_failure()
+        finally:
+            if conn:
+                conn.close()
+
+        if done:
+            WRITE_SPOOL.drop_applied(done)
+            logger.info(f"[SPOOL] Відтворено операцій: {done} (нових: {applied}), залишилось: {WRITE_SPOOL.pending()}.")
+        return applied
+
+async def spool_worker() -> None:
+    """Фонова задача: пакетний fsync журналу та відтворення після відновлення БД."""
+    last_replay = 0.0
+    while True:
+        await asyncio.sleep(SPOOL_FSYNC_INTERVAL)
+        # Помилка одного проходу не повинна зупиняти задачу назавжди: інакше журнал ніколи не відтвориться
+        try:
+            WRITE_SPOOL.sync()
+            if time.monotonic() - last_replay < SPOOL_REPLAY_INTERVAL:
+                continue
+            last_replay = time.monotonic()
+            if spool_has_pending() and not db_breaker_open():
+                await asyncio.to_thread(replay_spool)
+        except Exception as e:
+            logger.error(f"[SPOOL] Помилка фонової задачі журналу: {e}")
+
+
+# --- 2.6. ВІДКЛАДЕНІ ОНОВЛЕННЯ (ПЕРЕДАЧА МІЖ ІНСТАНСАМИ ПІД ЧАС ПЕРЕЗАПУСКУ) ---
+# Наступному інстансу передається лише оновлення, обробник якого ще нічого не записав:
+# - ServiceDraining кидається тільки до запису — TenantLimiter.run перевіряє зупинку до запуску задачі,
+#   а обробник, що пише сам до важкої задачі, викликає TENANT_LIMITER.ensure_accepting() перед записом;
+# - задача, перервана дедлайном уже після запуску, завершується JobInterrupted і не передається;
+# - після зафіксованого запису важка робота йде через reprice_after_commit, яка не передає відмову
+#   обмежувача обробнику помилок.
+# Крім того, такі обробники ідемпотентні (/pravylo — upsert, /svyato on|off), тож навіть повтор безпечний.
+
+def save_pending_update(payload: str) -> bool:
+    """Зберігає оновлення Telegram (JSON), яке цей інстанс не встиг обробити до зупинки."""
+    conn = get_db_connection()
+    if conn is None:
+        return False
+
+    saved = False
+    try:
+        cursor = conn.cursor()
+        cursor.execute('INSERT INTO pending_updates (payload) VALUES (%s)', (payload,))
+        conn.commit()
+        saved = True
+    except Exception as e:
+        logger.error(f"Помилка збереження відкладеного оновлення PostgreSQL: {e}")
+        conn.rollback()
+    finally:
+        if conn:
+            conn.close()
+    return saved
+
+def claim_pending_updates(limit: int = 100) -> list:
+    """
+    Забирає відкладені оновлення по порядку надходження. SKIP LOCKED дозволяє кільком
+    інстансам забирати одночасно, не отримуючи одне оновлення двічі.
+    """
+    conn = get_db_connection()
+    if conn is None:
+        return []
+
+    payloads = []
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            DELETE FROM pending_updates
+            WHERE id IN (
+                SELECT id FROM pending_updates
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, payload
+        ''', (limit,))
+        payloads = [payload for _, payload in sorted(cursor.fetchall())]
+        conn.commit()
+    except Exception as e:
+        logger.error(f"Помилка отримання відкладених оновлень PostgreSQL: {e}")
+        conn.rollback()
+    finally:
+        if conn:
+            conn.close()
+    return payloads
+
+async def pending_updates_worker(application: Application) -> None:
+    """Фонова задача: передає в чергу обробки оновлення, відкладені попереднім інстансом."""
+    while not TENANT_LIMITER.draining:
+        if not db_breaker_open():
+            for payload in await asyncio.to_thread(claim_pending_updates):
+                update = Update.de_json(json.loads(payload), application.bot)
+                logger.info(f"[LIFECYCLE] Продовжуємо відкладене оновлення {update.update_id}.")
+                await application.update_queue.put(update)
+        await asyncio.sleep(PENDING_UPDATES_INTERVAL)
+
+
+# --- 2.7. ЖУРНАЛ АУДИТУ ВИДАЛЕНЬ І МАСОВИХ ЗМІН ---
+# Кожна деструктивна операція має партію (batch_id). Видалені рядки записуються до audit_log
+# тим самим SQL-запитом, що їх видаляє (DELETE ... RETURNING у CTE): додаткового звернення до БД
+# немає, рядки не проходять через Python, а видалення і запис аудиту — одна транзакція.
+# Масові зміни (/red, /obid, /pvih) так само записують до audit_log стан рядків до зміни
+# в транзакції, що їх змінює; /vidnov повертає цей стан.
+
+AUDIT_DELETE_DAY = "delete_day"
+AUDIT_DELETE_RANGE = "delete_range"
+AUDIT_DELETE_USER = "delete_user"
+AUDIT_EDIT_RANGE = "edit_range"
+AUDIT_LUNCH_RANGE = "lunch_range"
+AUDIT_MOVE_HOLIDAY = "move_holiday"
+AUDIT_RESTORE = "restore"
+AUDIT_UPDATE_ACTIONS = (AUDIT_EDIT_RANGE, AUDIT_LUNCH_RANGE, AUDIT_MOVE_HOLIDAY) # Партії, що зберігають стан до зміни
+
+AUDIT_INSERT_DELETED = '''
+    INSERT INTO audit_log (batch_id, team_id, action, actor_chat_id, actor_user_id, record)
+    SELECT %s, team_id, %s, %s, %s, to_jsonb(deleted) FROM deleted
+'''
+
+# Стан рядків до масової зміни (рядки вже заблоковані SELECT ... FOR UPDATE тієї ж транзакції)
+AUDIT_INSERT_SNAPSHOT = '''
+    INSERT INTO audit_log (batch_id, team_id, action, actor_chat_id, actor_user_id, record)
+    SELECT %s, team_id, %s, %s, %s, to_jsonb(records) FROM records WHERE id = ANY(%s)
+'''
+
+AUDIT_INSERT_MOVED = '''
+    INSERT INTO audit_log (batch_id, team_id, action, actor_chat_id, actor_user_id, record)
+    SELECT %s, team_id, %s, %s, %s, to_jsonb(moved) FROM moved
+'''
+
+# Відновлення видалених рядків: дні, на які вже з'явився новий запис, пропускаються
+RESTORE_DELETED = '''
+    INSERT INTO records
+    (id, team_id, user_id, work_date, time_start, time_end, lunch_mins, net_hours, daily_pay)
+    SELECT r.id, r.team_id, r.user_id, r.work_date, r.time_start, r.time_end,
+           r.lunch_mins, r.net_hours, r.daily_pay
+    FROM audit_log AS a, jsonb_populate_record(NULL::records, a.record) AS r
+    WHERE a.team_id = %s AND a.batch_id = %s AND a.action <> %s
+      AND NOT EXISTS (
+          SELECT 1 FROM records
+          WHERE team_id = r.team_id AND user_id = r.user_id AND work_date = r.work_date
+      )
+    ON CONFLICT (id) DO NOTHING
+    RETURNING *
+'''
+
+# Повернення стану до масової зміни: пропускаються рядки, яких уже немає, і дати, зайняті іншим записом
+RESTORE_UPDATED = '''
+    UPDATE records AS t
+    SET work_date = r.work_date, time_start = r.time_start, time_end = r.time_end,
+        lunch_mins = r.lunch_mins, net_hours = r.net_hours, daily_pay = r.daily_pay
+    FROM audit_log AS a, jsonb_populate_record(NULL::records, a.record) AS r
+    WHERE a.team_id = %s AND a.batch_id = %s AND a.action <> %s
+      AND t.id = r.id AND t.team_id = r.team_id
+      AND NOT EXISTS (
+          SELECT 1 FROM records AS o
+          WHERE o.team_id = r.team_id AND o.user_id = r.user_id AND o.work_date = r.work_date AND o.id <> r.id
+      )
+    RETURNING t.*
+'''
+
+def new_audit_batch(update: Update, action: str) -> dict:
+    """Нова партія аудиту: хто (чат і користувач Telegram) виконує дію."""
+    return {
+        'batch_id': uuid.uuid4().hex[:12],
+        'action': action,
+        'chat_id': update.effective_chat.id if update.effective_chat else None,
+        'user_id': update.effective_user.id if update.effective_user else None,
+    }
+
+def audited_delete(delete_query: str) -> str:
+    """Обгортає DELETE так, що видалені рядки потрапляють до audit_log; rowcount — кількість видалених рядків."""
+    return f"WITH deleted AS ({delete_query} RETURNING *) {AUDIT_INSERT_DELETED}"
+
+def audit_params(audit: dict) -> tuple:
+    """Параметри для AUDIT_INSERT_DELETED."""
+    return (audit['batch_id'], audit['action'], audit['chat_id'], audit['user_id'])
+
+def restore_audit_batch(team_id: str, batch_id: str, audit: dict):
+    """
+    Відновлює записи партії одним запитом з audit_log і фіксує подію відновлення: видалені рядки
+    вставляються знову (RESTORE_DELETED), змінені масовою операцією — повертаються до попереднього
+    стану (RESTORE_UPDATED). Повертає словник {status, action, restored, skipped, users}
+    (status: 'ok', 'not_found', 'already') або None при помилці БД.
+    """
+    if spool_blocks_write("відновлення партії"):
+        return None
+    conn = get_db_connection()
+    if conn is None:
+        return None
+
+    result = None
+    try:
+        cursor = conn.cursor()
+        # Два одночасні /vidnov однієї партії не відновлять її двічі
+        cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', (f"{team_id}/{batch_id}",))
+        cursor.execute('''
+            SELECT count(*), min(action),
+                   EXISTS (SELECT 1 FROM audit_log WHERE team_id = %s AND undo_of = %s)
+            FROM audit_log WHERE team_id = %s AND batch_id = %s AND action <> %s
+        ''', (team_id, batch_id, team_id, batch_id, AUDIT_RESTORE))
+        total, action, already_restored = cursor.fetchone()
+        if total == 0:
+            result = {'status': 'not_found', 'action': None, 'restored': 0, 'skipped': 0, 'users': set()}
+        elif already_restored:
+            result = {'status': 'already', 'action': action, 'restored': 0, 'skipped': 0, 'users': set()}
+        else:
+            restore_query = RESTORE_UPDATED if action in AUDIT_UPDATE_ACTIONS else RESTORE_DELETED
+            cursor.execute(f'''
+                WITH restored AS ({restore_query})
+                INSERT INTO audit_log (batch_id, team_id, action, actor_chat_id, actor_user_id, record, undo_of)
+                SELECT %s, team_id, %s, %s, %s, to_jsonb(restored), %s FROM restored
+                RETURNING record->>'user_id'
+            ''', (team_id, batch_id, AUDIT_RESTORE) + audit_params(audit) + (batch_id,))
+            users = {row[0] for row in cursor.fetchall()}
+            restored = cursor.rowcount
+            result = {'status': 'ok', 'action': action, 'restored': restored, 'skipped': total - restored, 'users': users}
+        conn.commit()
+        for user_code in result['users']:
+            hot_index_invalidate(team_id, user_code)
+    except Exception as e:
+        logger.error(f"Помилка відновлення партії {batch_id} PostgreSQL: {e}")
+        conn.rollback()
+        result = None
+    finally:
+        if conn:
+            conn.close()
+    return result
+
+def get_audit_batches(team_id: str, limit: int):
+    """Останні партії журналу аудиту команди: (партія, дія, чат, користувач, час, рядків, код, від, до, відновлено)."""
+    conn = get_db_connection()
+    if conn is None:
+        return []
+
+    rows = []
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT a.batch_id, a.action, a.actor_chat_id, a.actor_user_id, min(a.logged_at), count(*),
+                   min(a.record->>'user_id'), min(a.record->>'work_date'), max(a.record->>'work_date'),
+                   EXISTS (SELECT 1 FROM audit_log AS u WHERE u.team_id = a.team_id AND u.undo_of = a.batch_id)
+            FROM audit_log AS a
+            WHERE a.team_id = %s
+            GROUP BY a.team_id, a.batch_id, a.action, a.actor_chat_id, a.actor_user_id
+            ORDER BY min(a.id) DESC
+            LIMIT %s
+        ''', (team_id, limit))
+        rows = cursor.fetchall()
+    except Exception as e:
+        logger.error(f"Помилка читання журналу аудиту PostgreSQL: {e}")
+    finally:
+        if conn:
+            conn.close()
+    return rows
+
+
+# --- 2.8. ПРАВИЛА ОПЛАТИ ---
+# Правило діє з valid_from до наступного правила того самого адресата: конкретного користувача
+# або всієї команди (PAY_RULE_ALL_USERS). Правило користувача має пріоритет над правилом команди,
+# а без жодного правила діє ставка команди з /stavka. Оплата дня:
+#   ставка × множник дня (свято або вихідний) × години, де години понад кожен поріг
+#   понаднормових рахуються з множником цього порогу.
+# Правила та свята команди компілюються в PayRuleIndex (відсортовані дати початку + bisect) і
+# кешуються до зміни. Після зміни правил daily_pay перераховується в БД, тож звіти й надалі
+# підсумовують збережену оплату одним запитом, не звертаючись до правил для кожного рядка.
+
+PAY_RULE_ALL_USERS = "*"
+REPRICE_OPEN_END = "9999-12-31" # Кінець діапазону перерахунку для правил, що діють «відтепер»
+
+class PayRuleIndex:
+    """Скомпільовані правила оплати однієї команди: визначення ставки для дати за O(log n)."""
+
+    def __init__(self, base_rate: float, rules: list, holidays: set):
+        self.base_rule = {'user_code': PAY_RULE_ALL_USERS, 'valid_from': '', 'hourly_rate': base_rate,
+                          'weekend_multiplier': 1.0, 'holiday_multiplier': 1.0, 'overtime_tiers': []}
+        self.rules = sorted(rules, key=lambda rule: (rule['user_code'], rule['valid_from']))
+        self.holidays = holidays
+        self._timelines = {}
+        for rule in self.rules:
+            starts, timeline = self._timelines.setdefault(rule['user_code'], ([], []))
+            starts.append(rule['valid_from'])
+            timeline.append(rule)
+
+    def _lookup(self, user_code: str, date_str: str):
+        starts, timeline = self._timelines.get(user_code, ((), ()))
+        position = bisect.bisect_right(starts, date_str)
+        return timeline[position - 1] if position else None
+
+    def resolve(self, user_code: str, date_str: str) -> dict:
+        """Правило, що діє для користувача на дату."""
+        return (self._lookup(user_code, date_str)
+                or self._lookup(PAY_RULE_ALL_USERS, date_str)
+                or self.base_rule)
+
+    def day_multiplier(self, rule: dict, date_str: str) -> float:
+        """Множник дня: свято команди, субота/неділя або звичайний день."""
+        if date_str in self.holidays:
+            return rule['holiday_multiplier']
+        if date.fromisoformat(date_str).weekday() >= 5:
+            return rule['weekend_multiplier']
+        return 1.0
+
+    def price(self, user_code: str, date_str: str, net_hours: float) -> float:
+        """Оплата за день з урахуванням ставки, множника дня та порогів понаднормових."""
+        if not net_hours:
+            return 0.0
+        rule = self.resolve(user_code, date_str)
+        weighted_hours, previous_multiplier = net_hours, 1.0
+        for threshold, multiplier in rule['overtime_tiers']:
+            if net_hours > threshold:
+                weighted_hours += (net_hours - threshold) * (multiplier - previous_multiplier)
+            previous_multiplier = multiplier
+        return round(rule['hourly_rate'] * self.day_multiplier(rule, date_str) * weighted_hours, 2)
+
+
+_pay_rules_cache = {}
+_pay_rules_cache_lock = threading.Lock()
+
+def load_pay_rules(team_id: str):
+    """Завантажує правила та свята команди й компілює їх. Повертає None, якщо БД недоступна."""
+    base_rate = get_tenant(team_id)['pay_rate']
+    conn = get_db_connection()
+    if conn is None:
+        return None
+
+    index = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT user_code, valid_from, hourly_rate, weekend_multiplier, holiday_multiplier, overtime_tiers
+            FROM pay_rules
+            WHERE team_id = %s
+        ''', (team_id,))
+        rules = [
+            {'user_code': user_code, 'valid_from': valid_from, 'hourly_rate': hourly_rate,
+             'weekend_multiplier': weekend_multiplier, 'holiday_multiplier': holiday_multiplier,
+             'overtime_tiers': sorted(tuple(tier) for tier in overtime_tiers)}
+            for user_code, valid_from, hourly_rate, weekend_multiplier, holiday_multiplier, overtime_tiers
+            in cursor.fetchall()
+        ]
+        cursor.execute('SELECT holiday_date FROM pay_holidays WHERE team_id = %s', (team_id,))
+        holidays = {row[0] for row in cursor.fetchall()}
+        index = PayRuleIndex(base_rate, rules, holidays)
+    except Exception as e:
+        logger.error(f"Помилка завантаження правил оплати PostgreSQL: {e}")
+    finally:
+        if conn:
+            conn.close()
+    return index
+
+def get_pay_rules(team_id: str) -> PayRuleIndex:
+    """Повертає скомпільовані правила команди з кешу; поки БД недоступна — лише ставку команди."""
+    with _pay_rules_cache_lock:
+        index = _pay_rules_cache.get(team_id)
+    if index is not None:
+        return index
+
+    index = load_pay_rules(team_id)
+    if index is None:
+        return PayRuleIndex(get_tenant(team_id)['pay_rate'], [], set())
+    with _pay_rules_cache_lock:
+        _pay_rules_cache[team_id] = index
+    return index
+
+def invalidate_pay_rules(team_id: str) -> None:
+    """Скидає скомпільовані правила команди після зміни правил, свят або ставки."""
+    with _pay_rules_cache_lock:
+        _pay_rules_cache.pop(team_id, None)
+
+def set_pay_rule(team_id: str, user_code: str, valid_from: str, hourly_rate: float, weekend_multiplier: float,
+                 holiday_multiplier: float, overtime_tiers: list) -> int:
+    """Додає правило оплати або замінює правило того самого адресата з тією самою датою."""
+    return execute_tenant_statement(team_id, '''
+        INSERT INTO pay_rules
+        (team_id, user_code, valid_from, hourly_rate, weekend_multiplier, holiday_multiplier, overtime_tiers)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (team_id, user_code, valid_from) DO UPDATE
+        SET hourly_rate = EXCLUDED.hourly_rate,
+            weekend_multiplier = EXCLUDED.weekend_multiplier,
+            holiday_multiplier = EXCLUDED.holiday_multiplier,
+            overtime_tiers = EXCLUDED.overtime_tiers
+    ''', (team_id, user_code, valid_from, hourly_rate, weekend_multiplier, holiday_multiplier,
+          json.dumps(overtime_tiers)))
+
+def set_pay_holiday(team_id: str, holiday_date: str, is_holiday: bool):
+    """
+    Робить день святковим (is_holiday=True) або звичайним. Операція ідемпотентна: повтор команди
+    (або її повторне виконання іншим інстансом) дає той самий стан.
+    True — стан змінено, False — день уже був у цьому стані, None — помилка.
+    """
+    conn = get_db_connection()
+    if conn is None:
+        return None
+
+    changed = None
+    try:
+        cursor = conn.cursor()
+        if is_holiday:
+            cursor.execute('''
+                INSERT INTO pay_holidays (team_id, holiday_date) VALUES (%s, %s)
+                ON CONFLICT DO NOTHING
+            ''', (team_id, holiday_date))
+        else:
+            cursor.execute('DELETE FROM pay_holidays WHERE team_id = %s AND holiday_date = %s', (team_id, holiday_date))
+        changed = cursor.rowcount == 1
+        conn.commit()
+    except Exception as e:
+        logger.error(f"Помилка зміни святкових днів PostgreSQL: {e}")
+        conn.rollback()
+    finally:
+        if conn:
+            conn.close()
+    invalidate_pay_rules(team_id)
+    return changed
+
+def reprice_records(team_id: str, user_code: str | None, date_from: str, date_to: str, dry_run: bool = False) -> int | None:
+    """
+    Перераховує daily_pay записів команди (або одного користувача) за діапазон за чинними правилами.
+    Записи читаються серверним курсором пачками по PAY_RECOMPUTE_BATCH_SIZE; змінена оплата кожної
+    пачки записується одним UPDATE ... FROM (VALUES ...) і фіксується окремо, тож довгий перерахунок
+    не тримає блокування всієї історії. Повертає кількість записів, оплата яких змінилась (або змінилася б),
+    або None, якщо перерахунок не виконано (записи пачок, зафіксованих до помилки, лишаються перерахованими).
+    """
+    if not dry_run and spool_blocks_write("перерахунок оплати"):
+        return None
+    pay_rules = get_pay_rules(team_id)
+    conn = get_db_connection()
+    if conn is None:
+        return None
+
+    repriced = 0
+    users = set()
+    try:
+        read_cursor = conn.cursor(name='records_reprice', withhold=True)
+        read_cursor.itersize = PAY_RECOMPUTE_BATCH_SIZE
+        read_cursor.execute('''
+            SELECT id, user_id, work_date, net_hours, daily_pay
+            FROM records
+            WHERE team_id = %s AND work_date BETWEEN %s AND %s AND (%s::text IS NULL OR user_id = %s)
+            ORDER BY id
+        ''', (team_id, date_from, date_to, user_code, user_code))
+        write_cursor = conn.cursor()
+        while True:
+            batch = read_cursor.fetchmany(PAY_RECOMPUTE_BATCH_SIZE)
+            if not batch:
+                break
+            changed = []
+            for record_id, record_user, work_date, net_hours, daily_pay in batch:
+                pay = pay_rules.price(record_user, work_date, net_hours)
+                if daily_pay is None or abs(pay - daily_pay) >= 0.005:
+                    changed.append((record_id, net_hours, pay))
+                    users.add(record_user)
+            if changed and not dry_run:
+                # Рядок, змінений після читання пачки (інші години), не перезаписується застарілою оплатою
+                execute_values(write_cursor, '''
+                    UPDATE records AS r SET daily_pay = v.pay
+                    FROM (VALUES %s) AS v (id, net_hours, pay)
+                    WHERE r.id = v.id AND r.net_hours = v.net_hours
+                ''', changed, template='(%s::integer, %s::real, %s::real)', page_size=PAY_RECOMPUTE_BATCH_SIZE)
+                # Пачка вміщується в одну сторінку execute_values, тож rowcount — точна кількість оновлених рядків
+                repriced += write_cursor.rowcount
+                conn.commit()
+            elif changed:
+                repriced += len(changed)
+        read_cursor.close()
+        conn.commit()
+    except Exception as e:
+        logger.error(f"Помилка перерахунку оплати PostgreSQL: {e}")
+        conn.rollback()
+        repriced = None
+    finally:
+        if conn:
+            conn.close()
+    if not dry_run:
+        for record_user in users:
+            hot_index_invalidate(team_id, record_user, date_from, date_to)
+    return repriced
+
+
+# --- 3. ЛОГІКА РОЗРАХУНКУ ЧАСУ ---
+
+def calculate_work_data(date_str, start_time_str, end_time_str, lunch_minutes, pay_rate=PAY_RATE):
+    """
+    Розраховує чистий робочий час та оплату за день.
+    """
+    try:
+        start_dt = datetime.strptime(f"{date_str} {start_time_str}", "%Y-%m-%d %H:%M")
+        end_dt = datetime.strptime(f"{date_str} {end_time_str}", "%Y-%m-%d %H:%M")
+
+        total_duration_minutes = (end_dt - start_dt).total_seconds() / 60
+        
+        # Віднімаємо лише загальний час, вказаний користувачем
+        total_deduction_minutes = lunch_minutes 
+        net_minutes = total_duration_minutes - total_deduction_minutes
+
+        if net_minutes < 0:
+            return None, None, "Помилка: Загальний час перерви перевищує тривалість зміни. Перевірте дані."
+
+        net_hours = round(net_minutes / 60, 2)
+        daily_pay = round(net_hours * pay_rate, 2)
+
+        return net_hours, daily_pay, None
+
+    except ValueError:
+        return None, None, "Помилка формату: Переконайтеся, що час введено як ГГ:ХХ (наприклад, 09:00), а дата як РРРР-ММ-ДД."
+    except Exception as e:
+        logger.error(f"Непередбачена помилка: {e}")
+        return None, None, f"Непередбачена помилка: {e}"
+
+def standardize_date(date_str: str) -> str:
+    """Перетворює '2025-10-1' на '2025-10-01'. Кидає ValueError для некоректної дати."""
+    return datetime.strptime(date_str.strip(), "%Y-%m-%d").strftime("%Y-%m-%d")
+
+def parse_range_args(args: list):
+    """
+    Розбирає аргументи діапазонних команд: <від> <до> [інші аргументи] [?].
+    Повертає (date_from, date_to, rest, dry_run). Кидає ValueError при невірному форматі.
+    """
+    args = list(args or [])
+    dry_run = bool(args) and args[-1] == DRY_RUN_ARG
+    if dry_run:
+        args.pop()
+    if len(args) < 2:
+        raise ValueError("Потрібні дві дати")
+
+    date_from = standardize_date(args[0])
+    date_to = standardize_date(args[1])
+    if date_from > date_to:
+        raise ValueError("Початкова дата пізніша за кінцеву")
+    return date_from, date_to, args[2:], dry_run
+
+
+# --- 3.1. ГРАФІКИ (ПУЛ ПРОЦЕСІВ + КЕШ FILE_ID) ---
+
+_render_pool = None
+_chart_cache = OrderedDict() # (команда, користувач, рік) -> (версія даних, file_id Telegram)
+
+def get_render_pool() -> ProcessPoolExecutor:
+    """Ліниво створює пул процесів для малювання (spawn — безпечно для процесу з потоками)."""
+    global _render_pool
+    if _render_pool is None:
+        _render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _render_pool
+
+def shutdown_render_pool() -> None:
+    """Зупиняє пул процесів малювання (при завершенні роботи бота)."""
+    global _render_pool
+    if _render_pool is not None:
+        _render_pool.shutdown(wait=False, cancel_futures=True)
+        _render_pool = None
+
+def chart_data_version(daily_totals: list) -> str:
+    """Версія даних графіка — хеш агрегованих рядків: змінюється лише тоді, коли змінюється картинка."""
+    return hashlib.sha1(repr(daily_totals).encode('utf-8')).hexdigest()
+
+def get_cached_chart(key: tuple, version: str):
+    """Повертає file_id раніше надісланого графіка, якщо дані не змінились."""
+    cached = _chart_cache.get(key)
+    if cached is None or cached[0] != version:
+        return None
+    _chart_cache.move_to_end(key)
+    return cached[1]
+
+def store_cached_chart(key: tuple, version: str, file_id: str) -> None:
+    """Запам'ятовує file_id графіка, витісняючи найдавніші записи."""
+    _chart_cache[key] = (version, file_id)
+    _chart_cache.move_to_end(key)
+    while len(_chart_cache) > CHART_CACHE_MAX_ENTRIES:
+        _chart_cache.popitem(last=False)
+
+def render_year_chart(year: str, title: str, daily_totals: list, currency: str) -> bytes:
+    """
+    Малює PNG: календарна теплова карта відпрацьованих днів (тижні × дні тижня) та
+    стовпчики годин і оплати по місяцях. Виконується у воркері пулу процесів.
+    """
+    import matplotlib.pyplot as plt
+    import numpy as np
+    from datetime import date as date_cls
+
+    # Колонка теплової карти — номер тижня від понеділка тижня, в який припадає 1 січня
+    first_monday = date_cls(int(year), 1, 1).toordinal() - date_cls(int(year), 1, 1).weekday()
+    heatmap = np.full((7, 54), np.nan)
+    monthly_hours = [0.0] * 12
+    monthly_pay = [0.0] * 12
+    for work_date, hours, pay in daily_totals:
+        day = datetime.strptime(work_date, "%Y-%m-%d").date()
+        heatmap[day.weekday(), (day.toordinal() - first_monday) // 7] = hours or 0.0
+        monthly_hours[day.month - 1] += hours or 0.0
+        monthly_pay[day.month - 1] += pay or 0.0
+
+    fig, (ax_heat, ax_bars) = plt.subplots(2, 1, figsize=(11, 5.5), gridspec_kw={'height_ratios': [1, 1.3]})
+    fig.suptitle(title)
+
+    # Вихідні (0 годин) — світлий колір, відсутні дні — порожні клітинки
+    cmap = plt.get_cmap('Greens').copy()
+    cmap.set_bad('#f2f2f2')
+    ax_heat.imshow(np.ma.masked_invalid(heatmap), aspect='auto', cmap=cmap, vmin=-2, vmax=max(12.0, np.nanmax(heatmap)))
+    ax_heat.set_yticks(range(7), ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Нд'], fontsize=7)
+    ax_heat.set_xticks([])
+
+    months = np.arange(12)
+    ax_bars.bar(months, monthly_hours, color='#4c9a5f')
+    ax_bars.set_ylabel('Години')
+    ax_bars.set_xticks(months, ['Січ', 'Лют', 'Бер', 'Кві', 'Тра', 'Чер', 'Лип', 'Сер', 'Вер', 'Жов', 'Лис', 'Гру'])
+    ax_pay = ax_bars.twinx()
+    ax_pay.plot(months, monthly_pay, color='#c0392b', marker='o')
+    ax_pay.set_ylabel(f'Оплата ({currency})')
+
+    output = io.BytesIO()
+    fig.tight_layout()
+    fig.savefig(output, format='png', dpi=90)
+    plt.close(fig)
+    return output.getvalue()
+
+
+# --- 4. ОБРОБНИКИ TELEGRAM-БОТА ---
+
+def selected_user_code(context: ContextTypes.DEFAULT_TYPE, tenant: dict) -> str | None:
+    """Повертає обраного користувача, лише якщо його обрано в цій самій команді (user_data спільні для всіх чатів)."""
+    user_code = context.user_data.get('current_user')
+    if user_code and context.user_data.get('current_team') == tenant['team_id'] and user_code in tenant['users']:
+        return user_code
+    return None
+
+async def select_user_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    # ... (код select_user_start) ...
+    tenant = get_chat_tenant(update)
+    if not tenant['users']:
+        await update.message.reply_text(
+            f"Список користувачів цієї команди порожній. Додайте користувача: `/{CMD_USER_ADD} <код> <ім'я>`",
+            parse_mode='Markdown'
+        )
+        return ConversationHandler.END
+
+    user_options = "\n".join([f"• <b>{html.escape(key)}</b> - {html.escape(name)}"
+                             for key, name in tenant['users'].items()])
+
+    await update.message.reply_text(
+        "👤 <b>Оберіть, для кого буде вестися облік:</b>\n"
+        "Введіть один із кодів зі списку (наприклад, user_1):\n\n"
+        f"{user_options}",
+        parse_mode='HTML'
+    )
+    return USER_SELECT
+
+async def select_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    # ... (код select_user) ...
+    user_code = update.message.text.strip().lower()
+    tenant = get_chat_tenant(update)
+
+    if user_code not in tenant['users']:
+        await update.message.reply_text(
+            f"⛔️ Код `{user_code}` не знайдено. Введіть коректний код зі списку:",
+            parse_mode='Markdown'
+        )
+        return USER_SELECT
+
+    user_name = tenant['users'][user_code]
+    context.user_data['current_user'] = user_code
+    context.user_data['current_team'] = tenant['team_id']
+
+    await update.message.reply_text(
+        f"✅ Облік встановлено для **{user_name}** (`{user_code}`).\n"
+        f"Тепер ви можете почати облік: **/{CMD_START_DAY}**",
+        parse_mode='Markdown'
+    )
+    return ConversationHandler.END
+
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    # ... (код start) ...
+    tenant = get_chat_tenant(update)
+    current_user_code = selected_user_code(context, tenant)
+
+    if not current_user_code:
+        await update.message.reply_text(
+            f"❌ **Помилка:** Спочатку оберіть користувача для обліку: **/{CMD_SWITCH_USER}**",
+            parse_mode='Markdown'
+        )
+        return ConversationHandler.END
+
+    user_name = tenant['users'][current_user_code]
+
+    await update.message.reply_text(
+        f"👋 Привіт! Облік для **{user_name}**.\n"
+        "Введіть **дату** (формат: РРРР-ММ-ДД, наприклад: 2025-10-15):"
+    )
+    return GET_DATE
+
+async def get_date(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Отримання дати, перевірка, стандартизація і запит часу початку."""
+    date_str_input = update.message.text.strip()
+
+    try:
+        # Стандартизуємо дату: перетворюємо на об'єкт datetime, а потім назад у формат YYYY-MM-DD
+        # Це виправить '2025-10-1' на '2025-10-01'
+        date_obj = datetime.strptime(date_str_input, "%Y-%m-%d")
+        date_str_standard = date_obj.strftime("%Y-%m-%d") # Це гарантує формат з нулями спереду
+    except ValueError:
+        await update.message.reply_text("⛔️ Невірний формат дати. Спробуйте ще раз (РРРР-ММ-ДД):")
+        return GET_DATE
+
+    tenant = get_chat_tenant(update)
+    current_user_code = selected_user_code(context, tenant)
+    if not current_user_code:
+        await update.message.reply_text(f"❌ Помилка: Користувач не обраний. Будь ласка, почніть з `/{CMD_SWITCH_USER}`.")
+        return ConversationHandler.END
+
+    if check_record_exists(tenant['team_id'], current_user_code, date_str_standard):
+        await update.message.reply_text(
+            f"❌ **Помилка:** Запис за дату **{date_str_standard}** для користувача **{tenant['users'][current_user_code]}** вже існує!\n\n"
+            f"Щоб додати новий запис, спочатку видаліть існуючий командою: `/{CMD_DELETE_DAY} {date_str_standard}` або скасуйте введення: `/{CMD_CANCEL}`.",
+            parse_mode='Markdown'
+        )
+        return ConversationHandler.END
+
+    context.user_data['work_date'] = date_str_standard # Зберігаємо стандартизовану дату
+    await update.message.reply_text(
+        f"✅ Дату **{date_str_standard}** прийнято.\n"
+        "Введіть **час початку** роботи (формат: ГГ:ХХ, наприклад: 09:00):"
+    )
+    return GET_START_TIME
+
+async def get_start_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    # ... (код get_start_time) ...
+    start_time_str = update.message.text.strip()
+    context.user_data['time_start'] = start_time_str
+
+    await update.message.reply_text(
+        f"✅ Початок **{start_time_str}** прийнято.\n"
+        "Введіть **час завершення** роботи (формат: ГГ:ХХ, наприклад: 18:30):"
+    )
+    return GET_END_TIME
+
+async def get_end_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    # ... (код get_end_time) ...
+    end_time_str = update.message.text.strip()
+    context.user_data['time_end'] = end_time_str
+
+    # ТЕКСТ: Просимо ввести загальний час перерв
+    await update.message.reply_text(
+        f"✅ Закінчення **{end_time_str}** прийнято.\n"
+        "Введіть **загальну тривалість усіх перерв/обіду у хвилинах** (наприклад: 60, 90, або **0**, якщо перерви не було):"
+    )
+    return GET_LUNCH
+
+async def get_lunch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    # ... (код get_lunch) ...
+    try:
         lunch_mins = int(update.message.text.strip())
         if lunch_mins < 0:
              await update.message.reply_text("⛔️ Час перерви не може бути від'ємним. Введіть 0 або позитивне число:")
@@ -399,7 +2213,8 @@ async def get_lunch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return GET_LUNCH
 
     # Збір усіх даних
-    current_user_code = context.user_data.get('current_user')
+    tenant = get_chat_tenant(update)
+    current_user_code = selected_user_code(context, tenant)
     if not current_user_code:
         await update.message.reply_text(f"❌ Помилка: Користувач не обраний. Будь ласка, почніть з `/{CMD_SWITCH_USER}`.")
         return ConversationHandler.END
@@ -408,27 +2223,54 @@ async def get_lunch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     # Виконання розрахунку
     net_hours, daily_pay, error_msg = calculate_work_data(
-        data['work_date'], data['time_start'], data['time_end'], lunch_mins
+        data['work_date'], data['time_start'], data['time_end'], lunch_mins, tenant['pay_rate']
     )
 
     if error_msg:
         await update.message.reply_text(f"❌ **Помилка!** {error_msg}\nСпробуйте почати знову: /{CMD_START_DAY}")
         return ConversationHandler.END
 
+    # Оплата за правилами команди: ставка на цю дату, множник вихідного/свята, понаднормові
+    pay_rules = get_pay_rules(tenant['team_id'])
+    pay_rule = pay_rules.resolve(current_user_code, data['work_date'])
+    day_multiplier = pay_rules.day_multiplier(pay_rule, data['work_date'])
+    daily_pay = pay_rules.price(current_user_code, data['work_date'], net_hours)
+
     # Збереження даних у базу (data['work_date'] вже стандартизовано в get_date)
-    save_record(current_user_code, data['work_date'], data['time_start'], data['time_end'], lunch_mins, net_hours, daily_pay)
+    status = save_record(tenant['team_id'], current_user_code, data['work_date'], data['time_start'], data['time_end'], lunch_mins, net_hours, daily_pay)
+
+    if status == SAVE_FAILED:
+        await update.message.reply_text(f"❌ **Помилка!** Не вдалося зберегти запис. Спробуйте почати знову: /{CMD_START_DAY}", parse_mode='Markdown')
+        return ConversationHandler.END
 
     # Надсилання результату
+    if status == SAVE_QUEUED:
+        header = (
+            "--- ⏳ **ДАНІ В ЧЕРЗІ** ⏳ ---\n"
+            "База даних тимчасово недоступна: запис збережено локально й буде перенесено автоматично.\n"
+        )
+    else:
+        header = "--- ✅ **ДАНІ ЗБЕРЕЖЕНО** ✅ ---\n"
     summary = (
-        f"--- ✅ **ДАНІ ЗБЕРЕЖЕНО** ✅ ---\n"
-        f"👤 **Користувач:** {KNOWN_USERS[current_user_code]}\n"
+        header +
+        f"👤 **Користувач:** {tenant['users'][current_user_code]}\n"
         f"📅 **Дата:** {data['work_date']}\n"
         f"🕒 **Зміна:** {data['time_start']} - {data['time_end']}\n"
         f"🍕 **Вирахування (Обід/Перерви):** {lunch_mins} хв\n"
         f"-----------------------------------\n"
         f"⏱️ **Чистий час:** **{net_hours} годин**\n"
-        f"💰 **Оплата за день ({CURRENCY_SYMBOL}{PAY_RATE}/год):** **{daily_pay} {CURRENCY_SYMBOL}**"
+        f"💰 **Оплата за день ({tenant['currency']}{pay_rule['hourly_rate']:g}/год"
+        f"{f' ×{day_multiplier:g}' if day_multiplier != 1 else ''}):** **{daily_pay} {tenant['currency']}**"
     )
+
+    # Попередній підсумок місяця з hot-window індексу (без запиту до БД, якщо місяць уже завантажено)
+    progress = status == SAVE_STORED and get_month_progress(tenant['team_id'], current_user_code, data['work_date'][:7])
+    if progress:
+        days_worked, month_hours, month_pay = progress
+        summary += (
+            f"\n📊 **За {data['work_date'][:7]}:** {days_worked} роб. дн., "
+            f"{month_hours} год, {month_pay} {tenant['currency']}"
+        )
     await update.message.reply_text(summary, parse_mode='Markdown')
 
     # Очищуємо дані форми
@@ -444,7 +2286,8 @@ async def get_lunch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 async def start_holiday(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # ... (код start_holiday) ...
-    current_user_code = context.user_data.get('current_user')
+    tenant = get_chat_tenant(update)
+    current_user_code = selected_user_code(context, tenant)
 
     if not current_user_code:
         await update.message.reply_text(
@@ -453,7 +2296,7 @@ async def start_holiday(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         )
         return ConversationHandler.END
 
-    user_name = KNOWN_USERS[current_user_code]
+    user_name = tenant['users'][current_user_code]
 
     await update.message.reply_text(
         f"🏖️ Облік для **{user_name}**.\n"
@@ -473,12 +2316,13 @@ async def get_holiday_date_and_save(update: Update, context: ContextTypes.DEFAUL
         await update.message.reply_text("⛔️ Невірний формат дати. Спробуйте ще раз (РРРР-ММ-ДД):")
         return GET_HOLIDAY_DATE
 
-    current_user_code = context.user_data.get('current_user')
+    tenant = get_chat_tenant(update)
+    current_user_code = selected_user_code(context, tenant)
     if not current_user_code:
         await update.message.reply_text(f"❌ Помилка: Користувач не обраний. Будь ласка, почніть з `/{CMD_SWITCH_USER}`.")
         return ConversationHandler.END
 
-    if check_record_exists(current_user_code, date_str_standard):
+    if check_record_exists(tenant['team_id'], current_user_code, date_str_standard):
         await update.message.reply_text(
             f"❌ **Помилка:** Запис за дату **{date_str_standard}** вже існує!\n"
             f"Щоб додати вихідний, спочатку видаліть існуючий запис: `/{CMD_DELETE_DAY} {date_str_standard}`"
@@ -486,7 +2330,8 @@ async def get_holiday_date_and_save(update: Update, context: ContextTypes.DEFAUL
         return ConversationHandler.END
 
     # Збереження запису з нульовими значеннями для Вихідного
-    save_record(
+    status = save_record(
+        team_id=tenant['team_id'],
         user_code=current_user_code, 
         work_date=date_str_standard, 
         time_start="-", 
@@ -496,9 +2341,20 @@ async def get_holiday_date_and_save(update: Update, context: ContextTypes.DEFAUL
         daily_pay=0.0
     )
 
+    if status == SAVE_FAILED:
+        await update.message.reply_text("❌ Не вдалося зберегти вихідний. Спробуйте ще раз пізніше.")
+        return ConversationHandler.END
+    if status == SAVE_QUEUED:
+        await update.message.reply_text(
+            f"⏳ **Вихідний** для **{tenant['users'][current_user_code]}** за дату **{date_str_standard}** поставлено в чергу: "
+            f"база даних тимчасово недоступна, запис буде перенесено автоматично.",
+            parse_mode='Markdown'
+        )
+        return ConversationHandler.END
+
     await update.message.reply_text(
-        f"✅ **Вихідний** для **{KNOWN_USERS[current_user_code]}** за дату **{date_str_standard}** успішно додано до бази даних.\n"
-        f"Ця дата буде відображена у звіті Excel як неробочий день (0 годин/0 {CURRENCY_SYMBOL}).",
+        f"✅ **Вихідний** для **{tenant['users'][current_user_code]}** за дату **{date_str_standard}** успішно додано до бази даних.\n"
+        f"Ця дата буде відображена у звіті Excel як неробочий день (0 годин/0 {tenant['currency']}).",
         parse_mode='Markdown'
     )
     return ConversationHandler.END
@@ -515,212 +2371,819 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # Зберігаємо обраного користувача, але очищуємо дані форми
     if 'current_user' in context.user_data:
         temp_user = context.user_data['current_user']
+        temp_team = context.user_data.get('current_team')
         context.user_data.clear()
         context.user_data['current_user'] = temp_user
+        context.user_data['current_team'] = temp_team
     else:
         context.user_data.clear()
 
     return ConversationHandler.END
 
-async def get_current_user_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str | None:
+async def get_current_user_code(update: Update, context: ContextTypes.DEFAULT_TYPE, tenant: dict) -> str | None:
     # ... (код get_current_user_code) ...
-    user_code = context.user_data.get('current_user')
+    user_code = selected_user_code(context, tenant)
     if not user_code:
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text=f"❌ **Помилка:** Спочатку оберіть користувача для звіту: `/{CMD_SWITCH_USER}`",
             parse_mode='Markdown'
         )
-    return user_code
+    return user_code
+
+def build_monthly_report(tenant: dict, user_code: str, month_year_prefix: str):
+    """
+    Будує Excel-звіт за місяць з коректним сортуванням і стовпцем дня тижня.
+    Синхронна функція: виконується в потоці через TENANT_LIMITER, щоб не блокувати інші команди.
+    Повертає (BytesIO з файлом, сумарна оплата) або None, якщо записів немає.
+    """
+    records = get_monthly_records(tenant['team_id'], month_year_prefix, user_code)
+
+    if not records:
+        return None
+
+    # 1. Створення DataFrame
+    currency_column_name = f'Оплата ({tenant["currency"]})'
+    df = pd.DataFrame(
+        records,
+        columns=['Дата', 'Початок', 'Кінець', 'Перерва (хв)', 'Чистий час (год)', currency_column_name]
+    )
+    
+    # 2. **КОРЕКТНЕ СОРТУВАННЯ ЗА ДАТОЮ** та **РОЗРАХУНОК ДНЯ ТИЖНЯ**
+    
+    # Словник для перекладу англійських скорочень на українські
+    day_names = {
+        'Mon': 'Пн', 'Tue': 'Вт', 'Wed': 'Ср', 'Thu': 'Чт', 
+        'Fri': 'Пт', 'Sat': 'Сб', 'Sun': 'Нд'
+    }
+    
+    # Тимчасовий стовпець для коректного перетворення в datetime (для сортування і дня тижня)
+    # Зберігаємо його як новий стовпець
+    df['Temp_Date_Sort'] = pd.to_datetime(df['Дата'], errors='coerce') 
+
+    # Створення стовпця "День тижня"
+    # Якщо дата валідна, отримуємо день тижня і перекладаємо його. Якщо NaT (вихідний), залишаємо порожнім.
+    df.insert(1, 'День тижня', df['Temp_Date_Sort'].dt.strftime('%a').map(day_names).fillna(''))
+    
+    # *** ВИПРАВЛЕННЯ: Сортуємо за назвою тимчасового стовпця! ***
+    df = df.sort_values(by='Temp_Date_Sort', ascending=True, na_position='last')
+    
+    # Видаляємо допоміжний стовпець, оскільки він більше не потрібен
+    df = df.drop(columns=['Temp_Date_Sort'])
+    
+    # Повертаємо формат дати назад у рядок (YYYY-MM-DD), щоб "-" для вихідних також коректно відображався
+    df['Дата'] = df['Дата'].apply(lambda x: x.strftime('%Y-%m-%d') if pd.notna(x) else x) # x - це '-' для NaT
+
+    # 3. Розрахунок підсумків
+    total_hours = df['Чистий час (год)'].sum()
+    total_pay = df[currency_column_name].sum()
+    
+    # Створення підсумкового рядка
+    summary_row = {
+        'Дата': f'РАЗОМ ({tenant["users"][user_code]}):',
+        'День тижня': '', # Додаємо пусте поле для нового стовпця
+        'Початок': '', 
+        'Кінець': '', 
+        'Перерва (хв)': '', 
+        'Чистий час (год)': round(total_hours, 2),
+        currency_column_name: round(total_pay, 2)
+    }
+
+    # Додавання підсумкового рядка до DataFrame
+    df.loc[len(df)] = summary_row
+    
+
+    # 4. Експорт безпосередньо в Excel
+    output = io.BytesIO()
+
+    # Використовуємо df.to_excel
+    df.to_excel(output, index=False, sheet_name='Work Log')
+    output.seek(0)
+    return output, round(total_pay, 2)
+
+async def monthly_summary_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обробник команди /zvit РРРР-ММ. Генерує та надсилає Excel-файл з коректним сортуванням 
+    і додає стовпець з днем тижня."""
+    tenant = get_chat_tenant(update)
+    user_code = await get_current_user_code(update, context, tenant)
+    if not user_code:
+        return
+
+    try:
+        month_year_prefix = context.args[0]
+        if len(month_year_prefix) != 7 or month_year_prefix[4] != '-':
+            await update.message.reply_text(f"⛔️ Невірний формат. Вкажіть місяць у форматі `/{CMD_SUMMARY} РРРР-ММ` (наприклад: `/{CMD_SUMMARY} 2025-10`)")
+            return
+    except IndexError:
+        await update.message.reply_text(f"Будь ласка, вкажіть місяць у форматі `/{CMD_SUMMARY} РРРР-ММ` (наприклад: `/{CMD_SUMMARY} 2025-10`)")
+        return
+
+    report = await TENANT_LIMITER.run(tenant['team_id'], build_monthly_report, tenant, user_code, month_year_prefix)
+
+    if report is None:
+        await update.message.reply_text(f"Немає записів за **{month_year_prefix}** для **{tenant['users'][user_code]}**.")
+        return
+
+    output, total_pay = report
+    excel_filename = f"Zvit_{month_year_prefix}_{user_code}.xlsx"
+
+    caption_text = (
+        f"✅ Звіт по робочих змінах для **{tenant['users'][user_code]}** за **{month_year_prefix}**.\n"
+        f"Сумарна оплата: **{total_pay} {tenant['currency']}**"
+    )
+
+    await context.bot.send_document(
+        chat_id=update.effective_chat.id,
+        document=output,
+        filename=excel_filename,
+        caption=caption_text,
+        parse_mode='Markdown'
+    )
+
+    await update.message.reply_text("Звіт успішно сформовано та надіслано!")
+
+async def annual_summary_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # ... (код annual_summary_command) ...
+    tenant = get_chat_tenant(update)
+    user_code = await get_current_user_code(update, context, tenant)
+    if not user_code:
+        return
+
+    try:
+        year = context.args[0]
+        if len(year) != 4 or not year.isdigit():
+            await update.message.reply_text(f"⛔️ Невірний формат. Вкажіть рік у форматі `/{CMD_YEAR_SUMMARY} РРРР` (наприклад: `/{CMD_YEAR_SUMMARY} 2025`)")
+            return
+    except (IndexError, TypeError):
+        await update.message.reply_text(f"Будь ласка, вкажіть рік у форматі `/{CMD_YEAR_SUMMARY} РРРР` (наприклад: `/{CMD_YEAR_SUMMARY} 2025`)")
+        return
+
+    if len(context.args) > 1 and context.args[1].lower() == CHART_ARG:
+        await send_year_chart(update, context, tenant, user_code, year)
+        return
+
+    all_dates = await TENANT_LIMITER.run(tenant['team_id'], get_annual_records_by_month, tenant['team_id'], user_code, year)
+
+    if not all_dates:
+        await update.message.reply_text(f"Немає записів за **{year}** для **{tenant['users'][user_code]}**.")
+        return
+
+    monthly_data = {}
+    for date_str in all_dates:
+        month_prefix = date_str[:7]
+        day = date_str[8:]
+
+        if month_prefix not in monthly_data:
+            monthly_data[month_prefix] = []
+
+        monthly_data[month_prefix].append(day)
+
+    response_parts = [
+        f"📅 **Активні робочі дні для {tenant['users'][user_code]} за {year} рік:**",
+        "--------------------------------------"
+    ]
+
+    for month, days in monthly_data.items():
+        days_str = ", ".join(days)
+        response_parts.append(f"\n🗓️ **{month}** ({len(days)} дн.):")
+        response_parts.append(days_str)
+
+    response_parts.append("\n--------------------------------------")
+    response_parts.append(f"Для детального звіту по місяцю використовуйте: `/{CMD_SUMMARY} РРРР-ММ`")
+
+    final_response = "\n".join(response_parts)
+
+    await update.message.reply_text(final_response, parse_mode='Markdown')
+
+async def send_year_chart(update: Update, context: ContextTypes.DEFAULT_TYPE, tenant: dict, user_code: str, year: str) -> None:
+    """Надсилає річний графік: повторно за file_id, якщо дані не змінились, інакше малює новий у пулі процесів."""
+    if matplotlib is None:
+        await update.message.reply_text("❌ Графіки недоступні на сервері (не встановлено matplotlib).")
+        return
+
+    team_id = tenant['team_id']
+    daily_totals = await TENANT_LIMITER.run(team_id, get_annual_daily_totals, team_id, user_code, year)
+    if not daily_totals:
+        await update.message.reply_text(f"Немає записів за **{year}** для **{tenant['users'][user_code]}**.")
+        return
+
+    key = (team_id, user_code, year)
+    version = chart_data_version(daily_totals)
+    total_hours = round(sum(hours or 0.0 for _, hours, _ in daily_totals), 2)
+    total_pay = round(sum(pay or 0.0 for _, _, pay in daily_totals), 2)
+    caption = f"📊 {tenant['users'][user_code]}, {year}: {total_hours} год, {total_pay} {tenant['currency']}"
+
+    file_id = get_cached_chart(key, version)
+    if file_id:
+        try:
+            await context.bot.send_photo(chat_id=update.effective_chat.id, photo=file_id, caption=caption)
+            return
+        except BadRequest:
+            logger.warning(f"[CHART] file_id для {key} більше недійсний, малюємо заново.")
+
+    png = await TENANT_LIMITER.run(team_id, render_year_chart, year, f"{tenant['users'][user_code]} — {year}",
+                                   daily_totals, tenant['currency'], executor=get_render_pool())
+    message = await context.bot.send_photo(chat_id=update.effective_chat.id, photo=png, caption=caption)
+    store_cached_chart(key, version, message.photo[-1].file_id)
+
+async def reject_while_spooled(update: Update) -> bool:
+    """
+    Відмовляє в команді, що змінює записи напряму в БД, поки локальний журнал не відтворено:
+    інакше вона обігнала б старіші операції з черги.
+    """
+    if not spool_has_pending():
+        return False
+    await update.message.reply_text(
+        "⏳ Записи з черги ще переносяться в базу даних. Повторіть команду за кілька секунд."
+    )
+    return True
+
+async def reprice_after_commit(team_id: str, user_code: str | None, date_from: str, date_to: str):
+    """
+    Перерахунок оплати після вже зафіксованої зміни правил. Відмова обмежувача (ліміт частоти або
+    зупинка інстансу) не передається обробнику помилок: інакше користувачу запропонували б повторити
+    команду, зміна якої вже збережена. Повертає кількість перерахованих записів або None.
+    """
+    try:
+        return await TENANT_LIMITER.run(team_id, reprice_records, team_id, user_code, date_from, date_to)
+    except (TenantThrottled, ServiceDraining, JobInterrupted) as e:
+        logger.warning(f"[PAY] Перерахунок {team_id} {date_from} — {date_to} не виконано ({type(e).__name__}).")
+        return None
+
+def reprice_note(repriced: int | None) -> str:
+    """Рядок відповіді про автоматичний перерахунок оплати."""
+    if repriced is None:
+        return f"⚠️ Оплату записів не перераховано (база даних недоступна). Повторіть пізніше: `/{CMD_REPRICE}`."
+    return f"Перераховано оплату записів: **{repriced}**."
+
+def undo_hint(audit: dict) -> str:
+    """Рядок відповіді з командою скасування видалення (Markdown)."""
+    return f"↩️ Скасувати: `/{CMD_UNDO} {audit['batch_id']}`"
+
+def log_audit_batch(tenant: dict, user_code: str, audit: dict, rows: int) -> None:
+    """Коротка подія аудиту в лог (повний вміст рядків — у таблиці audit_log)."""
+    logger.info(f"[AUDIT] {audit['action']} batch={audit['batch_id']} | Team: {tenant['team_id']} | User: {user_code} | "
+                f"Rows: {rows} | ChatID: {audit['chat_id']} | ActorID: {audit['user_id']}")
+
+async def delete_day_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # ... (код delete_day_command) ...
+    tenant = get_chat_tenant(update)
+    user_code = await get_current_user_code(update, context, tenant)
+    if not user_code:
+        return
+
+    try:
+        date_str_input = context.args[0]
+        # Стандартизуємо дату для видалення, щоб вона точно збігалася з БД
+        date_obj = datetime.strptime(date_str_input, "%Y-%m-%d")
+        date_str_to_delete = date_obj.strftime("%Y-%m-%d")
+
+    except (IndexError, ValueError):
+        await update.message.reply_text(f"⛔️ Невірний формат. Вкажіть дату у форматі `/{CMD_DELETE_DAY} РРРР-ММ-ДД` (наприклад: `/{CMD_DELETE_DAY} 2025-10-15`)")
+        return
+
+    audit = new_audit_batch(update, AUDIT_DELETE_DAY)
+    changes = delete_record(tenant['team_id'], user_code, date_str_to_delete, audit)
+
+    if changes == DELETE_QUEUED:
+        await update.message.reply_text(f"⏳ Видалення запису за **{date_str_to_delete}** поставлено в чергу: база даних тимчасово недоступна.", parse_mode='Markdown')
+    elif changes > 0:
+        log_audit_batch(tenant, user_code, audit, changes)
+        await update.message.reply_text(
+            f"🗑️ Запис за **{date_str_to_delete}** для **{tenant['users'][user_code]}** успішно видалено.\n{undo_hint(audit)}",
+            parse_mode='Markdown'
+        )
+    else:
+        await update.message.reply_text(f"❌ Запис за **{date_str_to_delete}** для **{tenant['users'][user_code]}** не знайдено або не було видалено.", parse_mode='Markdown')
+
+
+# -----------------------------------------------------------------
+# ОБРОБНИКИ ДІАПАЗОННИХ ОПЕРАЦІЙ
+# -----------------------------------------------------------------
+
+async def reply_range_result(update: Update, changes: int | None, dry_run: bool, action: str, period: str,
+                             audit: dict | None = None, total_pay: str | None = None, skipped: int = 0) -> None:
+    """
+    Єдиний формат відповіді для діапазонних команд (звичайне виконання та попередній перегляд).
+    changes=None — операцію не виконано через помилку БД. Для видалень і масових змін (audit) відповідь
+    містить команду скасування, для змін з перерахунком (total_pay) — оплату змінених днів за правилами
+    команди, а skipped — кількість днів, залишених без змін, бо перерва перевищує тривалість зміни.
+    """
+    if changes is None:
+        text = f"❌ Не вдалося виконати операцію ({period}): база даних недоступна. Спробуйте пізніше."
+    elif dry_run:
+        text = f"🔎 Попередній перегляд: буде {action} записів: **{changes}** ({period}). Нічого не змінено."
+        if changes and total_pay:
+            text += f"\nОплата цих днів за правилами команди: **{total_pay}**."
+    elif changes > 0:
+        text = f"✅ Успішно {action} записів: **{changes}** ({period})."
+        if total_pay:
+            text += f"\nОплата змінених днів за правилами команди: **{total_pay}**."
+        if audit:
+            text += f"\n{undo_hint(audit)}"
+    else:
+        text = f"❌ Не знайдено записів для зміни ({period})."
+    if changes is not None and skipped:
+        verb = "Буде пропущено" if dry_run else "Пропущено"
+        text += f"\n⚠️ {verb} днів, де перерва довша за зміну: **{skipped}**."
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+async def delete_range_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обробник команди /vidr РРРР-ММ-ДД РРРР-ММ-ДД [?]."""
+    tenant = get_chat_tenant(update)
+    user_code = await get_current_user_code(update, context, tenant)
+    if not user_code:
+        return
+
+    try:
+        date_from, date_to, _, dry_run = parse_range_args(context.args)
+    except ValueError:
+        await update.message.reply_text(
+            f"⛔️ Невірний формат. Приклад: `/{CMD_DELETE_RANGE} 2025-10-01 2025-10-31` "
+            f"(додайте `{DRY_RUN_ARG}` в кінці для попереднього перегляду)",
+            parse_mode='Markdown'
+        )
+        return
+
+    if not dry_run and await reject_while_spooled(update):
+        return
+    audit = new_audit_batch(update, AUDIT_DELETE_RANGE)
+    changes = delete_records_range(tenant['team_id'], user_code, date_from, date_to, audit, dry_run)
+    if changes and not dry_run:
+        log_audit_batch(tenant, user_code, audit, changes)
+    await reply_range_result(update, changes, dry_run, "видалено", f"{date_from} — {date_to}, {tenant['users'][user_code]}", audit)
+
+async def edit_range_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обробник команди /red РРРР-ММ-ДД РРРР-ММ-ДД ГГ:ХХ ГГ:ХХ ХВ [?] — однакова зміна для всіх робочих днів діапазону."""
+    tenant = get_chat_tenant(update)
+    user_code = await get_current_user_code(update, context, tenant)
+    if not user_code:
+        return
+
+    try:
+        date_from, date_to, rest, dry_run = parse_range_args(context.args)
+        time_start, time_end, lunch_mins = rest[0], rest[1], int(rest[2])
+        if lunch_mins < 0:
+            raise ValueError("Від'ємна перерва")
+    except (ValueError, IndexError):
+        await update.message.reply_text(
+            f"⛔️ Невірний формат. Приклад: `/{CMD_EDIT_RANGE} 2025-10-01 2025-10-31 09:00 18:00 60` "
+            f"(додайте `{DRY_RUN_ARG}` в кінці для попереднього перегляду)",
+            parse_mode='Markdown'
+        )
+        return
+
+    # Тривалість не залежить від дати, тому розраховуємо один раз для всього діапазону
+    net_hours, _, error_msg = calculate_work_data(date_from, time_start, time_end, lunch_mins)
+    if error_msg:
+        await update.message.reply_text(f"❌ **Помилка!** {error_msg}", parse_mode='Markdown')
+        return
+
+    if not dry_run and await reject_while_spooled(update):
+        return
+    audit = new_audit_batch(update, AUDIT_EDIT_RANGE)
+    # Ставка може відрізнятися по днях діапазону (вихідні, свята, зміна правил) — оплату рахують правила команди
+    changes, skipped, total_pay = await TENANT_LIMITER.run(tenant['team_id'], update_records_range_shift,
+                                                           tenant['team_id'], user_code, date_from, date_to,
+                                                           time_start, time_end, lunch_mins, audit, dry_run)
+    if changes and not dry_run:
+        log_audit_batch(tenant, user_code, audit, changes)
+    await reply_range_result(update, changes, dry_run, "змінено",
+                             f"{date_from} — {date_to}, {time_start}-{time_end}, {net_hours} год/день",
+                             audit, total_pay=f"{total_pay} {tenant['currency']}", skipped=skipped)
+
+async def lunch_range_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обробник команди /obid РРРР-ММ-ДД РРРР-ММ-ДД ХВ [?] — нова перерва з перерахунком годин і оплати."""
+    tenant = get_chat_tenant(update)
+    user_code = await get_current_user_code(update, context, tenant)
+    if not user_code:
+        return
+
+    try:
+        date_from, date_to, rest, dry_run = parse_range_args(context.args)
+        lunch_mins = int(rest[0])
+        if lunch_mins < 0:
+            raise ValueError("Від'ємна перерва")
+    except (ValueError, IndexError):
+        await update.message.reply_text(
+            f"⛔️ Невірний формат. Приклад: `/{CMD_LUNCH_RANGE} 2025-10-06 2025-10-12 30` "
+            f"(додайте `{DRY_RUN_ARG}` в кінці для попереднього перегляду)",
+            parse_mode='Markdown'
+        )
+        return
+
+    if not dry_run and await reject_while_spooled(update):
+        return
+    audit = new_audit_batch(update, AUDIT_LUNCH_RANGE)
+    changes, skipped, total_pay = await TENANT_LIMITER.run(tenant['team_id'], update_records_range_lunch,
+                                                           tenant['team_id'], user_code, date_from, date_to,
+                                                           lunch_mins, audit, dry_run)
+    if changes and not dry_run:
+        log_audit_batch(tenant, user_code, audit, changes)
+    await reply_range_result(update, changes, dry_run, "змінено", f"{date_from} — {date_to}, перерва {lunch_mins} хв",
+                             audit, total_pay=f"{total_pay} {tenant['currency']}", skipped=skipped)
+
+async def move_holiday_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обробник команди /pvih РРРР-ММ-ДД РРРР-ММ-ДД [?] — перенесення вихідного на іншу дату."""
+    tenant = get_chat_tenant(update)
+    user_code = await get_current_user_code(update, context, tenant)
+    if not user_code:
+        return
+
+    args = list(context.args or [])
+    dry_run = bool(args) and args[-1] == DRY_RUN_ARG
+    if dry_run:
+        args.pop()
+    try:
+        old_date, new_date = standardize_date(args[0]), standardize_date(args[1])
+    except (ValueError, IndexError):
+        await update.message.reply_text(
+            f"⛔️ Невірний формат. Приклад: `/{CMD_MOVE_HOLIDAY} 2025-10-15 2025-10-17` "
+            f"(додайте `{DRY_RUN_ARG}` в кінці для попереднього перегляду)",
+            parse_mode='Markdown'
+        )
+        return
+
+    if not dry_run and await reject_while_spooled(update):
+        return
+    audit = new_audit_batch(update, AUDIT_MOVE_HOLIDAY)
+    changes = move_holiday_record(tenant['team_id'], user_code, old_date, new_date, audit, dry_run)
+    if changes and not dry_run:
+        log_audit_batch(tenant, user_code, audit, changes)
+    await reply_range_result(update, changes, dry_run, "перенесено",
+                             f"вихідний {old_date} → {new_date}; нова дата має бути вільною", audit)
+
+# -----------------------------------------------------------------
+# ОБРОБНИКИ АНАЛІТИКИ
+# -----------------------------------------------------------------
+
+async def resolve_analytics_scope(update: Update, context: ContextTypes.DEFAULT_TYPE, tenant: dict, rest: list):
+    """
+    Визначає, чиї записи аналізувати: `all` — уся команда (None), код зі списку команди —
+    конкретний користувач, без аргументу — поточний обраний користувач. Повертає (успіх, код або None).
+    """
+    if rest and rest[0].lower() == 'all':
+        return True, None
+    if rest:
+        user_code = rest[0].lower()
+        if user_code not in tenant['users']:
+            await update.message.reply_text(f"❌ Код користувача `{user_code}` не знайдено у списку цієї команди.", parse_mode='Markdown')
+            return False, None
+        return True, user_code
+    user_code = await get_current_user_code(update, context, tenant)
+    return bool(user_code), user_code
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обробник команди /eksport csv|parquet РРРР-ММ-ДД РРРР-ММ-ДД [код|all]."""
+    tenant = get_chat_tenant(update)
+    try:
+        export_format = context.args[0].lower()
+        if export_format not in ('csv', 'parquet'):
+            raise ValueError("Невідомий формат")
+        date_from, date_to, rest, _ = parse_range_args(context.args[1:])
+    except (IndexError, ValueError):
+        await update.message.reply_text(
+            f"⛔️ Невірний формат. Приклад: `/{CMD_EXPORT} csv 2025-01-01 2025-12-31 all` "
+            f"(формат `csv` або `parquet`; в кінці — код користувача або `all` для всієї команди)",
+            parse_mode='Markdown'
+        )
+        return
 
-async def monthly_summary_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обробник команди /zvit РРРР-ММ. Генерує та надсилає Excel-файл з коректним сортуванням 
-    і додає стовпець з днем тижня."""
-    user_code = await get_current_user_code(update, context)
-    if not user_code:
+    if export_format == 'parquet' and pa is None:
+        await update.message.reply_text("❌ Parquet-експорт недоступний на сервері (не встановлено pyarrow). Використайте `csv`.", parse_mode='Markdown')
+        return
+
+    ok, user_code = await resolve_analytics_scope(update, context, tenant, rest)
+    if not ok:
+        return
+
+    path, rows_written = await TENANT_LIMITER.run(tenant['team_id'], export_records, tenant['team_id'],
+                                                  user_code, date_from, date_to, export_format)
+    if path is None:
+        await update.message.reply_text("❌ Не вдалося сформувати експорт. Спробуйте пізніше.")
         return
 
     try:
-        month_year_prefix = context.args[0]
-        if len(month_year_prefix) != 7 or month_year_prefix[4] != '-':
-            await update.message.reply_text(f"⛔️ Невірний формат. Вкажіть місяць у форматі `/{CMD_SUMMARY} РРРР-ММ` (наприклад: `/{CMD_SUMMARY} 2025-10`)")
+        if rows_written == 0:
+            await update.message.reply_text(f"Немає записів за {date_from} — {date_to}.")
             return
-    except IndexError:
-        await update.message.reply_text(f"Будь ласка, вкажіть місяць у форматі `/{CMD_SUMMARY} РРРР-ММ` (наприклад: `/{CMD_SUMMARY} 2025-10`)")
+        scope = user_code or 'all'
+        with open(path, 'rb') as export_file:
+            await context.bot.send_document(
+                chat_id=update.effective_chat.id,
+                document=export_file,
+                filename=f"Eksport_{date_from}_{date_to}_{scope}.{export_format}",
+                caption=f"✅ Експорт {export_format.upper()}: {rows_written} записів ({date_from} — {date_to}, {scope})."
+            )
+    finally:
+        os.remove(path)
+
+async def weekly_summary_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обробник команди /tyzh РРРР-ММ-ДД РРРР-ММ-ДД [код|all] — тижневі години, понаднормові та середня зміна."""
+    tenant = get_chat_tenant(update)
+    try:
+        date_from, date_to, rest, _ = parse_range_args(context.args)
+    except ValueError:
+        await update.message.reply_text(
+            f"⛔️ Невірний формат. Приклад: `/{CMD_WEEKLY} 2025-10-01 2025-10-31` (в кінці можна вказати код або `all`)",
+            parse_mode='Markdown'
+        )
         return
 
-    records = get_monthly_records(month_year_prefix, user_code)
+    ok, user_code = await resolve_analytics_scope(update, context, tenant, rest)
+    if not ok:
+        return
 
-    if not records:
-        await update.message.reply_text(f"Немає записів за **{month_year_prefix}** для **{KNOWN_USERS[user_code]}**.")
+    rows = await TENANT_LIMITER.run(tenant['team_id'], get_weekly_rollup, tenant['team_id'],
+                                    user_code, date_from, date_to, WEEKLY_OVERTIME_HOURS)
+    if not rows:
+        await update.message.reply_text(f"Немає робочих змін за {date_from} — {date_to}.")
         return
 
-    # 1. Створення DataFrame
-    currency_column_name = f'Оплата ({CURRENCY_SYMBOL})'
-    df = pd.DataFrame(
-        records,
-        columns=['Дата', 'Початок', 'Кінець', 'Перерва (хв)', 'Чистий час (год)', currency_column_name]
-    )
-    
-    # 2. **КОРЕКТНЕ СОРТУВАННЯ ЗА ДАТОЮ** та **РОЗРАХУНОК ДНЯ ТИЖНЯ**
-    
-    # Словник для перекладу англійських скорочень на українські
-    day_names = {
-        'Mon': 'Пн', 'Tue': 'Вт', 'Wed': 'Ср', 'Thu': 'Чт', 
-        'Fri': 'Пт', 'Sat': 'Сб', 'Sun': 'Нд'
-    }
-    
-    # Тимчасовий стовпець для коректного перетворення в datetime (для сортування і дня тижня)
-    # Зберігаємо його як новий стовпець
-    df['Temp_Date_Sort'] = pd.to_datetime(df['Дата'], errors='coerce') 
+    response_parts = [
+        f"📈 Тижневі підсумки {date_from} — {date_to} (понаднормові понад {WEEKLY_OVERTIME_HOURS:g} год/тиж.):"
+    ]
+    current = None
+    for row_user, week_start, shifts, hours, overtime, avg_shift, running_hours, pay in rows:
+        if row_user != current:
+            current = row_user
+            response_parts.append(f"\n👤 {tenant['users'].get(row_user, row_user)}:")
+        response_parts.append(
+            f"{week_start:%G-W%V} (з {week_start:%d.%m}): {shifts} зм., {hours} год"
+            f"{f', понаднорм. {overtime}' if overtime else ''}, сер. зміна {avg_shift} год, "
+            f"всього {running_hours} год, {pay} {tenant['currency']}"
+        )
+    final_response = "\n".join(response_parts)
 
-    # Створення стовпця "День тижня"
-    # Якщо дата валідна, отримуємо день тижня і перекладаємо його. Якщо NaT (вихідний), залишаємо порожнім.
-    df.insert(1, 'День тижня', df['Temp_Date_Sort'].dt.strftime('%a').map(day_names).fillna(''))
-    
-    # *** ВИПРАВЛЕННЯ: Сортуємо за назвою тимчасового стовпця! ***
-    df = df.sort_values(by='Temp_Date_Sort', ascending=True, na_position='last')
-    
-    # Видаляємо допоміжний стовпець, оскільки він більше не потрібен
-    df = df.drop(columns=['Temp_Date_Sort'])
-    
-    # Повертаємо формат дати назад у рядок (YYYY-MM-DD), щоб "-" для вихідних також коректно відображався
-    df['Дата'] = df['Дата'].apply(lambda x: x.strftime('%Y-%m-%d') if pd.notna(x) else x) # x - це '-' для NaT
+    if len(final_response) <= TEXT_SUMMARY_LIMIT:
+        await update.message.reply_text(final_response)
+        return
 
-    # 3. Розрахунок підсумків
-    total_hours = df['Чистий час (год)'].sum()
-    total_pay = df[currency_column_name].sum()
-    
-    # Створення підсумкового рядка
-    summary_row = {
-        'Дата': f'РАЗОМ ({KNOWN_USERS[user_code]}):',
-        'День тижня': '', # Додаємо пусте поле для нового стовпця
-        'Початок': '', 
-        'Кінець': '', 
-        'Перерва (хв)': '', 
-        'Чистий час (год)': round(total_hours, 2),
-        currency_column_name: round(total_pay, 2)
-    }
+    # Довгий період — надсилаємо компактний CSV замість кількох повідомлень
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['user_id', 'week_start', 'shifts', 'hours', 'overtime', 'avg_shift', 'running_hours', 'pay'])
+    writer.writerows(rows)
+    await context.bot.send_document(
+        chat_id=update.effective_chat.id,
+        document=io.BytesIO(output.getvalue().encode('utf-8')),
+        filename=f"Tyzhni_{date_from}_{date_to}.csv",
+        caption=f"📈 Тижневі підсумки {date_from} — {date_to}: {len(rows)} рядків."
+    )
 
-    # Додавання підсумкового рядка до DataFrame
-    df.loc[len(df)] = summary_row
-    
+async def is_chat_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """
+    Адмін-команди дозволені користувачам з ADMIN_USER_IDS. Для команди за замовчуванням (спільної для
+    всіх чатів без MULTI_TENANT і для LEGACY_CHAT_IDS) — тільки їм. Для інших команд також адміністраторам
+    групи, а в особистому чаті (це власна команда користувача) — завжди.
+    """
+    chat = update.effective_chat
+    user = update.effective_user
+    if user and str(user.id) in ADMIN_USER_IDS:
+        return True
+    if team_id_for_chat(chat.id) == DEFAULT_TEAM_ID:
+        await update.message.reply_text("⛔️ Ця команда доступна лише адміністраторам бота.")
+        return False
+    if chat.type == 'private':
+        return True
+    member = await context.bot.get_chat_member(chat.id, update.effective_user.id)
+    if member.status in ('administrator', 'creator'):
+        return True
+    await update.message.reply_text("⛔️ Ця команда доступна лише адміністраторам чату.")
+    return False
 
-    # 4. Експорт безпосередньо в Excel
-    output = io.BytesIO()
-    excel_filename = f"Zvit_{month_year_prefix}_{user_code}.xlsx"
+async def user_list_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # ... (код user_list_command) ...
+    tenant = get_chat_tenant(update)
+    if not tenant['users']:
+        await update.message.reply_text(
+            f"Список користувачів цієї команди порожній. Додайте користувача: `/{CMD_USER_ADD} <код> <ім'я>`",
+            parse_mode='Markdown'
+        )
+        return
 
-    # Використовуємо df.to_excel
-    df.to_excel(output, index=False, sheet_name='Work Log')
-    output.seek(0)
+    user_options = "\n".join([f"• <b>{html.escape(key)}</b> - {html.escape(name)}"
+                             for key, name in tenant['users'].items()])
 
-    caption_text = (
-        f"✅ Звіт по робочих змінах для **{KNOWN_USERS[user_code]}** за **{month_year_prefix}**.\n"
-        f"Сумарна оплата: **{round(total_pay, 2)} {CURRENCY_SYMBOL}**"
+    response_text = (
+        "👤 <b>Поточний список облікових записів:</b>\n"
+        "-------------------------------------\n"
+        "<b>Код</b> - Ім'я (для обміну):\n\n"
+        f"{user_options}\n\n"
+        f"💰 Ставка команди: {html.escape(str(tenant['pay_rate']))} {html.escape(tenant['currency'])}/год"
     )
 
-    await context.bot.send_document(
-        chat_id=update.effective_chat.id,
-        document=output,
-        filename=excel_filename,
-        caption=caption_text,
-        parse_mode='Markdown'
-    )
+    await update.message.reply_text(response_text, parse_mode='HTML')
 
-    await update.message.reply_text("Звіт успішно сформовано та надіслано!")
 
-async def annual_summary_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    # ... (код annual_summary_command) ...
-    user_code = await get_current_user_code(update, context)
-    if not user_code:
+async def user_add_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обробник команди /uadd <код> <ім'я> — додає користувача до реєстру команди цього чату."""
+    if not await is_chat_admin(update, context):
         return
 
     try:
-        year = context.args[0]
-        if len(year) != 4 or not year.isdigit():
-            await update.message.reply_text(f"⛔️ Невірний формат. Вкажіть рік у форматі `/{CMD_YEAR_SUMMARY} РРРР` (наприклад: `/{CMD_YEAR_SUMMARY} 2025`)")
-            return
-    except (IndexError, TypeError):
-        await update.message.reply_text(f"Будь ласка, вкажіть рік у форматі `/{CMD_YEAR_SUMMARY} РРРР` (наприклад: `/{CMD_YEAR_SUMMARY} 2025`)")
+        user_code = context.args[0].strip().lower()
+        user_name = " ".join(context.args[1:]).strip()
+        if not user_name:
+            raise IndexError
+    except IndexError:
+        await update.message.reply_text(
+            f"⛔️ Вкажіть код та ім'я: `/{CMD_USER_ADD} <код> <ім'я>` (наприклад: `/{CMD_USER_ADD} user_4 Олег`)",
+            parse_mode='Markdown'
+        )
         return
 
-    all_dates = get_annual_records_by_month(user_code, year)
+    tenant = get_chat_tenant(update)
+    if add_team_user(tenant['team_id'], user_code, user_name):
+        await update.message.reply_text(f"✅ Користувача **{user_name}** (`{user_code}`) додано до команди.", parse_mode='Markdown')
+    else:
+        await update.message.reply_text("❌ Не вдалося зберегти користувача. Спробуйте пізніше.")
 
-    if not all_dates:
-        await update.message.reply_text(f"Немає записів за **{year}** для **{KNOWN_USERS[user_code]}**.")
+async def team_rate_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обробник команди /stavka <ставка> [валюта] — ставка за годину для команди цього чату."""
+    if not await is_chat_admin(update, context):
         return
 
-    monthly_data = {}
-    for date_str in all_dates:
-        month_prefix = date_str[:7]
-        day = date_str[8:]
+    tenant = get_chat_tenant(update)
+    try:
+        pay_rate = float(context.args[0].replace(',', '.'))
+        if pay_rate < 0:
+            raise ValueError("Від'ємна ставка")
+        currency = context.args[1] if len(context.args) > 1 else tenant['currency']
+    except (IndexError, ValueError):
+        await update.message.reply_text(
+            f"⛔️ Вкажіть ставку: `/{CMD_TEAM_RATE} 7.5 €` (поточна: {tenant['pay_rate']} {tenant['currency']}/год)",
+            parse_mode='Markdown'
+        )
+        return
 
-        if month_prefix not in monthly_data:
-            monthly_data[month_prefix] = []
+    if set_team_pay_rate(tenant['team_id'], pay_rate, currency):
+        await update.message.reply_text(f"✅ Нова ставка команди: **{pay_rate} {currency}/год** (діє для нових записів; історію перерахує `/{CMD_REPRICE}`).", parse_mode='Markdown')
+    else:
+        await update.message.reply_text("❌ Не вдалося змінити ставку. Спробуйте пізніше.")
+
+def describe_pay_rule(rule: dict, currency: str) -> str:
+    """Правило оплати одним рядком: ставка, множники та пороги понаднормових."""
+    parts = [f"{rule['hourly_rate']:g} {currency}/год"]
+    if rule['weekend_multiplier'] != 1:
+        parts.append(f"вихідні ×{rule['weekend_multiplier']:g}")
+    if rule['holiday_multiplier'] != 1:
+        parts.append(f"свята ×{rule['holiday_multiplier']:g}")
+    for threshold, multiplier in rule['overtime_tiers']:
+        parts.append(f"понад {threshold:g} год ×{multiplier:g}")
+    return ", ".join(parts)
+
+async def pay_rule_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Обробник команди /pravylo <код|all> РРРР-ММ-ДД <ставка> [vih=1.5] [sv=2] [8:1.25 10:1.5] — правило
+    оплати з дати (без аргументів — список правил). Оплата записів від цієї дати перераховується.
+    """
+    if not await is_chat_admin(update, context):
+        return
 
-        monthly_data[month_prefix].append(day)
+    tenant = get_chat_tenant(update)
+    usage = (
+        f"Формат: `/{CMD_PAY_RULE} <код|all> РРРР-ММ-ДД <ставка> [{WEEKEND_MULTIPLIER_ARG}1.5] [{HOLIDAY_MULTIPLIER_ARG}2] [8:1.25 10:1.5]`\n"
+        f"(`8:1.25` — години понад 8 оплачуються з множником 1.25)"
+    )
+    if not context.args:
+        pay_rules = get_pay_rules(tenant['team_id'])
+        lines = []
+        for rule in pay_rules.rules:
+            if rule['user_code'] == PAY_RULE_ALL_USERS:
+                who = "вся команда"
+            else:
+                who = tenant['users'].get(rule['user_code'], f"`{rule['user_code']}`")
+            lines.append(f"• {who} з {rule['valid_from']}: {describe_pay_rule(rule, tenant['currency'])}")
+        await update.message.reply_text(
+            "💰 **Правила оплати:**\n" + ("\n".join(lines) if lines else "немає") +
+            f"\nБез правил діє ставка команди: {describe_pay_rule(pay_rules.base_rule, tenant['currency'])}.\n\n" + usage,
+            parse_mode='Markdown'
+        )
+        return
 
-    response_parts = [
-        f"📅 **Активні робочі дні для {KNOWN_USERS[user_code]} за {year} рік:**",
-        "--------------------------------------"
-    ]
+    try:
+        target = context.args[0].strip().lower()
+        valid_from = standardize_date(context.args[1])
+        hourly_rate = float(context.args[2].replace(',', '.'))
+        weekend_multiplier = holiday_multiplier = 1.0
+        overtime_tiers = []
+        for token in context.args[3:]:
+            token = token.lower().replace(',', '.')
+            if token.startswith(WEEKEND_MULTIPLIER_ARG):
+                weekend_multiplier = float(token[len(WEEKEND_MULTIPLIER_ARG):])
+            elif token.startswith(HOLIDAY_MULTIPLIER_ARG):
+                holiday_multiplier = float(token[len(HOLIDAY_MULTIPLIER_ARG):])
+            else:
+                threshold, multiplier = token.split(':')
+                overtime_tiers.append((float(threshold), float(multiplier)))
+        numbers = [hourly_rate, weekend_multiplier, holiday_multiplier] + [n for tier in overtime_tiers for n in tier]
+        if min(numbers) < 0:
+            raise ValueError("Від'ємне значення")
+    except (IndexError, ValueError):
+        await update.message.reply_text(f"⛔️ Невірний формат. {usage}", parse_mode='Markdown')
+        return
+    overtime_tiers.sort()
 
-    for month, days in monthly_data.items():
-        days_str = ", ".join(days)
-        response_parts.append(f"\n🗓️ **{month}** ({len(days)} дн.):")
-        response_parts.append(days_str)
+    if target == 'all':
+        user_code, who = PAY_RULE_ALL_USERS, "вся команда"
+    elif target in tenant['users']:
+        user_code, who = target, tenant['users'][target]
+    else:
+        await update.message.reply_text(f"❌ Код користувача `{target}` не знайдено у списку цієї команди.", parse_mode='Markdown')
+        return
 
-    response_parts.append("\n--------------------------------------")
-    response_parts.append(f"Для детального звіту по місяцю використовуйте: `/{CMD_SUMMARY} РРРР-ММ`")
+    if await reject_while_spooled(update):
+        return
+    TENANT_LIMITER.ensure_accepting()
+    if not set_pay_rule(tenant['team_id'], user_code, valid_from, hourly_rate, weekend_multiplier,
+                        holiday_multiplier, overtime_tiers):
+        await update.message.reply_text("❌ Не вдалося зберегти правило. Спробуйте пізніше.")
+        return
 
-    final_response = "\n".join(response_parts)
+    rule = {'hourly_rate': hourly_rate, 'weekend_multiplier': weekend_multiplier,
+            'holiday_multiplier': holiday_multiplier, 'overtime_tiers': overtime_tiers}
+    repriced = await reprice_after_commit(tenant['team_id'], None if user_code == PAY_RULE_ALL_USERS else user_code,
+                                          valid_from, REPRICE_OPEN_END)
+    await update.message.reply_text(
+        f"✅ Правило для **{who}** з **{valid_from}**: {describe_pay_rule(rule, tenant['currency'])}.\n"
+        + reprice_note(repriced),
+        parse_mode='Markdown'
+    )
 
-    await update.message.reply_text(final_response, parse_mode='Markdown')
+async def public_holiday_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обробник команди /svyato [РРРР-ММ-ДД on|off] — робить день святковим або звичайним (без аргументів — список)."""
+    if not await is_chat_admin(update, context):
+        return
 
-async def delete_day_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    # ... (код delete_day_command) ...
-    user_code = await get_current_user_code(update, context)
-    if not user_code:
+    tenant = get_chat_tenant(update)
+    if not context.args:
+        holidays = sorted(get_pay_rules(tenant['team_id']).holidays)
+        await update.message.reply_text(
+            "🎉 Святкові дні команди: " + (", ".join(holidays) if holidays else "немає") +
+            f"\nДодати: `/{CMD_PUBLIC_HOLIDAY} РРРР-ММ-ДД {HOLIDAY_ON_ARG}`, прибрати: `/{CMD_PUBLIC_HOLIDAY} РРРР-ММ-ДД {HOLIDAY_OFF_ARG}`",
+            parse_mode='Markdown'
+        )
         return
 
     try:
-        date_str_input = context.args[0]
-        # Стандартизуємо дату для видалення, щоб вона точно збігалася з БД
-        date_obj = datetime.strptime(date_str_input, "%Y-%m-%d")
-        date_str_to_delete = date_obj.strftime("%Y-%m-%d")
-
+        holiday_date = standardize_date(context.args[0])
+        switch = context.args[1].strip().lower()
+        if switch not in (HOLIDAY_ON_ARG, HOLIDAY_OFF_ARG):
+            raise ValueError("Невідомий перемикач")
     except (IndexError, ValueError):
-        await update.message.reply_text(f"⛔️ Невірний формат. Вкажіть дату у форматі `/{CMD_DELETE_DAY} РРРР-ММ-ДД` (наприклад: `/{CMD_DELETE_DAY} 2025-10-15`)")
+        await update.message.reply_text(
+            f"⛔️ Вкажіть дату та `{HOLIDAY_ON_ARG}` або `{HOLIDAY_OFF_ARG}`: `/{CMD_PUBLIC_HOLIDAY} 2025-12-25 {HOLIDAY_ON_ARG}`",
+            parse_mode='Markdown'
+        )
         return
 
-    changes = delete_record(user_code, date_str_to_delete)
+    if await reject_while_spooled(update):
+        return
+    is_holiday = switch == HOLIDAY_ON_ARG
+    TENANT_LIMITER.ensure_accepting()
+    if set_pay_holiday(tenant['team_id'], holiday_date, is_holiday) is None:
+        await update.message.reply_text("❌ Не вдалося змінити святкові дні. Спробуйте пізніше.")
+        return
 
-    if changes > 0:
-        await update.message.reply_text(f"🗑️ Запис за **{date_str_to_delete}** для **{KNOWN_USERS[user_code]}** успішно видалено.", parse_mode='Markdown')
-    else:
-        await update.message.reply_text(f"❌ Запис за **{date_str_to_delete}** для **{KNOWN_USERS[user_code]}** не знайдено або не було видалено.", parse_mode='Markdown')
+    # Перерахунок виконується й тоді, коли стан уже був таким: повтор команди доводить оплату до правил
+    repriced = await reprice_after_commit(tenant['team_id'], None, holiday_date, holiday_date)
+    status = "тепер святковий" if is_holiday else "більше не святковий"
+    await update.message.reply_text(
+        f"🎉 **{holiday_date}** {status}. " + reprice_note(repriced),
+        parse_mode='Markdown'
+    )
 
-async def user_list_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    # ... (код user_list_command) ...
-    if not KNOWN_USERS:
-        await update.message.reply_text("Список користувачів для обліку (KNOWN_USERS) порожній.", parse_mode='Markdown')
+async def reprice_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обробник команди /pererah РРРР-ММ-ДД РРРР-ММ-ДД [код|all] [?] — перерахунок оплати за чинними правилами."""
+    if not await is_chat_admin(update, context):
         return
 
-    user_options = "\n".join([f"• <b>{html.escape(key)}</b> - {html.escape(name)}"
-                             for key, name in KNOWN_USERS.items()])
-
-    response_text = (
-        "👤 <b>Поточний список облікових записів:</b>\n"
-        "-------------------------------------\n"
-        "<b>Код</b> - Ім'я (для обміну):\n\n"
-        f"{user_options}"
-    )
+    tenant = get_chat_tenant(update)
+    try:
+        date_from, date_to, rest, dry_run = parse_range_args(context.args)
+    except ValueError:
+        await update.message.reply_text(
+            f"⛔️ Невірний формат. Приклад: `/{CMD_REPRICE} 2025-01-01 2025-12-31 all` "
+            f"(додайте `{DRY_RUN_ARG}` в кінці для попереднього перегляду)",
+            parse_mode='Markdown'
+        )
+        return
 
-    await update.message.reply_text(response_text, parse_mode='HTML')
+    ok, user_code = await resolve_analytics_scope(update, context, tenant, rest)
+    if not ok or (not dry_run and await reject_while_spooled(update)):
+        return
 
+    repriced = await TENANT_LIMITER.run(tenant['team_id'], reprice_records, tenant['team_id'], user_code,
+                                        date_from, date_to, dry_run)
+    scope = tenant['users'].get(user_code, user_code) if user_code else "вся команда"
+    await reply_range_result(update, repriced, dry_run, "перераховано", f"{date_from} — {date_to}, {scope}")
 
 async def user_delete_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # ... (код user_delete_command) ...
+    if not await is_chat_admin(update, context):
+        return
+
     try:
         user_code_to_delete = context.args[0].strip().lower()
     except IndexError:
@@ -730,32 +3193,112 @@ async def user_delete_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         return
 
-    if user_code_to_delete not in KNOWN_USERS:
+    tenant = get_chat_tenant(update)
+    if user_code_to_delete not in tenant['users']:
         await update.message.reply_text(
-            f"❌ Код користувача **`{user_code_to_delete}`** не знайдено у списку `KNOWN_USERS`. Видалення скасовано.",
+            f"❌ Код користувача **`{user_code_to_delete}`** не знайдено у списку цієї команди. Видалення скасовано.",
             parse_mode='Markdown'
         )
         return
 
-    user_name = KNOWN_USERS[user_code_to_delete]
+    user_name = tenant['users'][user_code_to_delete]
 
-    # Видалення записів з бази даних
-    deleted_count = delete_user_records(user_code_to_delete)
+    # Видалення записів з бази даних (лише в межах команди цього чату) та з реєстру команди
+    if await reject_while_spooled(update):
+        return
+    audit = new_audit_batch(update, AUDIT_DELETE_USER)
+    deleted_count = delete_user_records(tenant['team_id'], user_code_to_delete, audit)
+    if deleted_count is None:
+        await update.message.reply_text("❌ Не вдалося видалити записи: база даних недоступна. Спробуйте пізніше.")
+        return
+    remove_team_user(tenant['team_id'], user_code_to_delete)
+    if deleted_count:
+        log_audit_batch(tenant, user_code_to_delete, audit, deleted_count)
 
     await update.message.reply_text(
         f"🗑️ Усі записи для **{user_name}** (`{user_code_to_delete}`) успішно видалено з бази даних.\n"
-        f"Видалено записів: **{deleted_count}**.",
+        f"Видалено записів: **{deleted_count}**."
+        + (f"\n{undo_hint(audit)}" if deleted_count else ""),
         parse_mode='Markdown'
     )
 
     # Скидаємо поточного користувача, якщо він був видалений
-    if context.user_data.get('current_user') == user_code_to_delete:
+    if (context.user_data.get('current_user') == user_code_to_delete
+            and context.user_data.get('current_team') == tenant['team_id']):
         context.user_data.pop('current_user')
         await update.message.reply_text(
             f"Тепер облік для вас не встановлено. Оберіть нового користувача: `/{CMD_SWITCH_USER}`",
             parse_mode='Markdown'
         )
 
+async def undo_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обробник команди /vidnov <партія> — відновлює записи, видалені або змінені однією операцією."""
+    if not await is_chat_admin(update, context):
+        return
+
+    try:
+        batch_id = context.args[0].strip().lower()
+    except IndexError:
+        await update.message.reply_text(
+            f"⛔️ Вкажіть номер операції: `/{CMD_UNDO} <номер>`. Останні операції: `/{CMD_AUDIT_LOG}`",
+            parse_mode='Markdown'
+        )
+        return
+
+    if await reject_while_spooled(update):
+        return
+    tenant = get_chat_tenant(update)
+    audit = new_audit_batch(update, AUDIT_RESTORE)
+    result = restore_audit_batch(tenant['team_id'], batch_id, audit)
+    if result is None:
+        await update.message.reply_text("❌ Не вдалося відновити записи. Спробуйте пізніше.")
+        return
+    if result['status'] == 'not_found':
+        await update.message.reply_text(f"❌ Операцію `{batch_id}` не знайдено в журналі цієї команди.", parse_mode='Markdown')
+        return
+    if result['status'] == 'already':
+        await update.message.reply_text(f"ℹ️ Операцію `{batch_id}` вже було скасовано раніше.", parse_mode='Markdown')
+        return
+
+    log_audit_batch(tenant, ",".join(sorted(result['users'])), dict(audit, action=f"{AUDIT_RESTORE}:{batch_id}"), result['restored'])
+    text = f"↩️ Відновлено записів: **{result['restored']}**."
+    if result['skipped']:
+        if result['action'] in AUDIT_UPDATE_ACTIONS:
+            reason = "записи вже видалено або дата зайнята іншим записом"
+        else:
+            reason = "на ці дні вже є нові записи"
+        text += f"\nПропущено ({reason}): **{result['skipped']}**."
+    missing = sorted(result['users'] - tenant['users'].keys())
+    if missing:
+        text += "\nКористувачів немає в реєстрі команди, додайте їх знову: " + ", ".join(
+            f"`/{CMD_USER_ADD} {user_code} <ім'я>`" for user_code in missing)
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+async def audit_log_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обробник команди /zhurnal — останні видалення, масові зміни та відновлення команди цього чату."""
+    if not await is_chat_admin(update, context):
+        return
+
+    tenant = get_chat_tenant(update)
+    rows = await asyncio.to_thread(get_audit_batches, tenant['team_id'], AUDIT_LIST_LIMIT)
+    if not rows:
+        await update.message.reply_text("📜 Журнал видалень і змін цієї команди порожній.")
+        return
+
+    lines = []
+    for batch_id, action, chat_id, actor_id, logged_at, count, user_code, first_date, last_date, restored in rows:
+        period = first_date if first_date == last_date else f"{first_date} — {last_date}"
+        status = " (скасовано)" if restored else ""
+        lines.append(
+            f"• <code>{html.escape(batch_id)}</code> {logged_at:%Y-%m-%d %H:%M} {html.escape(action)}{status}: "
+            f"{html.escape(user_code or '')}, {html.escape(period or '')}, рядків: {count} "
+            f"(чат {chat_id}, користувач {actor_id})"
+        )
+    await update.message.reply_text(
+        "📜 <b>Останні операції:</b>\n" + "\n".join(lines) + f"\n\nСкасувати: /{CMD_UNDO} &lt;номер&gt;",
+        parse_mode='HTML'
+    )
+
 async def log_user_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # ... (код log_user_messages) ...
     if update.message and update.message.text:
@@ -763,11 +3306,43 @@ async def log_user_messages(update: Update, context: ContextTypes.DEFAULT_TYPE)
         text = update.message.text
 
         # Ідентифікуємо користувача, якщо він обраний
-        user_code = context.user_data.get('current_user', 'N/A')
-        user_name = KNOWN_USERS.get(user_code, 'Невідомий')
+        tenant = get_chat_tenant(update)
+        user_code = selected_user_code(context, tenant) or 'N/A'
+        user_name = tenant['users'].get(user_code, 'Невідомий')
 
         # Виводимо в консоль
-        logger.info(f"[USER_INPUT] ChatID: {chat_id} | User: {user_name} ({user_code}) | Message: '{text}'")
+        logger.info(f"[USER_INPUT] ChatID: {chat_id} | Team: {tenant['team_id']} | User: {user_name} ({user_code}) | Message: '{text}'")
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Оновлення, які не встигли виконатися через зупинку інстансу (ServiceDraining — до будь-якого запису,
+    див. розділ 2.6), зберігаються в pending_updates і виконуються наступним інстансом. Важкі задачі понад ліміт частоти команди відхиляються
+    з попередженням. Решта помилок лише логуються.
+    """
+    if isinstance(context.error, ServiceDraining) and isinstance(update, Update):
+        saved = await asyncio.to_thread(save_pending_update, json.dumps(update.to_dict()))
+        if update.effective_message:
+            if saved:
+                text = "⏳ Бот перезапускається: запит буде виконано автоматично за хвилину."
+            else:
+                text = "⏳ Бот перезапускається. Будь ласка, повторіть команду за хвилину."
+            await update.effective_message.reply_text(text)
+        return
+    if isinstance(context.error, JobInterrupted) and isinstance(update, Update):
+        logger.warning(f"[LIFECYCLE] Задачу оновлення {update.update_id} перервано дедлайном зупинки.")
+        if update.effective_message:
+            await update.effective_message.reply_text(
+                "⏳ Бот перезапускається, операцію перервано. Перевірте результат і за потреби повторіть команду."
+            )
+        return
+    if isinstance(context.error, TenantThrottled) and isinstance(update, Update):
+        team_id = team_id_for_chat(update.effective_chat.id)
+        logger.warning(f"[RATE_LIMIT] Команда {team_id} перевищила ліміт важких задач, запит відхилено.")
+        # Попереджаємо лише про перший відхилений запит поспіль, щоб не множити повідомлення під час флуду
+        if update.effective_message and TENANT_LIMITER.streak.get(team_id) == 1:
+            await update.effective_message.reply_text("⏳ Забагато звітів від цієї команди. Повторіть команду за кілька секунд.")
+        return
+    logger.error("Необроблена помилка під час обробки оновлення", exc_info=context.error)
 
 
 # --- 5. ГОЛОВНА ФУНКЦІЯ ---
@@ -775,27 +3350,114 @@ async def log_user_messages(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def set_bot_commands(application: Application):
     # ... (код set_bot_commands) ...
     commands = [
-        BotCommand(CMD_SWITCH_USER, f"Змінити: Обрати поточного користувача ({' / '.join(KNOWN_USERS.values())})"),
+        BotCommand(CMD_SWITCH_USER, "Змінити: Обрати поточного користувача"),
         BotCommand(CMD_HOLIDAY, f"Вихідний: Додати неробочий день (/{CMD_HOLIDAY} РРРР-ММ-ДД)"),
         BotCommand(CMD_START_DAY, "Почати облік нового робочого дня"),
         BotCommand(CMD_SUMMARY, f"Звіт: Отримати Excel-звіт за місяць (напр.: /{CMD_SUMMARY} 2024-12)"),
-        BotCommand(CMD_YEAR_SUMMARY, f"Рік: Переглянути робочі дні за рік (напр.: /{CMD_YEAR_SUMMARY} 2025)"),
+        BotCommand(CMD_YEAR_SUMMARY, f"Рік: Робочі дні за рік (напр.: /{CMD_YEAR_SUMMARY} 2025 або /{CMD_YEAR_SUMMARY} 2025 {CHART_ARG})"),
         BotCommand(CMD_DELETE_DAY, f"Видалити: Стерти запис за день (напр.: /{CMD_DELETE_DAY} 2025-01-01)"),
+        BotCommand(CMD_DELETE_RANGE, f"Видалити діапазон (напр.: /{CMD_DELETE_RANGE} 2025-10-01 2025-10-31 {DRY_RUN_ARG})"),
+        BotCommand(CMD_EDIT_RANGE, f"Редагувати зміни за діапазон (напр.: /{CMD_EDIT_RANGE} 2025-10-01 2025-10-31 09:00 18:00 60)"),
+        BotCommand(CMD_LUNCH_RANGE, f"Перерва за діапазон (напр.: /{CMD_LUNCH_RANGE} 2025-10-06 2025-10-12 30)"),
+        BotCommand(CMD_MOVE_HOLIDAY, f"Перенести вихідний (напр.: /{CMD_MOVE_HOLIDAY} 2025-10-15 2025-10-17)"),
+        BotCommand(CMD_EXPORT, f"Експорт CSV/Parquet (напр.: /{CMD_EXPORT} csv 2025-01-01 2025-12-31 all)"),
+        BotCommand(CMD_WEEKLY, f"Тижневі години й понаднормові (напр.: /{CMD_WEEKLY} 2025-10-01 2025-10-31)"),
         BotCommand(CMD_USER_LIST, "Адмін: Показати список користувачів"),
+        BotCommand(CMD_USER_ADD, f"Адмін: Додати користувача (напр.: /{CMD_USER_ADD} user_4 Олег)"),
         BotCommand(CMD_USER_DELETE, "Адмін: Видалити всі записи користувача"),
+        BotCommand(CMD_TEAM_RATE, f"Адмін: Ставка команди (напр.: /{CMD_TEAM_RATE} 7.5 €)"),
+        BotCommand(CMD_PAY_RULE, f"Адмін: Правило оплати (напр.: /{CMD_PAY_RULE} all 2025-01-01 7.5 {WEEKEND_MULTIPLIER_ARG}1.5 8:1.25)"),
+        BotCommand(CMD_PUBLIC_HOLIDAY, f"Адмін: Святковий день (напр.: /{CMD_PUBLIC_HOLIDAY} 2025-12-25 {HOLIDAY_ON_ARG})"),
+        BotCommand(CMD_REPRICE, f"Адмін: Перерахувати оплату (напр.: /{CMD_REPRICE} 2025-01-01 2025-12-31 all)"),
+        BotCommand(CMD_AUDIT_LOG, "Адмін: Журнал видалень і змін"),
+        BotCommand(CMD_UNDO, f"Адмін: Скасувати видалення або зміну (напр.: /{CMD_UNDO} 3f9a1c2b7d4e)"),
         BotCommand(CMD_CANCEL, "Скасувати поточне введення даних")
     ]
     await application.bot.set_my_commands(commands)
     logger.info("Список команд успішно встановлено.")
 
+_background_tasks = set()
+
+def warm_caches() -> None:
+    """Прогріває підключення до БД, реєстр команди за замовчуванням і hot-window індекс її користувачів."""
+    tenant = get_tenant(DEFAULT_TEAM_ID)
+    for month in hot_window_months():
+        for user_code in tenant['users']:
+            get_hot_month(DEFAULT_TEAM_ID, user_code, month)
+    if spool_has_pending():
+        replay_spool()
+
+def begin_shutdown(application: Application) -> None:
+    """
+    Обробник SIGTERM/SIGINT: інстанс перестає приймати оновлення (webhook-сервер зупиняється, Telegram
+    тримає нові оновлення для наступного інстансу), а незавершені задачі отримують DRAIN_DEADLINE секунд.
+    """
+    if TENANT_LIMITER.draining:
+        return
+    logger.info(f"[LIFECYCLE] Отримано сигнал зупинки, завершуємо задачі (до {DRAIN_DEADLINE:g} с).")
+    TENANT_LIMITER.begin_drain(DRAIN_DEADLINE)
+    application.stop_running()
+
+def start_background_tasks(application: Application) -> None:
+    """Запускає фонові задачі в циклі подій (не через application.create_task, щоб не затримувати stop())."""
+    loop = asyncio.get_running_loop()
+    for worker in (spool_worker(), pending_updates_worker(application)):
+        _background_tasks.add(loop.create_task(worker))
+
+async def on_startup(application: Application) -> None:
+    """
+    Виконується до реєстрації webhook: прогріває кеші та пул процесів, щоб перші оновлення після
+    перезапуску не чекали холодного старту, запускає фонові задачі та обробку сигналів.
+    """
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, begin_shutdown, application)
+
+    started = time.perf_counter()
+    await asyncio.to_thread(warm_caches)
+    if matplotlib is not None:
+        pool = get_render_pool()
+        await asyncio.gather(*(loop.run_in_executor(pool, int) for _ in range(RENDER_WORKERS)))
+    logger.info(f"[LIFECYCLE] Прогрів завершено за {time.perf_counter() - started:.2f} с.")
+
+    start_background_tasks(application)
+    await set_bot_commands(application)
+
+async def on_stop(application: Application) -> None:
+    """Після зливання оновлень: зупиняє фонові задачі."""
+    await TENANT_LIMITER.wait_idle()
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+
+async def shutdown_workers(application: Application) -> None:
+    """Звільняє фонові ресурси після зупинки бота."""
+    WRITE_SPOOL.sync()
+    # Остання спроба перенести журнал у БД: решта операцій дочекається наступного інстансу на постійному томі
+    if spool_has_pending() and not db_breaker_open():
+        await asyncio.to_thread(replay_spool, time.monotonic() + SPOOL_SHUTDOWN_REPLAY)
+        logger.info(f"[LIFECYCLE] Операцій у журналі після зупинки: {WRITE_SPOOL.pending()}.")
+    shutdown_render_pool()
+
 def main() -> None:
     """Запуск бота."""
     
     # Спроба ініціалізації БД
     setup_database()
+    if not ADMIN_USER_IDS:
+        logger.warning("ADMIN_USER_IDS не встановлено: адмін-команди для команди за замовчуванням вимкнено.")
+    if not SPOOL_ON_VOLUME:
+        logger.warning("SPOOL_PATH не задано і том Railway не підключено: записи під час недоступності БД не зберігатимуться в чергу.")
 
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
-    application.post_init = set_bot_commands
+    # Стан діалогів і user_data переживає перезапуск (файл має бути на постійному томі)
+    persistence = PicklePersistence(filepath=STATE_PATH, update_interval=STATE_FLUSH_INTERVAL)
+
+    application = Application.builder().token(TELEGRAM_TOKEN).persistence(persistence).build()
+    application.post_init = on_startup
+    application.post_stop = on_stop
+    application.post_shutdown = shutdown_workers
+    application.add_error_handler(error_handler)
 
     # ConversationHandler для вибору користувача
     switch_handler = ConversationHandler(
@@ -804,6 +3466,8 @@ def main() -> None:
             USER_SELECT: [MessageHandler(filters.TEXT & ~filters.COMMAND, select_user)],
         },
         fallbacks=[CommandHandler(CMD_CANCEL, cancel)],
+        name="switch_user",
+        persistent=True,
     )
 
     # ConversationHandler для вводу робочих даних
@@ -816,6 +3480,8 @@ def main() -> None:
             GET_LUNCH: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_lunch)],
         },
         fallbacks=[CommandHandler(CMD_CANCEL, cancel)],
+        name="work_day",
+        persistent=True,
     )
 
     # ConversationHandler для додавання вихідного
@@ -825,6 +3491,8 @@ def main() -> None:
             GET_HOLIDAY_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_holiday_date_and_save)],
         },
         fallbacks=[CommandHandler(CMD_CANCEL, cancel)],
+        name="holiday",
+        persistent=True,
     )
 
 
@@ -833,26 +3501,47 @@ def main() -> None:
     application.add_handler(conv_handler)
     application.add_handler(holiday_handler) 
 
-    # Обробники звітів та видалення
-    application.add_handler(CommandHandler(CMD_SUMMARY, monthly_summary_command))
-    application.add_handler(CommandHandler(CMD_YEAR_SUMMARY, annual_summary_command))
+    # Обробники звітів та видалення (звіти не блокують обробку оновлень інших команд)
+    application.add_handler(CommandHandler(CMD_SUMMARY, monthly_summary_command, block=False))
+    application.add_handler(CommandHandler(CMD_YEAR_SUMMARY, annual_summary_command, block=False))
     application.add_handler(CommandHandler(CMD_DELETE_DAY, delete_day_command))
 
+    # Обробники діапазонних операцій
+    application.add_handler(CommandHandler(CMD_DELETE_RANGE, delete_range_command))
+    application.add_handler(CommandHandler(CMD_EDIT_RANGE, edit_range_command, block=False))
+    application.add_handler(CommandHandler(CMD_LUNCH_RANGE, lunch_range_command, block=False))
+    application.add_handler(CommandHandler(CMD_MOVE_HOLIDAY, move_holiday_command))
+
+    # Обробники аналітики (важкі запити виконуються в потоках і не блокують інші оновлення)
+    application.add_handler(CommandHandler(CMD_EXPORT, export_command, block=False))
+    application.add_handler(CommandHandler(CMD_WEEKLY, weekly_summary_command, block=False))
+
     # Обробники керування користувачами
     application.add_handler(CommandHandler(CMD_USER_LIST, user_list_command))
     application.add_handler(CommandHandler(CMD_USER_DELETE, user_delete_command))
+    application.add_handler(CommandHandler(CMD_USER_ADD, user_add_command))
+    application.add_handler(CommandHandler(CMD_TEAM_RATE, team_rate_command))
+    application.add_handler(CommandHandler(CMD_UNDO, undo_command))
+
+    # Правила оплати (перерахунок історії виконується в потоці й не блокує інші оновлення)
+    application.add_handler(CommandHandler(CMD_PAY_RULE, pay_rule_command, block=False))
+    application.add_handler(CommandHandler(CMD_PUBLIC_HOLIDAY, public_holiday_command, block=False))
+    application.add_handler(CommandHandler(CMD_REPRICE, reprice_command, block=False))
+    application.add_handler(CommandHandler(CMD_AUDIT_LOG, audit_log_command))
 
     # Обробник для логування всіх не-командних повідомлень (ПОВИНЕН БУТИ ОСТАННІМ!)
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, log_user_messages))
 
     # --- ЗАПУСК У РЕЖИМІ WEBHOOKS (ОБОВ'ЯЗКОВО ДЛЯ RAILWAY) ---
+    # Оновлення, що надійшли під час перезапуску, не відкидаються (drop_pending_updates=False),
+    # а сигнали зупинки обробляє begin_shutdown (stop_signals=None)
 
     PORT = int(os.environ.get("PORT", 8080)) 
     WEBHOOK_URL = os.environ.get("WEBHOOK_URL") 
     
     if not WEBHOOK_URL:
         logger.warning("WEBHOOK_URL не встановлено. Запуск у режимі Long Polling (Тільки для локального тестування!)")
-        application.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+        application.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=False, stop_signals=None)
     else:
         # Успішний запуск у режимі Webhook
         logger.info(f"Запуск у режимі Webhook на порту {PORT} за адресою {WEBHOOK_URL}")
@@ -863,7 +3552,8 @@ def main() -> None:
             url_path=TELEGRAM_TOKEN,
             webhook_url=WEBHOOK_URL + TELEGRAM_TOKEN,
             allowed_updates=Update.ALL_TYPES,
-            drop_pending_updates=True
+            drop_pending_updates=False,
+            stop_signals=None
         )
 
 if __name__ == '__main__':
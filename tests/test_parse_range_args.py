@@ -0,0 +1,56 @@
+"""Тести розбору аргументів діапазонних команд, зокрема прапорця попереднього перегляду `?`."""
+import pytest
+
+import Pized
+
+
+def test_two_dates():
+    assert Pized.parse_range_args(["2025-10-01", "2025-10-31"]) == ("2025-10-01", "2025-10-31", [], False)
+
+
+def test_dates_are_standardized():
+    assert Pized.parse_range_args(["2025-10-1", "2025-10-9"]) == ("2025-10-01", "2025-10-09", [], False)
+
+
+def test_rest_arguments():
+    assert Pized.parse_range_args(["2025-10-01", "2025-10-31", "09:00", "18:00", "60"]) == (
+        "2025-10-01", "2025-10-31", ["09:00", "18:00", "60"], False)
+
+
+def test_dry_run_flag():
+    assert Pized.parse_range_args(["2025-10-01", "2025-10-31", Pized.DRY_RUN_ARG]) == (
+        "2025-10-01", "2025-10-31", [], True)
+
+
+def test_dry_run_flag_after_rest_arguments():
+    assert Pized.parse_range_args(["2025-10-01", "2025-10-31", "60", "?"]) == ("2025-10-01", "2025-10-31", ["60"], True)
+
+
+def test_dry_run_flag_only_counts_at_the_end():
+    assert Pized.parse_range_args(["2025-10-01", "2025-10-31", "?", "60"]) == (
+        "2025-10-01", "2025-10-31", ["?", "60"], False)
+
+
+def test_single_day_range():
+    assert Pized.parse_range_args(("2025-10-05", "2025-10-05")) == ("2025-10-05", "2025-10-05", [], False)
+
+
+def test_args_are_not_mutated():
+    args = ["2025-10-01", "2025-10-31", "?"]
+    Pized.parse_range_args(args)
+    assert args == ["2025-10-01", "2025-10-31", "?"]
+
+
+@pytest.mark.parametrize("args", [
+    None,
+    [],
+    ["?"],
+    ["2025-10-01"],
+    ["2025-10-01", "?"],
+    ["2025-10-31", "2025-10-01"],
+    ["2025-13-01", "2025-10-31"],
+    ["01.10.2025", "2025-10-31"],
+])
+def test_invalid_args(args):
+    with pytest.raises(ValueError):
+        Pized.parse_range_args(args)
@@ -0,0 +1,73 @@
+"""Тести PayRuleIndex: пороги понаднормових, множники дня та пріоритет правил користувача над правилами команди."""
+import pytest
+
+import Pized
+
+
+def make_rule(user_code, valid_from, hourly_rate, overtime_tiers=(), weekend_multiplier=1.0, holiday_multiplier=1.0):
+    return {'user_code': user_code, 'valid_from': valid_from, 'hourly_rate': hourly_rate,
+            'weekend_multiplier': weekend_multiplier, 'holiday_multiplier': holiday_multiplier,
+            'overtime_tiers': sorted(overtime_tiers)}
+
+
+WEEKDAY = "2025-10-01" # Середа
+SATURDAY = "2025-10-04"
+
+
+@pytest.mark.parametrize("net_hours, expected", [
+    (0, 0.0),
+    (6, 600.0),     # Нижче першого порогу
+    (8, 800.0),     # Рівно на порозі — без надбавки
+    (9, 950.0),     # 8 × 1 + 1 × 1.5
+    (10, 1150.0),   # 8 × 1 + 1 × 1.5 + 1 × 2
+    (12.5, 1650.0), # 8 × 1 + 1 × 1.5 + 3.5 × 2
+])
+def test_overtime_tiers(net_hours, expected):
+    index = Pized.PayRuleIndex(50.0, [make_rule(Pized.PAY_RULE_ALL_USERS, "2025-01-01", 100.0,
+                                                [(9, 2.0), (8, 1.5)])], set())
+    assert index.price("u1", WEEKDAY, net_hours) == expected
+
+
+def test_day_multiplier_applies_on_top_of_tiers():
+    rule = make_rule(Pized.PAY_RULE_ALL_USERS, "2025-01-01", 100.0, [(8, 1.5)],
+                     weekend_multiplier=2.0, holiday_multiplier=3.0)
+    index = Pized.PayRuleIndex(50.0, [rule], {WEEKDAY})
+    assert index.price("u1", WEEKDAY, 9) == 2850.0
+    assert index.price("u1", SATURDAY, 9) == 1900.0
+    assert index.price("u1", "2025-10-02", 9) == 950.0
+
+
+def test_base_rate_without_rules():
+    index = Pized.PayRuleIndex(50.0, [], set())
+    assert index.resolve("u1", WEEKDAY) is index.base_rule
+    assert index.price("u1", SATURDAY, 10) == 500.0
+
+
+def test_user_rule_takes_precedence_over_team_rule():
+    team_rule = make_rule(Pized.PAY_RULE_ALL_USERS, "2025-01-01", 100.0)
+    user_rule = make_rule("u1", "2025-06-01", 200.0)
+    index = Pized.PayRuleIndex(50.0, [team_rule, user_rule], set())
+
+    assert index.resolve("u1", "2025-05-31") is team_rule # Правило користувача ще не діє
+    assert index.resolve("u1", "2025-06-01") is user_rule
+    assert index.resolve("u2", "2025-06-01") is team_rule
+    assert index.resolve("u1", "2024-12-31") is index.base_rule
+
+
+def test_user_rule_wins_even_if_team_rule_is_newer():
+    user_rule = make_rule("u1", "2025-01-01", 200.0)
+    team_rule = make_rule(Pized.PAY_RULE_ALL_USERS, "2025-09-01", 120.0)
+    index = Pized.PayRuleIndex(50.0, [team_rule, user_rule], set())
+
+    assert index.resolve("u1", WEEKDAY) is user_rule
+    assert index.resolve("u2", WEEKDAY) is team_rule
+
+
+def test_latest_rule_of_the_same_target_applies():
+    rules = [make_rule("u1", "2025-01-01", 100.0), make_rule("u1", "2025-07-01", 110.0),
+             make_rule("u1", "2025-10-01", 130.0)]
+    index = Pized.PayRuleIndex(50.0, rules, set())
+
+    assert index.resolve("u1", "2025-06-30")['hourly_rate'] == 100.0
+    assert index.resolve("u1", "2025-09-30")['hourly_rate'] == 110.0
+    assert index.resolve("u1", WEEKDAY)['hourly_rate'] == 130.0
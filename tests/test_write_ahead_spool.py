@@ -0,0 +1,70 @@
+"""Тести WriteAheadSpool: дописування, читання, відкидання застосованих операцій і недописаний останній рядок."""
+import json
+
+import Pized
+
+
+def make_op(work_date, op='save'):
+    return {'op': op, 'team_id': 't1', 'user_code': 'u1', 'work_date': work_date}
+
+
+def test_append_read_drop(tmp_path):
+    spool = Pized.WriteAheadSpool(str(tmp_path / "spool.jsonl"), fsync_interval=0)
+    ops = [make_op(f"2025-10-0{day}") for day in range(1, 4)]
+    for op in ops:
+        spool.append(op)
+
+    assert spool.pending() == 3
+    assert spool.read() == ops
+
+    spool.drop_applied(2)
+    assert spool.pending() == 1
+    assert spool.read() == ops[2:]
+
+    spool.append(make_op("2025-10-04", op='delete'))
+    assert spool.read() == [ops[2], make_op("2025-10-04", op='delete')]
+
+    spool.drop_applied(2)
+    assert spool.pending() == 0
+    assert spool.read() == []
+
+
+def test_partial_final_line_is_dropped(tmp_path):
+    path = tmp_path / "spool.jsonl"
+    complete = [make_op("2025-10-01"), make_op("2025-10-02")]
+    torn = json.dumps(make_op("2025-10-03"))[:-7] # Процес упав посеред запису
+    path.write_text("".join(json.dumps(op) + "\n" for op in complete) + torn, encoding='utf-8')
+
+    spool = Pized.WriteAheadSpool(str(path), fsync_interval=0)
+    assert spool.pending() == 2
+    assert spool.read() == complete
+    assert path.read_text(encoding='utf-8').endswith("\n")
+
+    # Нова операція не склеюється з обрізаним рядком
+    spool.append(make_op("2025-10-04"))
+    assert spool.read() == complete + [make_op("2025-10-04")]
+
+    spool.drop_applied(3)
+    assert spool.read() == []
+
+
+def test_partial_final_line_before_first_append(tmp_path):
+    path = tmp_path / "spool.jsonl"
+    path.write_text(json.dumps(make_op("2025-10-01")) + "\n" + '{"op": "sa', encoding='utf-8')
+
+    spool = Pized.WriteAheadSpool(str(path), fsync_interval=0)
+    spool.append(make_op("2025-10-02"))
+
+    assert spool.read() == [make_op("2025-10-01"), make_op("2025-10-02")]
+    assert spool.pending() == 2
+
+
+def test_corrupt_line_in_the_middle_is_skipped(tmp_path):
+    path = tmp_path / "spool.jsonl"
+    path.write_text(json.dumps(make_op("2025-10-01")) + "\n" + "not json\n" + json.dumps(make_op("2025-10-02")) + "\n",
+                    encoding='utf-8')
+
+    spool = Pized.WriteAheadSpool(str(path), fsync_interval=0)
+    assert spool.read() == [make_op("2025-10-01"), make_op("2025-10-02")]
+    spool.drop_applied(1)
+    assert spool.read() == [make_op("2025-10-02")]
@@ -0,0 +1,71 @@
+"""
+Навантажувальний тест ізоляції команд (TenantLimiter): велика команда заливає звітами, малі команди
+мають лишатися в межах своєї p99 затримки. Запуск: `python tools/loadtest.py`.
+"""
+import asyncio
+import math
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Pized
+
+
+async def tenant_load_scenario(per_tenant_jobs: int, tenants: int, jobs_per_tenant: int, heavy_jobs: int,
+                               job_seconds: float) -> dict:
+    """
+    Одна «велика» команда ставить heavy_jobs звітів раніше за всіх, решта tenants команд — по jobs_per_tenant.
+    Ліміт частоти вимкнено: перевіряються саме семафори одночасних задач. Повертає p50/p99 очікування (мс).
+    """
+    limiter = Pized.TenantLimiter(Pized.TENANT_RATE_LIMIT, Pized.TENANT_RATE_BURST, per_tenant_jobs,
+                                  Pized.GLOBAL_MAX_CONCURRENT_JOBS, rate_limited=False)
+    latencies = {}
+
+    async def report(team_id: str) -> None:
+        queued = time.perf_counter()
+        await limiter.run(team_id, time.sleep, job_seconds, executor=executor)
+        latencies.setdefault(team_id, []).append(time.perf_counter() - queued - job_seconds)
+
+    def percentile(values: list, pct: float) -> float:
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * pct))] * 1000 if values else 0.0
+
+    jobs = [report("heavy") for _ in range(heavy_jobs)]
+    for n in range(tenants):
+        jobs.extend(report(f"small_{n}") for _ in range(jobs_per_tenant))
+    # Окремий пул на GLOBAL_MAX_CONCURRENT_JOBS потоків, щоб результат не залежав від кількості CPU
+    with ThreadPoolExecutor(max_workers=Pized.GLOBAL_MAX_CONCURRENT_JOBS) as executor:
+        await asyncio.gather(*jobs)
+
+    small = [v for team_id, values in latencies.items() if team_id != "heavy" for v in values]
+    heavy = latencies["heavy"]
+    return {'small_p50': percentile(small, 0.5), 'small_p99': percentile(small, 0.99),
+            'heavy_p50': percentile(heavy, 0.5), 'heavy_p99': percentile(heavy, 0.99)}
+
+async def tenant_load_test(tenants: int = 50, jobs_per_tenant: int = 2, heavy_jobs: int = 400, job_seconds: float = 0.05) -> None:
+    """
+    Запуск: `python tools/loadtest.py`. Порівнює очікування малих команд, поки велика команда заливає
+    звітами: з семафором на команду (TENANT_MAX_CONCURRENT_JOBS) і без нього (лише глобальний семафор).
+    Завершується з помилкою, якщо ізоляція не тримає p99 малих команд у межах.
+    """
+    results = {}
+    unbounded = heavy_jobs + tenants * jobs_per_tenant # Семафор команди, який ніколи не чекає
+    for label, per_tenant_jobs in (("Без ізоляції", unbounded), ("З ізоляцією", Pized.TENANT_MAX_CONCURRENT_JOBS)):
+        result = await tenant_load_scenario(per_tenant_jobs, tenants, jobs_per_tenant, heavy_jobs, job_seconds)
+        results[label] = result
+        print(f"{label}: малі команди p50={result['small_p50']:.0f} мс, p99={result['small_p99']:.0f} мс; "
+              f"велика команда p50={result['heavy_p50']:.0f} мс, p99={result['heavy_p99']:.0f} мс")
+
+    # Малим командам лишається щонайменше GLOBAL - TENANT слотів, тож їхня черга не залежить від heavy_jobs
+    free_slots = max(1, Pized.GLOBAL_MAX_CONCURRENT_JOBS - Pized.TENANT_MAX_CONCURRENT_JOBS)
+    bound_ms = math.ceil(tenants * jobs_per_tenant / free_slots) * job_seconds * 1000 * 1.5
+    isolated, shared = results["З ізоляцією"]['small_p99'], results["Без ізоляції"]['small_p99']
+    if isolated > bound_ms or isolated > shared / 2:
+        raise SystemExit(f"ПРОВАЛ: p99 малих команд {isolated:.0f} мс (межа {bound_ms:.0f} мс, без ізоляції {shared:.0f} мс)")
+    print(f"OK: p99 малих команд {isolated:.0f} мс ≤ {bound_ms:.0f} мс і вдвічі менше, ніж без ізоляції ({shared:.0f} мс)")
+
+
+if __name__ == '__main__':
+    asyncio.run(tenant_load_test())
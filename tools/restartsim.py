@@ -0,0 +1,301 @@
+"""
+Імітація перезапуску бота (rolling restart). Запуск: `python tools/restartsim.py`.
+
+Імітація проганяє справжній шлях передачі: Application з PTB (run_polling і його послідовність
+зупинки), begin_shutdown, error_handler, save_pending_update / claim_pending_updates,
+pending_updates_worker та on_stop. Замінено лише зовнішні системи: Bot API (SimulatedTelegram
+тримає оновлення до підтвердження offset, як Telegram) і таблицю pending_updates (SimulatedPendingStore).
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+from telegram import Update
+from telegram.ext import Application, CommandHandler, ContextTypes
+from telegram.request import BaseRequest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Pized
+
+
+class SimulatedTelegram:
+    """Заглушка Bot API: черга оновлень з підтвердженням через offset і журнал відповідей бота."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._updates = []
+        self._next_id = 1
+        self.sent_at = {} # update_id -> час надходження в «Telegram»
+        self.replies = []
+
+    def push(self, text: str) -> int:
+        """Нове повідомлення від користувача з командою text."""
+        with self._lock:
+            update_id = self._next_id
+            self._next_id += 1
+            chat = {'id': 1000 + update_id % 10, 'type': 'private'}
+            self._updates.append({
+                'update_id': update_id,
+                'message': {
+                    'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'text': text,
+                    'from': {'id': chat['id'], 'is_bot': False, 'first_name': 'Sim'},
+                    'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}],
+                },
+            })
+            self.sent_at[update_id] = time.perf_counter()
+            return update_id
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._updates)
+
+    def call(self, endpoint: str, params: dict):
+        """Відповідь на виклик методу Bot API."""
+        with self._lock:
+            if endpoint == 'getMe':
+                return {'id': 1, 'is_bot': True, 'first_name': 'Sim', 'username': 'sim_bot'}
+            if endpoint == 'deleteWebhook':
+                if params.get('drop_pending_updates'):
+                    self._updates.clear()
+                return True
+            if endpoint == 'getUpdates':
+                # Оновлення з id < offset вважаються підтвердженими й більше не віддаються
+                offset = params.get('offset') or 0
+                self._updates = [u for u in self._updates if u['update_id'] >= offset]
+                return self._updates[:params.get('limit', 100)]
+            if endpoint == 'sendMessage':
+                self.replies.append(params.get('text'))
+                return {'message_id': len(self.replies), 'date': int(time.time()), 'text': params.get('text'),
+                        'chat': {'id': params.get('chat_id'), 'type': 'private'}}
+            return True
+
+
+class SimulatedTelegramRequest(BaseRequest):
+    """Транспорт PTB, що звертається до SimulatedTelegram замість api.telegram.org."""
+
+    def __init__(self, telegram: SimulatedTelegram):
+        self.telegram = telegram
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        result = self.telegram.call(endpoint, params)
+        if endpoint == 'getUpdates':
+            # Long polling: чекаємо на нові оновлення (не довше 0.5 с, щоб зупинка не затягувалась)
+            deadline = time.monotonic() + min(float(params.get('timeout') or 0), 0.5)
+            while not result and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+                result = self.telegram.call(endpoint, params)
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+class SimulatedPendingStore:
+    """Таблиця pending_updates у пам'яті: підставляється замість Pized.get_db_connection на час імітації."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows = []
+        self._next_id = 1
+        self.saved = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._rows)
+
+    def connect(self):
+        return self
+
+    def cursor(self):
+        return SimulatedPendingCursor(self)
+
+    def commit(self) -> None:
+        pass
+
+    def rollback(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class SimulatedPendingCursor:
+    """Курсор SimulatedPendingStore: розуміє лише запити до pending_updates."""
+
+    def __init__(self, store: SimulatedPendingStore):
+        self.store = store
+        self._result = []
+
+    def execute(self, query: str, params: tuple = ()) -> None:
+        with self.store._lock:
+            if 'INSERT INTO pending_updates' in query:
+                self.store._rows.append((self.store._next_id, params[0]))
+                self.store._next_id += 1
+                self.store.saved += 1
+            elif 'DELETE FROM pending_updates' in query:
+                self._result = self.store._rows[:params[0]]
+                del self.store._rows[:params[0]]
+            else:
+                raise NotImplementedError(query)
+
+    def fetchall(self) -> list:
+        return self._result
+
+
+def rolling_restart_simulation(graceful: bool, rate: float = 50, duration: float = 6.0, restart_at: float = 2.0,
+                               start_seconds: float = 1.0, report_share: float = 0.1, report_seconds: float = 0.5,
+                               drain_deadline: float = Pized.DRAIN_DEADLINE, settle_seconds: float = 15.0,
+                               seed: int = 1) -> dict:
+    """
+    Два інстанси бота по черзі обробляють потік оновлень з частотою rate, частина з них — важкі звіти
+    через Pized.TENANT_LIMITER. У момент restart_at старий інстанс отримує «SIGTERM», новий стартує після його
+    зупинки й прогріву start_seconds. graceful=True — поточна поведінка (begin_shutdown, drop_pending_updates=False);
+    graceful=False — стара (одразу stop_running, новий інстанс з drop_pending_updates=True).
+    drain_deadline, коротший за report_seconds, змушує старий інстанс передати звіти, що чекали на слот,
+    через pending_updates, а ті, що вже виконуються, перервати (JobInterrupted — користувач отримує відповідь).
+    Повертає кількість надісланих, втрачених, перерваних і повторно оброблених оновлень, передані через
+    pending_updates та p99 затримку.
+    """
+    telegram = SimulatedTelegram()
+    store = SimulatedPendingStore()
+    completed = {}
+    interrupted = set()
+    duplicates = 0
+    completed_lock = threading.Lock()
+
+    async def sim_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        nonlocal duplicates
+        if context.args and context.args[0] == 'report':
+            try:
+                await Pized.TENANT_LIMITER.run(f"team_{update.update_id % 10}", time.sleep, report_seconds)
+            except Pized.JobInterrupted:
+                with completed_lock:
+                    interrupted.add(update.update_id)
+                raise
+        else:
+            await asyncio.sleep(0.005)
+        with completed_lock:
+            if update.update_id in completed:
+                duplicates += 1 # Оновлення оброблено вдруге (не підтверджений offset при передачі)
+            else:
+                completed[update.update_id] = time.perf_counter()
+
+    def run_instance(drop_pending_updates: bool, instance: dict) -> None:
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        application = (Application.builder().token("1:SIMULATION")
+                       .request(SimulatedTelegramRequest(telegram))
+                       .get_updates_request(SimulatedTelegramRequest(telegram))
+                       .build())
+
+        async def startup(app: Application) -> None:
+            instance['loop'] = asyncio.get_running_loop()
+            await asyncio.sleep(start_seconds) # Прогрів кешів і пулу процесів
+            Pized.start_background_tasks(app)
+            instance['ready'].set()
+
+        application.post_init = startup
+        application.post_stop = Pized.on_stop
+        application.add_error_handler(Pized.error_handler)
+        application.add_handler(CommandHandler("sim", sim_command, block=False))
+        instance['app'] = application
+        application.run_polling(poll_interval=0, timeout=1, drop_pending_updates=drop_pending_updates, stop_signals=None)
+
+    def start_instance(drop_pending_updates: bool) -> tuple:
+        instance = {'ready': threading.Event()}
+        thread = threading.Thread(target=run_instance, args=(drop_pending_updates, instance))
+        thread.start()
+        instance['ready'].wait()
+        return thread, instance
+
+    def new_limiter() -> Pized.TenantLimiter:
+        return Pized.TenantLimiter(Pized.TENANT_RATE_LIMIT, Pized.TENANT_RATE_BURST, Pized.TENANT_MAX_CONCURRENT_JOBS,
+                                   Pized.GLOBAL_MAX_CONCURRENT_JOBS, rate_limited=False)
+
+    def producer() -> None:
+        rng = random.Random(seed) # Однакова суміш звітів у кожному прогоні
+        started = time.perf_counter()
+        sent = 0
+        while time.perf_counter() - started < duration:
+            telegram.push("/sim report" if rng.random() < report_share else "/sim quick")
+            sent += 1
+            time.sleep(max(0.0, started + sent / rate - time.perf_counter()))
+
+    # Бот звертається до get_db_connection і TENANT_LIMITER як до глобальних імен модуля — підміняємо їх там
+    saved_connection, saved_limiter, saved_deadline = Pized.get_db_connection, Pized.TENANT_LIMITER, Pized.DRAIN_DEADLINE
+    Pized.get_db_connection, Pized.DRAIN_DEADLINE = store.connect, drain_deadline
+    try:
+        Pized.TENANT_LIMITER = new_limiter()
+        old_thread, old = start_instance(drop_pending_updates=False)
+        producer_thread = threading.Thread(target=producer)
+        producer_thread.start()
+
+        time.sleep(restart_at)
+        shutdown = Pized.begin_shutdown if graceful else Application.stop_running
+        old['loop'].call_soon_threadsafe(shutdown, old['app'])
+        old_thread.join()
+
+        # Новий інстанс — окремий процес у реальному розгортанні, тож і стан обмежувача в нього свій
+        Pized.TENANT_LIMITER = new_limiter()
+        new_thread, new = start_instance(drop_pending_updates=not graceful)
+        producer_thread.join()
+
+        deadline = time.monotonic() + settle_seconds
+        while time.monotonic() < deadline:
+            with completed_lock:
+                done = len(completed)
+            if done + len(interrupted) == len(telegram.sent_at) or (telegram.pending() == 0 and len(store) == 0
+                                                 and not Pized.TENANT_LIMITER._in_flight):
+                break
+            time.sleep(0.1)
+        time.sleep(report_seconds + 0.1)
+        new['loop'].call_soon_threadsafe(new['app'].stop_running)
+        new_thread.join()
+    finally:
+        Pized.get_db_connection, Pized.TENANT_LIMITER, Pized.DRAIN_DEADLINE = saved_connection, saved_limiter, saved_deadline
+
+    latencies = sorted(completed[update_id] - telegram.sent_at[update_id] for update_id in completed)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000 if latencies else 0.0
+    return {'sent': len(telegram.sent_at), 'lost': len(telegram.sent_at) - len(completed) - len(interrupted),
+            'interrupted': len(interrupted), 'duplicates': duplicates, 'handed_over': store.saved, 'p99_ms': round(p99, 1)}
+
+def restart_report() -> None:
+    """
+    Порівнює втрати та p99 затримку для старого і нового перезапуску. Новий перезапуск перевіряється й
+    з дедлайном, коротшим за звіт (передача через pending_updates). Завершується з помилкою, якщо новий
+    перезапуск втратив або повторив оновлення, або якщо передача через pending_updates не відбулася.
+    """
+    logging.disable(logging.INFO)
+    scenarios = (
+        ("Старий (drop_pending_updates)", {'graceful': False}),
+        ("Зливання + передача", {'graceful': True}),
+        ("Зливання з дедлайном 0.2 с", {'graceful': True, 'drain_deadline': 0.2, 'report_share': 0.5}),
+    )
+    failures = []
+    for label, options in scenarios:
+        result = rolling_restart_simulation(**options)
+        print(f"{label}: надіслано {result['sent']}, втрачено {result['lost']}, перервано {result['interrupted']}, "
+              f"повторів {result['duplicates']}, передано через pending_updates {result['handed_over']}, "
+              f"p99 затримка {result['p99_ms']} мс")
+        if not options['graceful']:
+            continue
+        if result['lost'] or result['duplicates']:
+            failures.append(f"{label}: втрачено {result['lost']}, повторів {result['duplicates']}")
+        if 'drain_deadline' in options and not result['handed_over']:
+            failures.append(f"{label}: жодне оновлення не передано через pending_updates")
+    if failures:
+        raise SystemExit("ПРОВАЛ: " + "; ".join(failures))
+    print("OK: новий перезапуск не втрачає й не повторює оновлень, передача через pending_updates працює")
+
+if __name__ == '__main__':
+    restart_report()